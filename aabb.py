@@ -5,29 +5,53 @@ from point3 import Point3
 class AABB:
     '''Axis-aligned bounding box stored with two points'''
 
+    __slots__ = ('_min', '_max')
+
     def __init__(self, a=Point3(0, 0, 0), b=Point3(0, 0, 0)):
         self._min = a
         self._max = b
 
     def hit(self, ray, tmin, tmax):
-        for a in range(3):
-            inv_dir = 1.0 / ray.dir[a]
-            t0 = (self._min[a] - ray.orig[a]) * inv_dir
-            t1 = (self._max[a] - ray.orig[a]) * inv_dir
+        # Slab test per axis, written out to avoid indexing the vectors
+        orig = ray.orig
+        direction = ray.dir
+        lo = self._min
+        hi = self._max
 
-            if inv_dir < 0.0:
-                temp = t0
-                t0 = t1
-                t1 = temp
+        inv_dir = 1.0 / direction.x if direction.x != 0 else float('inf')
+        t0 = (lo.x - orig.x) * inv_dir
+        t1 = (hi.x - orig.x) * inv_dir
+        if inv_dir < 0.0:
+            t0, t1 = t1, t0
+        if t0 > tmin:
+            tmin = t0
+        if t1 < tmax:
+            tmax = t1
+        if tmax <= tmin:
+            return False
 
-            if t0 > tmin:
-                tmin = t0
-            if t1 < tmax:
-                tmax = t1
+        inv_dir = 1.0 / direction.y if direction.y != 0 else float('inf')
+        t0 = (lo.y - orig.y) * inv_dir
+        t1 = (hi.y - orig.y) * inv_dir
+        if inv_dir < 0.0:
+            t0, t1 = t1, t0
+        if t0 > tmin:
+            tmin = t0
+        if t1 < tmax:
+            tmax = t1
+        if tmax <= tmin:
+            return False
 
-            if tmax <= tmin:
-                return False
-        return True
+        inv_dir = 1.0 / direction.z if direction.z != 0 else float('inf')
+        t0 = (lo.z - orig.z) * inv_dir
+        t1 = (hi.z - orig.z) * inv_dir
+        if inv_dir < 0.0:
+            t0, t1 = t1, t0
+        if t0 > tmin:
+            tmin = t0
+        if t1 < tmax:
+            tmax = t1
+        return tmax > tmin
 
     def replace_values(self, other):
         self._min = other._min
@@ -36,6 +60,6 @@ class AABB:
     @classmethod
     def surrounding_box(self, box0, box1):
         small = Point3(min(box0._min.x, box1._min.x), min(box0._min.y, box1._min.y), min(box0._min.z, box1._min.z))
-        big   = Point3(min(box0._max.x, box1._max.x), min(box0._max.y, box1._max.y), min(box0._max.z, box1._max.z))
+        big   = Point3(max(box0._max.x, box1._max.x), max(box0._max.y, box1._max.y), max(box0._max.z, box1._max.z))
 
         return AABB(small, big)
\ No newline at end of file
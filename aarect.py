@@ -1,12 +1,65 @@
 # Custom libraries
-from hittable import Hittable, HitRecord
+from hittable import Hittable
 from aabb import AABB
 from point3 import Point3
 from vec3 import Vec3
 from ray import Ray
-
-# 3rd party library
-from random import uniform
+from sampler import sample_2d
+
+# 3rd party libraries
+from math import sqrt, acos, cos, sin, pi
+
+
+# Outward normals of the rectangles, shared by all hits (never changed in place)
+X_NORMAL = Vec3(1, 0, 0)
+Y_NORMAL = Vec3(0, 1, 0)
+Z_NORMAL = Vec3(0, 0, 1)
+
+
+def spherical_rectangle(x0, x1, y0, y1, z0):
+    '''Solid angle of the rectangle [x0, x1] x [y0, y1] in the plane z = z0 seen from the origin, and the terms that sample_spherical_rectangle
+    needs (Urena, Fajardo and King, "An Area-Preserving Parametrization for Spherical Rectangles", 2013)'''
+    # Seen from below, which mirrors the rectangle without changing its solid angle
+    z0 = -abs(z0)
+    if z0 == 0:
+        return 0.0, 0.0, 0.0, 0.0
+
+    # Normals of the planes through the origin and each edge (only their nonzero components), and the angles between them
+    z2 = z0 * z0
+    l0 = sqrt(z2 + y0 * y0)
+    l1 = sqrt(z2 + x1 * x1)
+    l2 = sqrt(z2 + y1 * y1)
+    l3 = sqrt(z2 + x0 * x0)
+    g0 = acos(min(max(y0 * x1 / (l0 * l1), -1.0), 1.0))
+    g1 = acos(min(max(-x1 * y1 / (l1 * l2), -1.0), 1.0))
+    g2 = acos(min(max(y1 * x0 / (l2 * l3), -1.0), 1.0))
+    g3 = acos(min(max(-x0 * y0 / (l3 * l0), -1.0), 1.0))
+    k = 2 * pi - g2 - g3
+    return max(g0 + g1 - k, 0.0), k, -y0 / l0, y1 / l2
+
+
+def sample_spherical_rectangle(x0, x1, y0, y1, z0, u, v):
+    '''Point (x, y) of the rectangle [x0, x1] x [y0, y1] in the plane z = z0 chosen uniformly by solid angle seen from the origin
+    with two random numbers, and the solid angle (0 if the rectangle is seen edge-on)'''
+    solid_angle, k, b0, b1 = spherical_rectangle(x0, x1, y0, y1, z0)
+    if not solid_angle > 0:
+        return x0, y0, 0.0
+    z0 = -abs(z0)
+
+    # Column of the point: the angle u * solid_angle + k gives the cosine of its direction in the XZ-plane
+    au = u * solid_angle + k
+    fu = (cos(au) * b0 - b1) / (sin(au) or 1e-300)
+    cu = min(max((1 if fu > 0 else -1) / sqrt(fu * fu + b0 * b0), -1.0), 1.0)
+    xu = min(max(-(cu * z0) / max(sqrt(1 - cu * cu), 1e-300), x0), x1)
+
+    # Height of the point along the column, uniform in the sine of its elevation
+    d = sqrt(xu * xu + z0 * z0)
+    h0 = y0 / sqrt(d * d + y0 * y0)
+    h1 = y1 / sqrt(d * d + y1 * y1)
+    hv = h0 + v * (h1 - h0)
+    hv2 = hv * hv
+    yv = hv * d / sqrt(1 - hv2) if hv2 < 1 - 1e-12 else y1
+    return xu, min(max(yv, y0), y1), solid_angle
 
 
 class xyRect(Hittable):
@@ -24,7 +77,7 @@ class xyRect(Hittable):
         output_box.replace_values(AABB(Point3(self.x0, self.y0, self.k - 0.0001), Point3(self.x1, self.y1, self.k + 0.0001)))
         return True
 
-    def hit(self, ray, t_min, t_max, rec):
+    def intersect(self, ray, t_min, t_max, rec):
         t = (self.k - ray.orig.z) / ray.dir.z
         if t < t_min or t > t_max:
             return False
@@ -34,31 +87,51 @@ class xyRect(Hittable):
 
         if x < self.x0 or x > self.x1 or y < self.y0 or y > self.y1:
             return False
-        
-        rec.u = (x - self.x0) / (self.x1 - self.x0)
-        rec.v = (y - self.y0) / (self.y1 - self.y0)
+
         rec.t = t
-        outward_normal = Vec3(0, 0, 1)
-        rec.set_face_normal(ray, outward_normal)
-        rec.mat = self.mat
-        rec.p = ray.at(t)
+        rec.obj = self
+        rec.inner = None
         return True
 
-    def pdf_value(self, origin, v):
-        rec = HitRecord()
+    def occluded(self, ray, t_min, t_max):
+        t = (self.k - ray.orig.z) / ray.dir.z
+        if t < t_min or t > t_max:
+            return False
+        x = ray.orig.x + t * ray.dir.x
+        y = ray.orig.y + t * ray.dir.y
+        return self.x0 <= x <= self.x1 and self.y0 <= y <= self.y1
+
+    def surface(self, ray, rec):
+        rec.p = ray.at(rec.t)
+        rec.u = (rec.p.x - self.x0) / (self.x1 - self.x0)
+        rec.v = (rec.p.y - self.y0) / (self.y1 - self.y0)
+        rec.du = 1 / (self.x1 - self.x0)
+        rec.dv = 1 / (self.y1 - self.y0)
+        rec.set_face_normal(ray, Z_NORMAL)
+        rec.mat = self.mat
 
-        if not self.hit(Ray(origin, v), 0.001, float('inf'), rec):
+    def pdf_value(self, origin, v):
+        if not self.occluded(Ray(origin, v), 0.001, float('inf')):
             return 0
-
-        area = (self.x1 - self.x0) * (self.y1 - self.y0)
-        distance_squared = rec.t * rec.t * v.length_squared()
-        cosine = abs(v.dot(rec.normal) / v.length())
-
-        return distance_squared / (cosine * area)
+        return self.light_pdf(origin, v)
+
+    def light_pdf(self, o, v):
+        '''Density of sample_light choosing a direction v from o that hits the rectangle (uniform over its solid angle)'''
+        solid_angle = spherical_rectangle(self.x0 - o.x, self.x1 - o.x, self.y0 - o.y, self.y1 - o.y, self.k - o.z)[0]
+        return 1 / solid_angle if solid_angle > 0 else 0.0
+
+    def sample_light(self, o):
+        '''Direction (unit length) from o to a point of the rectangle chosen uniformly by solid angle, with its distance and density'''
+        u, v = sample_2d()
+        h = self.k - o.z
+        x, y, solid_angle = sample_spherical_rectangle(self.x0 - o.x, self.x1 - o.x, self.y0 - o.y, self.y1 - o.y, h, u, v)
+        distance = sqrt(x * x + y * y + h * h)
+        if not solid_angle > 0:
+            return Vec3(x, y, h), distance, 0.0
+        return Vec3(x, y, h) / distance, distance, 1 / solid_angle
 
     def random(self, origin):
-        random_point = Point3(uniform(self.x0, self.x1), uniform(self.y0, self.y1), self.k + 0.001)
-        return random_point - origin
+        return self.sample_light(origin)[0]
 
 
 class xzRect(Hittable):
@@ -76,7 +149,7 @@ class xzRect(Hittable):
         output_box.replace_values(AABB(Point3(self.x0, self.k - 0.0001, self.z0), Point3(self.x1, self.k + 0.0001, self.z1)))
         return True
 
-    def hit(self, ray, t_min, t_max, rec):
+    def intersect(self, ray, t_min, t_max, rec):
         t = (self.k - ray.orig.y) / ray.dir.y
         if t < t_min or t > t_max:
             return False
@@ -86,31 +159,51 @@ class xzRect(Hittable):
 
         if x < self.x0 or x > self.x1 or z < self.z0 or z > self.z1:
             return False
-        
-        rec.u = (x - self.x0) / (self.x1 - self.x0)
-        rec.v = (z - self.z0) / (self.z1 - self.z0)
+
         rec.t = t
-        outward_normal = Vec3(0, 1, 0)
-        rec.set_face_normal(ray, outward_normal)
-        rec.mat = self.mat
-        rec.p = ray.at(t)
+        rec.obj = self
+        rec.inner = None
         return True
 
-    def pdf_value(self, origin, v):
-        rec = HitRecord()
+    def occluded(self, ray, t_min, t_max):
+        t = (self.k - ray.orig.y) / ray.dir.y
+        if t < t_min or t > t_max:
+            return False
+        x = ray.orig.x + t * ray.dir.x
+        z = ray.orig.z + t * ray.dir.z
+        return self.x0 <= x <= self.x1 and self.z0 <= z <= self.z1
+
+    def surface(self, ray, rec):
+        rec.p = ray.at(rec.t)
+        rec.u = (rec.p.x - self.x0) / (self.x1 - self.x0)
+        rec.v = (rec.p.z - self.z0) / (self.z1 - self.z0)
+        rec.du = 1 / (self.x1 - self.x0)
+        rec.dv = 1 / (self.z1 - self.z0)
+        rec.set_face_normal(ray, Y_NORMAL)
+        rec.mat = self.mat
 
-        if not self.hit(Ray(origin, v), 0.001, float('inf'), rec):
+    def pdf_value(self, origin, v):
+        if not self.occluded(Ray(origin, v), 0.001, float('inf')):
             return 0
-
-        area = (self.x1 - self.x0) * (self.z1 - self.z0)
-        distance_squared = rec.t * rec.t * v.length_squared()
-        cosine = abs(v.dot(rec.normal) / v.length())
-
-        return distance_squared / (cosine * area)
+        return self.light_pdf(origin, v)
+
+    def light_pdf(self, o, v):
+        '''Density of sample_light choosing a direction v from o that hits the rectangle (uniform over its solid angle)'''
+        solid_angle = spherical_rectangle(self.x0 - o.x, self.x1 - o.x, self.z0 - o.z, self.z1 - o.z, self.k - o.y)[0]
+        return 1 / solid_angle if solid_angle > 0 else 0.0
+
+    def sample_light(self, o):
+        '''Direction (unit length) from o to a point of the rectangle chosen uniformly by solid angle, with its distance and density'''
+        u, v = sample_2d()
+        h = self.k - o.y
+        x, y, solid_angle = sample_spherical_rectangle(self.x0 - o.x, self.x1 - o.x, self.z0 - o.z, self.z1 - o.z, h, u, v)
+        distance = sqrt(x * x + y * y + h * h)
+        if not solid_angle > 0:
+            return Vec3(x, h, y), distance, 0.0
+        return Vec3(x, h, y) / distance, distance, 1 / solid_angle
 
     def random(self, origin):
-        random_point = Point3(uniform(self.x0, self.x1), self.k + 0.001, uniform(self.z0, self.z1))
-        return random_point - origin
+        return self.sample_light(origin)[0]
 
 
 class yzRect(Hittable):
@@ -128,38 +221,58 @@ class yzRect(Hittable):
         output_box.replace_values(AABB(Point3(self.k - 0.0001, self.y0, self.z0), Point3(self.k + 0.0001, self.y1, self.z1)))
         return True
 
-    def hit(self, ray, t_min, t_max, rec):
+    def intersect(self, ray, t_min, t_max, rec):
         t = (self.k - ray.orig.x) / ray.dir.x
         if t < t_min or t > t_max:
             return False
-        
+
         y = ray.orig.y + t * ray.dir.y
         z = ray.orig.z + t * ray.dir.z
 
         if y < self.y0 or y > self.y1 or z < self.z0 or z > self.z1:
             return False
 
-        rec.u = (y - self.y0) / (self.y1 - self.y0)
-        rec.v = (z - self.z0) / (self.z1 - self.z0)
         rec.t = t
-        outward_normal = Vec3(1, 0, 0)
-        rec.set_face_normal(ray, outward_normal)
-        rec.mat = self.mat
-        rec.p = ray.at(t)
+        rec.obj = self
+        rec.inner = None
         return True
 
-    def pdf_value(self, origin, v):
-        rec = HitRecord()
+    def occluded(self, ray, t_min, t_max):
+        t = (self.k - ray.orig.x) / ray.dir.x
+        if t < t_min or t > t_max:
+            return False
+        y = ray.orig.y + t * ray.dir.y
+        z = ray.orig.z + t * ray.dir.z
+        return self.y0 <= y <= self.y1 and self.z0 <= z <= self.z1
+
+    def surface(self, ray, rec):
+        rec.p = ray.at(rec.t)
+        rec.u = (rec.p.y - self.y0) / (self.y1 - self.y0)
+        rec.v = (rec.p.z - self.z0) / (self.z1 - self.z0)
+        rec.du = 1 / (self.y1 - self.y0)
+        rec.dv = 1 / (self.z1 - self.z0)
+        rec.set_face_normal(ray, X_NORMAL)
+        rec.mat = self.mat
 
-        if not self.hit(Ray(origin, v), 0.001, float('inf'), rec):
+    def pdf_value(self, origin, v):
+        if not self.occluded(Ray(origin, v), 0.001, float('inf')):
             return 0
-
-        area = (self.y1 - self.y0) * (self.z1 - self.z0)
-        distance_squared = rec.t * rec.t * v.length_squared()
-        cosine = abs(v.dot(rec.normal) / v.length())
-
-        return distance_squared / (cosine * area)
+        return self.light_pdf(origin, v)
+
+    def light_pdf(self, o, v):
+        '''Density of sample_light choosing a direction v from o that hits the rectangle (uniform over its solid angle)'''
+        solid_angle = spherical_rectangle(self.y0 - o.y, self.y1 - o.y, self.z0 - o.z, self.z1 - o.z, self.k - o.x)[0]
+        return 1 / solid_angle if solid_angle > 0 else 0.0
+
+    def sample_light(self, o):
+        '''Direction (unit length) from o to a point of the rectangle chosen uniformly by solid angle, with its distance and density'''
+        u, v = sample_2d()
+        h = self.k - o.x
+        x, y, solid_angle = sample_spherical_rectangle(self.y0 - o.y, self.y1 - o.y, self.z0 - o.z, self.z1 - o.z, h, u, v)
+        distance = sqrt(x * x + y * y + h * h)
+        if not solid_angle > 0:
+            return Vec3(h, x, y), distance, 0.0
+        return Vec3(h, x, y) / distance, distance, 1 / solid_angle
 
     def random(self, origin):
-        random_point = Point3(self.k + 0.001, uniform(self.y0, self.y1), uniform(self.z0, self.z1))
-        return random_point - origin
\ No newline at end of file
+        return self.sample_light(origin)[0]
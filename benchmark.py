@@ -0,0 +1,247 @@
+# Custom libraries
+from color import Color
+from point3 import Point3
+from camera import Camera
+from hittablelist import HittableList
+from hittable import HitRecord, Translate, RotateY, FlipFace
+from instance import Instance
+from mesh import TriangleMesh
+from constantmedium import ConstantMedium
+from bvh import SahBvh, LinearBvh
+from scene import Scene, random_scene, two_perlin_spheres, earth, cornell_box, cornell_smoke, final_scene
+from main import make_renderer
+from sampler import SAMPLERS
+from stats import RenderStats
+from lightlist import LightList, find_lights
+
+# 3rd party libraries
+from random import random, seed as seed_random
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+
+# Version of the JSON results format
+RESULTS_VERSION = 1
+
+# Sky color of the outdoor scenes
+SKY = (0.70, 0.80, 1.00)
+
+# Per scene: the function building it, aspect ratio, camera (lookfrom, lookat, vfov, aperture, focus distance) and background
+BENCHMARKS = {
+    'random_scene':       (random_scene,       16 / 9, ((13, 2, 3), (0, 0, 0), 20, 0.1, 10.0), SKY),
+    'two_perlin_spheres': (two_perlin_spheres, 16 / 9, ((13, 2, 3), (0, 0, 0), 20, 0.0, 10.0), SKY),
+    'earth':              (earth,              16 / 9, ((13, 2, 3), (0, 0, 0), 20, 0.0, 10.0), SKY),
+    'cornell_box':        (cornell_box,        1.0, ((278, 278, -800), (278, 278, 0), 40, 0.0, 10.0), (0, 0, 0)),
+    'cornell_smoke':      (cornell_smoke,      1.0, ((278, 278, -800), (278, 278, 0), 40, 0.0, 10.0), (0, 0, 0)),
+    'final_scene':        (final_scene,        1.0, ((478, 278, -600), (278, 278, 0), 40, 0.0, 10.0), (0, 0, 0)),
+}
+
+# Metrics compared between runs, and whether a higher value is better
+METRICS = {
+    'rays_per_second': True,
+    'primitive_tests_per_ray': False,
+    'bvh_build_time': False,
+    'peak_memory': False,
+}
+
+
+def find_bvhs(obj):
+    '''All BVHs (including those of triangle meshes) in a hittable tree (shared ones once per instance)'''
+    if isinstance(obj, (SahBvh, LinearBvh, TriangleMesh)):
+        return [obj]
+    if isinstance(obj, HittableList):
+        return [bvh for child in obj.objects for bvh in find_bvhs(child)]
+    if isinstance(obj, (Translate, RotateY, Instance)):
+        return find_bvhs(obj.obj)
+    if isinstance(obj, FlipFace):
+        return find_bvhs(obj.p)
+    if isinstance(obj, ConstantMedium):
+        return find_bvhs(obj.boundary)
+    return []
+
+
+def build_scene(name, width):
+    '''Build a benchmark scene with its camera and lights, returning the scene and background color'''
+    scene_function, aspect_ratio, (lookfrom, lookat, vfov, aperture, dist_to_focus), background = BENCHMARKS[name]
+    height = int(width / aspect_ratio)
+
+    world = scene_function()
+    lights = LightList(find_lights(world))
+    camera = Camera(Point3(*lookfrom), Point3(*lookat), Point3(0, 1, 0), vfov, aspect_ratio, aperture, dist_to_focus, 0.0, 1.0)
+
+    return Scene(camera, world, lights, width, height), Color(*background)
+
+
+def count_primitive_tests(scene, engine, renderer):
+    '''Average number of primitive hit tests for a closest-hit query of one camera ray through every pixel, by the engine's own
+    traversal'''
+    rec = HitRecord()
+    stats = RenderStats()
+    stats.enable()
+    try:
+        if engine == 'wavefront':
+            import numpy as np
+            rng = np.random.default_rng(int(random() * 2 ** 32))
+            rows = np.arange(scene.height)
+            j = np.repeat(scene.height - 1 - rows, scene.width)
+            i = np.tile(np.arange(scene.width), scene.height)
+            o, d, time = renderer.tracer.camera_rays(scene.camera, i, j, scene.width, scene.height, rng)
+            renderer.tracer.intersect(o, d, time, rng)
+        else:
+            for j in range(scene.height):
+                for i in range(scene.width):
+                    ray = scene.camera.get_ray((i + random()) / (scene.width - 1), (j + random()) / (scene.height - 1))
+                    scene.world.hit(ray, 0.001, float('inf'), rec)
+    finally:
+        stats.disable()
+    tests = sum(count for key, count in stats.counts.items() if key.startswith('tests.'))
+    return tests / (scene.width * scene.height)
+
+
+def measure_peak_memory(name, engine, width, samples_per_pixel, max_depth, seed, tile_size, sampler):
+    '''Peak traced memory use while building a scene and its renderer and rendering one tile'''
+    tracemalloc.start()
+    try:
+        seed_random(seed)
+        scene, background = build_scene(name, width)
+        renderer = make_renderer(scene, engine, max_depth, background, seed, sampler)
+        renderer.render_tile(0, 0, min(tile_size, scene.width), min(tile_size, scene.height), samples_per_pixel)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run_benchmark(name, engine, width, samples_per_pixel, max_depth, seed, tile_size=16, sampler='independent'):
+    '''Build and render one scene on a single process, returning its metrics'''
+    seed_random(seed)
+    start = time.perf_counter()
+    scene, background = build_scene(name, width)
+    build_time = time.perf_counter() - start
+    # Instances share their BVHs, which are only built once
+    bvh_build_time = sum(bvh.build_time for bvh in {id(bvh): bvh for bvh in find_bvhs(scene.world)}.values())
+
+    start = time.perf_counter()
+    renderer = make_renderer(scene, engine, max_depth, background, seed, sampler)
+    setup_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for y0 in range(0, scene.height, tile_size):
+        for x0 in range(0, scene.width, tile_size):
+            renderer.render_tile(x0, y0, min(x0 + tile_size, scene.width), min(y0 + tile_size, scene.height), samples_per_pixel)
+    render_time = time.perf_counter() - start
+    rays = scene.width * scene.height * samples_per_pixel
+
+    seed_random(seed)
+    tests_per_ray = count_primitive_tests(scene, engine, renderer)
+
+    # Memory is traced in a separate run, as tracing slows down allocation and would distort the timings
+    peak_memory = measure_peak_memory(name, engine, width, samples_per_pixel, max_depth, seed, tile_size, sampler)
+
+    return {
+        'width': scene.width,
+        'height': scene.height,
+        'samples_per_pixel': samples_per_pixel,
+        'camera_rays': rays,
+        'build_time': build_time,
+        'bvh_build_time': bvh_build_time,
+        'setup_time': setup_time,
+        'render_time': render_time,
+        'rays_per_second': rays / render_time,
+        'primitive_tests_per_ray': tests_per_ray,
+        'peak_memory': peak_memory,
+    }
+
+
+def compare_results(results, baseline, tolerance):
+    '''Print the change of every metric against a previous run and return the regressions beyond the tolerance (a fraction)'''
+    regressions = []
+    print(f'Compared with {baseline["engine"]} run from {baseline["date"]}:')
+    for name, metrics in results['scenes'].items():
+        if name not in baseline['scenes']:
+            continue
+        old = baseline['scenes'][name]
+        if (old['width'], old['samples_per_pixel']) != (metrics['width'], metrics['samples_per_pixel']):
+            print(f'  {name:20s} skipped, rendered at another size or sample count')
+            continue
+        changes = []
+        for metric, higher_is_better in METRICS.items():
+            if not old.get(metric):
+                continue
+            change = metrics[metric] / old[metric] - 1
+            worse = -change if higher_is_better else change
+            flag = ''
+            if worse > tolerance:
+                regressions.append((name, metric, change))
+                flag = ' REGRESSION'
+            changes.append(f'{metric} {change * 100:+.1f}%{flag}')
+        print(f'  {name:20s} ' + ', '.join(changes))
+    return regressions
+
+
+def print_results(results):
+    '''Print the benchmark results as a table'''
+    print(f'{"scene":20s} {"size":>9s} {"spp":>4s} {"rays/s":>9s} {"tests/ray":>9s} {"build s":>8s} {"bvh s":>7s} {"peak MB":>8s}')
+    for name, m in results['scenes'].items():
+        print(f'{name:20s} {m["width"]:4d}x{m["height"]:<4d} {m["samples_per_pixel"]:4d} {m["rays_per_second"]:9.0f} {m["primitive_tests_per_ray"]:9.2f} '
+              f'{m["build_time"]:8.3f} {m["bvh_build_time"]:7.3f} {m["peak_memory"] / 2 ** 20:8.1f}')
+
+
+def main():
+    '''Benchmark the built-in scenes at a small fixed size with fixed seeds'''
+    parser = argparse.ArgumentParser(description='Render every built-in scene at a small size and report performance metrics')
+    parser.add_argument('scenes', nargs='*', help=f'Scenes to benchmark: {", ".join(BENCHMARKS)} (all by default)')
+    parser.add_argument('-e', '--engine', action='store', choices=['scalar', 'wavefront'], dest='engine', default='scalar', help='Render engine')
+    parser.add_argument('-w', '--width', action='store', type=int, dest='width', default=64, help='Image width in pixels')
+    parser.add_argument('-s', '--samples', action='store', type=int, dest='samples', default=4, help='Samples per pixel')
+    parser.add_argument('-d', '--max-depth', action='store', type=int, dest='max_depth', default=25, help='Maximum ray bounces')
+    parser.add_argument('--seed', action='store', type=int, dest='seed', default=1, help='Random seed for the scenes and sampling')
+    parser.add_argument('--sampler', action='store', choices=SAMPLERS, dest='sampler', default='independent', help='Sample pattern of the scalar engine')
+    parser.add_argument('-j', '--json', action='store', dest='json', default=None, help='File to write the results to')
+    parser.add_argument('-c', '--compare', action='store', dest='compare', default=None, help='Results file of a previous run to compare with')
+    parser.add_argument('--tolerance', action='store', type=float, dest='tolerance', default=0.1, help='Relative change that counts as a regression')
+    args = parser.parse_args()
+    for name in args.scenes:
+        if name not in BENCHMARKS:
+            parser.error(f'Unknown scene {name}, expected one of {", ".join(BENCHMARKS)}')
+
+    results = {
+        'version': RESULTS_VERSION,
+        'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'engine': args.engine,
+        'seed': args.seed,
+        'sampler': args.sampler,
+        'max_depth': args.max_depth,
+        'scenes': {},
+    }
+    for name in args.scenes or BENCHMARKS:
+        print(f'Benchmarking {name}...')
+        results['scenes'][name] = run_benchmark(name, args.engine, args.width, args.samples, args.max_depth, args.seed, sampler=args.sampler)
+
+    print_results(results)
+
+    if args.json:
+        with open(args.json, 'w') as results_fileobj:
+            json.dump(results, results_fileobj, indent=2)
+
+    if args.compare:
+        with open(args.compare) as baseline_fileobj:
+            baseline = json.load(baseline_fileobj)
+        if baseline.get('version') != RESULTS_VERSION:
+            sys.exit(f'{args.compare} is not a benchmark results file (version {RESULTS_VERSION})')
+        # Runs of different engines, samplers, path depths or seeds do different work, so their metrics are not comparable
+        for setting in ('engine', 'sampler', 'max_depth', 'seed'):
+            if baseline.get(setting) != results[setting]:
+                sys.exit(f'{args.compare} used {setting} {baseline.get(setting)}, but this run uses {results[setting]}; not comparing')
+        regressions = compare_results(results, baseline, args.tolerance)
+        if regressions:
+            print(f'{len(regressions)} regressions beyond {args.tolerance * 100:.0f}%')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,5 @@
 # Custom libraries
-from hittable import Hittable, HitRecord
+from hittable import Hittable
 from hittablelist import HittableList
 from aabb import AABB
 from aarect import *
@@ -28,15 +28,19 @@ class Box(Hittable):
         output_box.replace_values(AABB(self.box_min, self.box_max))
         return True
 
-    def hit(self, ray, t_min, t_max, rec):
-        temp = HitRecord()
-        dist_min = t_max
+    def intersect(self, ray, t_min, t_max, rec):
+        # Every hit narrows the search to closer hits, so the record ends up with the closest one
         hit_anything = False
 
         for obj in self.sides:
-            if obj.hit(ray, t_min, dist_min, temp):
+            if obj.intersect(ray, t_min, t_max, rec):
                 hit_anything = True
-                dist_min = temp.t
-                rec.replace_values(temp)
+                t_max = rec.t
         
-        return hit_anything
\ No newline at end of file
+        return hit_anything
+
+    def occluded(self, ray, t_min, t_max):
+        for obj in self.sides:
+            if obj.occluded(ray, t_min, t_max):
+                return True
+        return False
\ No newline at end of file
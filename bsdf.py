@@ -0,0 +1,47 @@
+# 3rd party libraries
+from math import sqrt, cos, sin, pi, copysign
+
+
+# Density of uniformly chosen directions
+UNIFORM_SPHERE_PDF = 1 / (4 * pi)
+
+
+def cosine_sample(nx, ny, nz, u1, u2, out):
+    '''Write a cosine-distributed direction (unit length) around a unit normal, chosen by two random numbers, and its density into
+    out.dx, out.dy, out.dz and out.pdf
+
+    The basis around the normal is built inline without branches (Duff et al., "Building an Orthonormal Basis, Revisited", 2017),
+    so no vectors are created.
+    '''
+    sign = copysign(1.0, nz)
+    a = -1.0 / (sign + nz)
+    b = nx * ny * a
+    phi = 2 * pi * u1
+    r = sqrt(u2)
+    x = cos(phi) * r
+    y = sin(phi) * r
+    z = sqrt(1 - u2)
+    out.dx = x * (1 + sign * nx * nx * a) + y * b + z * nx
+    out.dy = x * sign * b + y * (sign + ny * ny * a) + z * ny
+    out.dz = -x * sign * nx - y * ny + z * nz
+    out.pdf = z / pi
+
+
+def cosine_pdf(nx, ny, nz, dx, dy, dz):
+    '''Density of cosine_sample choosing a direction (of any length) around a unit normal'''
+    cosine = nx * dx + ny * dy + nz * dz
+    if cosine <= 0:
+        return 0.0
+    return cosine / (pi * sqrt(dx * dx + dy * dy + dz * dz))
+
+
+def uniform_sphere_sample(u1, u2, out):
+    '''Write a uniformly distributed direction (unit length) chosen by two random numbers, and its density, into out'''
+    z = 1 - 2 * u1
+    r = sqrt(max(1 - z * z, 0.0))
+    phi = 2 * pi * u2
+    out.dx = r * cos(phi)
+    out.dy = r * sin(phi)
+    out.dz = z
+    out.pdf = UNIFORM_SPHERE_PDF
+
@@ -1,93 +1,404 @@
 # Custom libraries
 from hittable import Hittable
+from hittablelist import HittableList
 from aabb import AABB
+from point3 import Point3
 
-# 3rd party library
-from random import uniform
+# 3rd party libraries
+from array import array
+import time
+
+
+# Relative costs of traversing a node and intersecting a primitive, used by the surface area heuristic
+TRAVERSAL_COST = 1.0
+INTERSECTION_COST = 1.0
 
 
 class BvhNode(Hittable):
-    '''Node in a bounding volume hierarchy for grouping objects together, speeding up rendering by making a tree of nodes'''
+    '''Node in a bounding volume hierarchy, grouping two children (nodes or leaves) under one bounding box'''
 
-    def __init__(self, objects, time0, time1, start=None, end=None):
-        self.objects = objects
-        self.time0   = time0
-        self.time1   = time1
+    def __init__(self, left, right, box, axis=0):
+        self.left  = left
+        self.right = right
+        self.box   = box
+        self.axis  = axis
 
-        self.box = AABB()
+    def bounding_box(self, t0, t1, output_box):
+        output_box.replace_values(self.box)
+        return True
 
-        if start is None:
-            self.start   = 0
-        else:
-            self.start = start
-        if end is None:
-            self.end = len(self.objects)
-        else:
-            self.end = end
+    def intersect(self, ray, t_min, t_max, rec):
+        if not self.box.hit(ray, t_min, t_max):
+            return False
 
-        axis = int(uniform(0, 3))
+        hit_left  = self.left.intersect(ray, t_min, t_max, rec)
+        hit_right = self.right.intersect(ray, t_min, rec.t if hit_left else t_max, rec)
+
+        return (hit_left or hit_right)
+
+    def occluded(self, ray, t_min, t_max):
+        if not self.box.hit(ray, t_min, t_max):
+            return False
+        return self.left.occluded(ray, t_min, t_max) or self.right.occluded(ray, t_min, t_max)
 
-        if axis == 0:
-            comparator = self.box_x_compare
-        elif axis == 1:
-            comparator = self.box_y_compare
-        else:
-            comparator = self.box_z_compare
-
-        object_span = self.end - self.start
-
-        if object_span == 1:
-            self.left  = self.objects[self.start]
-            self.right = self.objects[self.start]
-        elif object_span == 2:
-            if comparator(self.objects[self.start], self.objects[self.start + 1]):
-                self.left = self.objects[self.start]
-                self.right = self.objects[self.start + 1]
-            else:
-                self.left = self.objects[self.start + 1]
-                self.right = self.objects[self.start]
-        else:
-            s = sorted(self.objects[self.start:self.end + 1], key=comparator)
 
-            mid = self.start + object_span / 2
-            self.left  = BvhNode(self.objects, self.start,      mid, self.time0, self.time1)
-            self.right = BvhNode(self.objects,        mid, self.end, self.time0, self.time1)
+class BvhLeaf(Hittable):
+    '''Leaf in a bounding volume hierarchy storing a small list of objects'''
 
-        box_left = AABB()
-        box_right = AABB()
-        
-        if (not self.left.bounding_box(self.time0, self.time1, box_left)) or (not self.right.bounding_box(self.time0, self.time1, box_right)):
-            print('No bounding box in BvhNode constructor')
-        
-        self.box = AABB.surrounding_box(box_left, box_right)
+    def __init__(self, objects, box):
+        self.objects = objects
+        self.box     = box
 
     def bounding_box(self, t0, t1, output_box):
         output_box.replace_values(self.box)
         return True
 
-    def hit(self, ray, t_min, t_max, rec):
+    def intersect(self, ray, t_min, t_max, rec):
         if not self.box.hit(ray, t_min, t_max):
             return False
 
-        hit_left  = self.left.hit(ray, t_min, t_max, rec)
-        hit_right = self.right.hit(ray, t_min, t_max, rec)
+        hit_anything = False
 
-        return (hit_left or hit_right)
+        for obj in self.objects:
+            if obj.intersect(ray, t_min, t_max, rec):
+                hit_anything = True
+                t_max = rec.t
+
+        return hit_anything
+
+    def occluded(self, ray, t_min, t_max):
+        if not self.box.hit(ray, t_min, t_max):
+            return False
+
+        for obj in self.objects:
+            if obj.occluded(ray, t_min, t_max):
+                return True
+        return False
+
+
+class SahBvh(Hittable):
+    '''Bounding volume hierarchy built with the binned surface area heuristic (SAH) from precomputed primitive bounds
+
+    leaf_size is the largest number of primitives in a leaf, not a target: groups up to that size only become leaves where the SAH
+    finds no cheaper split. Well separated primitives (like the small spheres of random_scene) therefore mostly end up in leaves
+    of their own. Raising TRAVERSAL_COST makes leaves fill up, but did not render faster in any of the built-in scenes.
+    '''
+
+    def __init__(self, objects, time0, time1, leaf_size=4, bins=12):
+        if isinstance(objects, HittableList):
+            objects = objects.objects
+        self.objects   = list(objects)
+        self.time0     = time0
+        self.time1     = time1
+        self.leaf_size = leaf_size
+        self.bins      = bins
+
+        start = time.perf_counter()
+
+        # Compute the bounds and centroid of every primitive once
+        self.prim_min = []
+        self.prim_max = []
+        self.centroid = []
+        for lo, hi in self.primitive_bounds():
+            self.prim_min.append(lo)
+            self.prim_max.append(hi)
+            self.centroid.append(tuple(0.5 * (lo[a] + hi[a]) for a in range(3)))
+
+        self.node_count = 0
+        self.leaf_count = 0
+        self.weighted_cost = 0.0
+        self.root = self.build(list(range(len(self.objects))))
+
+        self.build_time = time.perf_counter() - start
+        root_area = box_area(self.root.box._min, self.root.box._max)
+        self.cost = self.weighted_cost / root_area if root_area > 0 else self.weighted_cost
+
+    def __str__(self):
+        return f'SAH BVH over {len(self.objects)} objects: {self.node_count} nodes, {self.leaf_count} leaves, built in {self.build_time:.3f} s, estimated cost {self.cost:.2f}'
+
+    def bounding_box(self, t0, t1, output_box):
+        output_box.replace_values(self.root.box)
+        return True
+
+    def intersect(self, ray, t_min, t_max, rec):
+        return self.root.intersect(ray, t_min, t_max, rec)
+
+    def occluded(self, ray, t_min, t_max):
+        return self.root.occluded(ray, t_min, t_max)
+
+    def primitive_bounds(self):
+        '''Bounds (min xyz, max xyz) of every primitive, in order'''
+        for obj in self.objects:
+            box = AABB()
+            if not obj.bounding_box(self.time0, self.time1, box):
+                raise ValueError(f'{type(obj).__name__} has no bounding box and cannot be put in a BVH')
+            yield (box._min.x, box._min.y, box._min.z), (box._max.x, box._max.y, box._max.z)
+
+    def bounds(self, indices, source_min, source_max):
+        lo = [float('inf')] * 3
+        hi = [float('-inf')] * 3
+        for i in indices:
+            pmin = source_min[i]
+            pmax = source_max[i]
+            for a in range(3):
+                if pmin[a] < lo[a]:
+                    lo[a] = pmin[a]
+                if pmax[a] > hi[a]:
+                    hi[a] = pmax[a]
+        return lo, hi
+
+    def make_leaf(self, indices, lo, hi):
+        box = AABB(Point3(*lo), Point3(*hi))
+        self.leaf_count += 1
+        self.weighted_cost += box_area(lo, hi) * INTERSECTION_COST * len(indices)
+        return BvhLeaf([self.objects[i] for i in indices], box)
+
+    def build(self, indices):
+        '''Recursively split the primitives with the lowest SAH cost split over all three axes'''
+        lo, hi = self.bounds(indices, self.prim_min, self.prim_max)
+        count = len(indices)
+        if count == 1:
+            return self.make_leaf(indices, lo, hi)
+
+        parent_area = box_area(lo, hi) or 1.0
+        c_lo, c_hi = self.bounds(indices, self.centroid, self.centroid)
+
+        best_cost = float('inf')
+        best_axis = None
+        best_split = None
+        for axis in range(3):
+            extent = c_hi[axis] - c_lo[axis]
+            if extent <= 0:
+                continue
+            scale = self.bins / extent
+
+            bin_count = [0] * self.bins
+            bin_lo = [[float('inf')] * 3 for _ in range(self.bins)]
+            bin_hi = [[float('-inf')] * 3 for _ in range(self.bins)]
+            for i in indices:
+                b = min(int((self.centroid[i][axis] - c_lo[axis]) * scale), self.bins - 1)
+                bin_count[b] += 1
+                pmin = self.prim_min[i]
+                pmax = self.prim_max[i]
+                blo = bin_lo[b]
+                bhi = bin_hi[b]
+                for a in range(3):
+                    if pmin[a] < blo[a]:
+                        blo[a] = pmin[a]
+                    if pmax[a] > bhi[a]:
+                        bhi[a] = pmax[a]
+
+            # Sweep from the right to get the area and count of everything after each split plane
+            right_area = [0.0] * self.bins
+            right_count = [0] * self.bins
+            acc_lo = [float('inf')] * 3
+            acc_hi = [float('-inf')] * 3
+            acc_count = 0
+            for b in range(self.bins - 1, 0, -1):
+                acc_count += bin_count[b]
+                merge_bounds(acc_lo, acc_hi, bin_lo[b], bin_hi[b])
+                right_count[b] = acc_count
+                right_area[b] = box_area(acc_lo, acc_hi) if acc_count else 0.0
+
+            acc_lo = [float('inf')] * 3
+            acc_hi = [float('-inf')] * 3
+            acc_count = 0
+            for b in range(self.bins - 1):
+                acc_count += bin_count[b]
+                merge_bounds(acc_lo, acc_hi, bin_lo[b], bin_hi[b])
+                if acc_count == 0 or right_count[b + 1] == 0:
+                    continue
+                cost = TRAVERSAL_COST + INTERSECTION_COST * (box_area(acc_lo, acc_hi) * acc_count + right_area[b + 1] * right_count[b + 1]) / parent_area
+                if cost < best_cost:
+                    best_cost = cost
+                    best_axis = axis
+                    best_split = b
+
+        leaf_cost = INTERSECTION_COST * count
+        if best_axis is None:
+            if count <= self.leaf_size:
+                return self.make_leaf(indices, lo, hi)
+            # All centroids coincide, so split by count instead
+            mid = count // 2
+            left_indices, right_indices = indices[:mid], indices[mid:]
+            best_axis = 0
+        elif count <= self.leaf_size and leaf_cost <= best_cost:
+            # Small groups stay together only if no split is cheaper, so leaf_size acts as a maximum
+            return self.make_leaf(indices, lo, hi)
+        else:
+            scale = self.bins / (c_hi[best_axis] - c_lo[best_axis])
+            left_indices = []
+            right_indices = []
+            for i in indices:
+                if min(int((self.centroid[i][best_axis] - c_lo[best_axis]) * scale), self.bins - 1) <= best_split:
+                    left_indices.append(i)
+                else:
+                    right_indices.append(i)
+
+        self.node_count += 1
+        self.weighted_cost += box_area(lo, hi) * TRAVERSAL_COST
+        return BvhNode(self.build(left_indices), self.build(right_indices), AABB(Point3(*lo), Point3(*hi)), best_axis)
+
+
+def merge_bounds(lo, hi, other_lo, other_hi):
+    '''Grow the bounds (lo, hi) in place to include (other_lo, other_hi)'''
+    for a in range(3):
+        if other_lo[a] < lo[a]:
+            lo[a] = other_lo[a]
+        if other_hi[a] > hi[a]:
+            hi[a] = other_hi[a]
+
+
+def box_area(lo, hi):
+    '''Surface area of a box given as two corners (sequences or points)'''
+    dx = hi[0] - lo[0]
+    dy = hi[1] - lo[1]
+    dz = hi[2] - lo[2]
+    return 2.0 * (dx * dy + dy * dz + dz * dx)
+
+
+
+class LinearBvh(Hittable):
+    '''SAH bounding volume hierarchy flattened into contiguous arrays, traversed with a stack (nearest child first)'''
+
+    def __init__(self, objects, time0, time1, leaf_size=4, bins=12):
+        tree = SahBvh(objects, time0, time1, leaf_size, bins)
+
+        start = time.perf_counter()
+
+        # Per node: six bounds (min xyz, max xyz), and for interior nodes the index of the second child and the split axis,
+        # for leaves the offset and number of primitives (the first child of an interior node always follows it directly)
+        self.bounds = array('d')
+        self.offsets = array('i')
+        self.counts = array('i')
+        self.primitives = []
+        self.flatten(tree.root)
+
+        self.node_count = tree.node_count
+        self.leaf_count = tree.leaf_count
+        self.cost = tree.cost
+        self.build_time = tree.build_time + time.perf_counter() - start
+        self.box = tree.root.box
+
+    def __str__(self):
+        return f'Linear BVH over {len(self.primitives)} objects: {len(self.counts)} nodes ({self.leaf_count} leaves), built in {self.build_time:.3f} s, estimated cost {self.cost:.2f}'
+
+    def flatten(self, node):
+        index = len(self.counts)
+        box = node.box
+        self.bounds.extend((box._min.x, box._min.y, box._min.z, box._max.x, box._max.y, box._max.z))
+
+        if isinstance(node, BvhLeaf):
+            self.offsets.append(len(self.primitives))
+            self.counts.append(len(node.objects))
+            self.primitives.extend(node.objects)
+            return index
+
+        # Interior nodes store their split axis as a negative count
+        self.offsets.append(0)
+        self.counts.append(-1 - node.axis)
+        self.flatten(node.left)
+        self.offsets[index] = self.flatten(node.right)
+        return index
+
+    def bounding_box(self, t0, t1, output_box):
+        output_box.replace_values(self.box)
+        return True
+
+    def intersect(self, ray, t_min, t_max, rec):
+        return self.traverse(ray, t_min, t_max, rec, None)
+
+    def intersect_counted(self, ray, t_min, t_max, rec, stats_counts):
+        '''Same traversal as intersect, but also adding the visited nodes to stats_counts['bvh_nodes'] (used when render statistics are enabled)'''
+        return self.traverse(ray, t_min, t_max, rec, stats_counts)
+
+    def occluded(self, ray, t_min, t_max):
+        '''Same traversal as intersect, but returning at the first primitive hit'''
+        return self.traverse(ray, t_min, t_max, None, None)
+
+    def occluded_counted(self, ray, t_min, t_max, stats_counts):
+        '''Same traversal as occluded, but also adding the visited nodes to stats_counts['bvh_nodes'] (used when render statistics are enabled)'''
+        return self.traverse(ray, t_min, t_max, None, stats_counts)
+
+    def traverse(self, ray, t_min, t_max, rec, stats_counts):
+        '''Traversal shared by all queries: the closest hit into rec, or without rec whether anything is hit at all. The number
+        of visited nodes is added to stats_counts['bvh_nodes'] unless it is None'''
+        ox, oy, oz = ray.orig.x, ray.orig.y, ray.orig.z
+        dx, dy, dz = ray.dir.x, ray.dir.y, ray.dir.z
+        ix = 1.0 / dx if dx != 0 else float('inf')
+        iy = 1.0 / dy if dy != 0 else float('inf')
+        iz = 1.0 / dz if dz != 0 else float('inf')
+
+        # Offsets of the near and far slab planes in the bounds array, depending on the ray direction
+        nx, fx = (3, 0) if ix < 0 else (0, 3)
+        ny, fy = (4, 1) if iy < 0 else (1, 4)
+        nz, fz = (5, 2) if iz < 0 else (2, 5)
+        negative = (ix < 0, iy < 0, iz < 0)
+
+        bounds = self.bounds
+        offsets = self.offsets
+        counts = self.counts
+        primitives = self.primitives
+        any_hit = rec is None
+
+        hit_anything = False
+        stack = []
+        node = 0
+        pushed = 0
 
-    def box_compare(self, a, b, axis):
-        box_a = AABB()
-        box_b = AABB()
+        while True:
+            b = 6 * node
+            t0 = (bounds[b + nx] - ox) * ix
+            t1 = (bounds[b + fx] - ox) * ix
+            ty0 = (bounds[b + ny] - oy) * iy
+            ty1 = (bounds[b + fy] - oy) * iy
+            if ty0 > t0:
+                t0 = ty0
+            if ty1 < t1:
+                t1 = ty1
+            tz0 = (bounds[b + nz] - oz) * iz
+            tz1 = (bounds[b + fz] - oz) * iz
+            if tz0 > t0:
+                t0 = tz0
+            if tz1 < t1:
+                t1 = tz1
+            if t0 < t_min:
+                t0 = t_min
+            if t1 > t_max:
+                t1 = t_max
 
-        if (not a.bounding_box(0, 0, box_a)) or (not b.bounding_box(0, 0, box_b)):
-            print('No bounding box in BvhNode constructor')
-            
-        return (box_a._min[axis] < box_b._min[axis])
+            if t0 < t1:
+                count = counts[node]
+                if count >= 0:
+                    offset = offsets[node]
+                    if any_hit:
+                        for i in range(offset, offset + count):
+                            if primitives[i].occluded(ray, t_min, t_max):
+                                hit_anything = True
+                                break
+                        if hit_anything:
+                            break
+                    else:
+                        for i in range(offset, offset + count):
+                            if primitives[i].intersect(ray, t_min, t_max, rec):
+                                hit_anything = True
+                                t_max = rec.t
+                else:
+                    # Visit the child on the near side of the split axis first, keep the other for later
+                    pushed += 1
+                    if negative[-1 - count]:
+                        stack.append(node + 1)
+                        node = offsets[node]
+                    else:
+                        stack.append(offsets[node])
+                        node = node + 1
+                    continue
 
-    def box_x_compare(self, b):
-        return self.box_compare(self, b, 0)
-    
-    def box_y_compare(self, b):
-        return self.box_compare(self, b, 1)
+            if not stack:
+                break
+            node = stack.pop()
 
-    def box_z_compare(self, b):
-        return self.box_compare(self, b, 2) 
+        if stats_counts is not None:
+            # Every node pushed was visited, except those still left on the stack after an early exit
+            stats_counts['bvh_nodes'] += 1 + 2 * pushed - len(stack)
+        return hit_anything
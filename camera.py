@@ -3,10 +3,10 @@ from point3 import Point3
 from vec3 import Vec3
 from ray import Ray
 from utils import deg_to_rad
+from sampler import sample_1d
 
 # 3rd party libraries
 from math import tan
-from random import uniform
 
 
 class Camera:
@@ -40,7 +40,24 @@ class Camera:
         self.time1 = t1
 
     def get_ray(self, s, t):
-        rd = self.lens_radius * Vec3.random_in_unit_disk()
-        offset = self.u * rd.x + self.v * rd.y
-
-        return Ray(self.origin + offset, self.lower_left_corner + s * self.horizontal + t * self.vertical - self.origin - offset, uniform(self.time0, self.time1))
\ No newline at end of file
+        # Written out per component, so only the origin and direction vectors are created (the time is sampled before the lens, so it
+        # uses the same sample dimension with and without depth of field)
+        time = self.time0 + sample_1d() * (self.time1 - self.time0)
+        if self.lens_radius > 0:
+            rd = Vec3.random_in_unit_disk()
+            dx = self.lens_radius * rd.x
+            dy = self.lens_radius * rd.y
+        else:
+            dx = dy = 0.0
+        u = self.u
+        v = self.v
+        ox = self.origin.x + u.x * dx + v.x * dy
+        oy = self.origin.y + u.y * dx + v.y * dy
+        oz = self.origin.z + u.z * dx + v.z * dy
+
+        llc = self.lower_left_corner
+        h = self.horizontal
+        vert = self.vertical
+        direction = Vec3(llc.x + s * h.x + t * vert.x - ox, llc.y + s * h.y + t * vert.y - oy, llc.z + s * h.z + t * vert.z - oz)
+
+        return Ray(Vec3(ox, oy, oz), direction, time)
\ No newline at end of file
@@ -9,6 +9,8 @@ from math import isnan
 class Color(Vec3):
     '''Store color as a 3D vector (RGB)'''
 
+    __slots__ = ()
+
     def write_color(self, samples_per_pixel):
         r = self.x
         g = self.y
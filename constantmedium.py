@@ -3,9 +3,9 @@ from hittable import Hittable, HitRecord
 from material import Isotropic
 from vec3 import Vec3
 from aabb import AABB
+from sampler import sample_1d
 
 # 3rd party libraries
-from random import random
 from math import log
 
 
@@ -24,28 +24,44 @@ class ConstantMedium(Hittable):
             return True
         return False
 
-    def hit(self, ray, t_min, t_max, rec):
+    def intersect(self, ray, t_min, t_max, rec):
         rec1 = HitRecord()
         rec2 = HitRecord()
 
-        if not self.boundary.hit(ray, float('-inf'), float('inf'), rec1):
+        if not self.boundary.intersect(ray, float('-inf'), float('inf'), rec1):
             return False
         
-        if not self.boundary.hit(ray, rec1.t + 0.0001, float('inf'), rec2):
+        if not self.boundary.intersect(ray, rec1.t + 0.0001, float('inf'), rec2):
             return False
 
+        # Only the part of the medium between t_min and t_max (and in front of the ray) can scatter it
+        t1 = max(rec1.t, t_min)
+        t2 = min(rec2.t, t_max)
+        if t1 >= t2:
+            return False
+        t1 = max(t1, 0)
+
         ray_length = ray.dir.length()
-        distance_inside_boundary = (rec2.t - rec1.t) * ray_length
-        hit_distance = self.neg_inv_density * log(random())
+        distance_inside_boundary = (t2 - t1) * ray_length
+        hit_distance = self.neg_inv_density * log(1 - sample_1d())
 
         if hit_distance > distance_inside_boundary:
             return False
         
-        rec.t = rec1.t + hit_distance / ray_length
+        rec.t = t1 + hit_distance / ray_length
+        rec.obj = self
+        # The entry into the boundary, whose UV coordinates the hit takes over
+        rec.inner = rec1
+        return True
+
+    def surface(self, ray, rec):
+        boundary_rec = rec.inner
+        boundary_rec.obj.surface(ray, boundary_rec)
         rec.p = ray.at(rec.t)
         rec.normal = Vec3(1, 0, 0) # Arbitrary
         rec.front_face = True # Arbitrary
         rec.mat = self.phase_function
-        rec.u = rec1.u
-        rec.v = rec1.v
-        return True
+        rec.u = boundary_rec.u
+        rec.v = boundary_rec.v
+        rec.du = boundary_rec.du
+        rec.dv = boundary_rec.dv
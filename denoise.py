@@ -0,0 +1,159 @@
+# Custom libraries
+from framebuffer import CHECKPOINT_HEADER, CHECKPOINT_MAGIC, CHECKPOINT_VERSION, FEATURE_COUNT, LUMINANCE
+
+# 3rd party libraries
+import numpy as np
+import argparse
+import time
+
+
+# Weights of the B3 spline kernel of the a-trous wavelet transform (5 taps per axis)
+KERNEL = (1 / 16, 1 / 4, 3 / 8, 1 / 4, 1 / 16)
+
+# Albedo channels below this are not divided out of the color (nothing to demodulate)
+MIN_ALBEDO = 0.01
+
+
+def split_layers(values, width, height):
+    '''Per-pixel mean color, variance of the mean luminance, albedo, normal and depth from the doubles of a framebuffer or checkpoint (rows from the top)'''
+    pixels = width * height
+    colors = values[:3 * pixels].reshape(height, width, 3)
+    counts = values[3 * pixels:4 * pixels].reshape(height, width)
+    squares = values[4 * pixels:5 * pixels].reshape(height, width)
+    features = values[6 * pixels:(6 + FEATURE_COUNT) * pixels].reshape(height, width, FEATURE_COUNT)
+
+    scl = np.where(counts > 0, 1.0 / np.maximum(counts, 1), 0.0)
+    color = np.nan_to_num(colors * scl[:, :, None])
+    features = features * scl[:, :, None]
+
+    # Variance of the mean from the spread of the samples, or from the 3x3 neighbourhood where a pixel has too few samples
+    mean = color @ np.array(LUMINANCE)
+    variance = np.maximum(squares * scl - mean * mean, 0.0) / np.maximum(counts - 1, 1)
+    few = counts < 2
+    if few.any():
+        local_mean = box3(mean)
+        local_variance = np.maximum(box3(mean * mean) - local_mean * local_mean, 0.0)
+        variance[few] = local_variance[few]
+    return color, variance, features[:, :, 0:3], features[:, :, 3:6], features[:, :, 6]
+
+
+def box3(image):
+    '''Average of the 3x3 neighbourhood of every pixel (repeating the edge pixels)'''
+    padded = np.pad(image, 1, mode='edge')
+    height, width = image.shape
+    return sum(padded[1 + dy:1 + dy + height, 1 + dx:1 + dx + width] for dy in (-1, 0, 1) for dx in (-1, 0, 1)) / 9
+
+
+def denoise(color, variance, albedo, normal, depth, iterations=5, sigma_luminance=4.0, sigma_normal=128.0, sigma_depth=1.0):
+    '''Edge-avoiding a-trous wavelet filter (Dammertz et al. 2010, with the variance guided luminance weights of SVGF)
+
+    The albedo is divided out of the color first, so textures stay sharp while the lighting is blurred. Every iteration averages 5x5
+    pixels spaced twice as far apart as in the previous one, weighted by how similar their first-hit normals and depths are and by
+    how much their luminance differs relative to its estimated noise.
+    '''
+    height, width = depth.shape
+    demodulate = np.where(albedo > MIN_ALBEDO, albedo, 1.0)
+    irradiance = color / demodulate
+    variance = variance / (demodulate @ np.array(LUMINANCE)) ** 2
+
+    length = np.sqrt((normal * normal).sum(axis=2, keepdims=True))
+    normal = np.where(length > 0, normal / np.maximum(length, 1e-12), 0.0)
+    # Depth change per pixel, so slanted surfaces are not cut apart by their own depth differences
+    gradient = np.maximum(np.abs(np.gradient(depth, axis=0)), np.abs(np.gradient(depth, axis=1)))
+
+    # The guides are padded once for the widest step, pixels outside the image get no weight
+    pad = 2 ** iterations
+    padded_normal = np.pad(normal, ((pad, pad), (pad, pad), (0, 0)))
+    padded_depth = np.pad(depth, pad)
+    valid = np.pad(np.ones((height, width)), pad)
+
+    def shifted(padded, dx, dy):
+        return padded[pad + dy:pad + dy + height, pad + dx:pad + dx + width]
+
+    for iteration in range(iterations):
+        step = 2 ** iteration
+        luminance = irradiance @ np.array(LUMINANCE)
+        limit = sigma_luminance * np.sqrt(box3(variance)) + 1e-6
+        padded_irradiance = np.pad(irradiance, ((pad, pad), (pad, pad), (0, 0)))
+        padded_variance = np.pad(variance, pad)
+
+        weights = np.zeros((height, width))
+        total = np.zeros((height, width, 3))
+        total_variance = np.zeros((height, width))
+        for ky, hy in enumerate(KERNEL):
+            for kx, hx in enumerate(KERNEL):
+                dx = (kx - 2) * step
+                dy = (ky - 2) * step
+                if dx == 0 and dy == 0:
+                    w = np.full((height, width), hx * hy)
+                    c = irradiance
+                    v = variance
+                else:
+                    c = shifted(padded_irradiance, dx, dy)
+                    v = shifted(padded_variance, dx, dy)
+                    w_normal = np.maximum((normal * shifted(padded_normal, dx, dy)).sum(axis=2), 0.0) ** sigma_normal
+                    w_depth = np.exp(-np.abs(depth - shifted(padded_depth, dx, dy)) / (sigma_depth * gradient * np.hypot(dx, dy) + 0.01 * depth + 1e-6))
+                    w_luminance = np.exp(-np.abs(luminance - c @ np.array(LUMINANCE)) / limit)
+                    w = hx * hy * shifted(valid, dx, dy) * w_normal * w_depth * w_luminance
+                weights += w
+                total += w[:, :, None] * c
+                total_variance += w * w * v
+        irradiance = total / weights[:, :, None]
+        variance = total_variance / (weights * weights)
+
+    return irradiance * demodulate
+
+
+def denoise_framebuffer(framebuffer, filename, **settings):
+    '''Denoise the samples in a framebuffer (rendered with features) and write the result as a PPM file'''
+    with framebuffer.lock:
+        values = np.frombuffer(framebuffer.shm.buf[:framebuffer.size], dtype=np.float64).copy()
+    write_ppm(filename, denoise(*split_layers(values, framebuffer.width, framebuffer.height), **settings))
+
+
+def read_checkpoint(filename):
+    '''Width, height and doubles of a render checkpoint file'''
+    with open(filename, 'rb') as checkpoint_fileobj:
+        magic, version, width, height = CHECKPOINT_HEADER.unpack(checkpoint_fileobj.read(CHECKPOINT_HEADER.size))
+        if magic != CHECKPOINT_MAGIC or version != CHECKPOINT_VERSION:
+            raise ValueError(f'{filename} is not a render checkpoint (version {CHECKPOINT_VERSION})')
+        values = np.fromfile(checkpoint_fileobj, dtype='<f8', count=width * height * (6 + FEATURE_COUNT))
+    return width, height, values
+
+
+def write_ppm(filename, image):
+    '''Tone-map (same gamma as FrameBuffer.write_ppm) and write an image array (rows from the top) as a plain PPM file'''
+    image = np.nan_to_num(image)
+    values = np.where(image > 0, (256 * np.minimum(np.maximum(image, 0.0) ** (1 / 1.5), 0.999)).astype(np.int64), 0)
+    height, width, _ = image.shape
+    with open(filename, 'w') as img_fileobj:
+        img_fileobj.write(f'P3 {width} {height}\n255\n')
+        for row in values.reshape(height, width * 3):
+            img_fileobj.write(' '.join(map(str, row.tolist())))
+            img_fileobj.write(' \n')
+
+
+def main():
+    '''Denoise the samples saved in a render checkpoint'''
+    parser = argparse.ArgumentParser(description='Denoise a render checkpoint (rendered with --features or --denoise) into a PPM image')
+    parser.add_argument('checkpoint', help='Checkpoint file to denoise')
+    parser.add_argument('output', help='PPM file to write')
+    parser.add_argument('-i', '--iterations', action='store', type=int, dest='iterations', default=5, help='Filter passes (each doubles the filter radius)')
+    parser.add_argument('--sigma-luminance', action='store', type=float, dest='sigma_luminance', default=4.0, help='Luminance difference allowed, in standard errors of the pixel mean')
+    parser.add_argument('--sigma-normal', action='store', type=float, dest='sigma_normal', default=128.0, help='Exponent of the normal similarity (higher keeps edges sharper)')
+    parser.add_argument('--sigma-depth', action='store', type=float, dest='sigma_depth', default=1.0, help='Depth difference allowed, relative to the local depth gradient')
+    args = parser.parse_args()
+
+    width, height, values = read_checkpoint(args.checkpoint)
+    layers = split_layers(values, width, height)
+    if not layers[3].any():
+        parser.error(f'{args.checkpoint} has no feature buffers (render it with --features or --denoise)')
+
+    start = time.perf_counter()
+    image = denoise(*layers, args.iterations, args.sigma_luminance, args.sigma_normal, args.sigma_depth)
+    write_ppm(args.output, image)
+    print(f'Denoised {width}x{height} pixels in {time.perf_counter() - start:.2f} s')
+
+
+if __name__ == '__main__':
+    main()
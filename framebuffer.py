@@ -0,0 +1,238 @@
+# 3rd party libraries
+from multiprocessing import Lock
+from multiprocessing.shared_memory import SharedMemory
+import os
+import struct
+
+
+# Checkpoint file header: magic, format version, width, height
+CHECKPOINT_HEADER = struct.Struct('<4sIII')
+CHECKPOINT_MAGIC = b'PRTC'
+CHECKPOINT_VERSION = 4
+
+# Weights of the linear RGB channels in the luminance used for sample variance estimates
+LUMINANCE = (0.2126, 0.7152, 0.0722)
+
+# First-hit features summed per pixel: albedo (3), normal (3) and depth (1)
+FEATURE_COUNT = 7
+
+# Colors of the heatmap from no cost to the highest cost
+HEATMAP_COLORS = ((0, 0, 0), (0, 0, 1), (1, 0, 0), (1, 1, 0), (1, 1, 1))
+
+
+def luminance(r, g, b):
+    '''Luminance of a linear RGB color'''
+    return LUMINANCE[0] * r + LUMINANCE[1] * g + LUMINANCE[2] * b
+
+
+def heat_color(x):
+    '''False color for a value from 0 to 1, from black through blue, red and yellow to white'''
+    x = min(max(x, 0.0), 1.0) * (len(HEATMAP_COLORS) - 1)
+    i = min(int(x), len(HEATMAP_COLORS) - 2)
+    f = x - i
+    return tuple(a + (b - a) * f for a, b in zip(HEATMAP_COLORS[i], HEATMAP_COLORS[i + 1]))
+
+
+class FrameBuffer:
+    '''Linear float RGB sums, per-pixel sample counts, sums of squared sample luminance, render costs and first-hit feature sums in shared memory, which render processes accumulate samples into'''
+
+    def __init__(self, width, height, name=None, lock=None):
+        self.width  = width
+        self.height = height
+        self.lock   = Lock() if lock is None else lock
+
+        # Three color sums per pixel, then one sample count per pixel, one sum of squared luminance per pixel, one render cost
+        # per pixel (seconds or rays, depending on the engine) and seven feature sums per pixel, all doubles
+        self.color_bytes = width * height * 3 * 8
+        self.size = width * height * (6 + FEATURE_COUNT) * 8
+        count_end = self.color_bytes + width * height * 8
+        square_end = count_end + width * height * 8
+        cost_end = square_end + width * height * 8
+        if name is None:
+            # New shared memory is zero-filled
+            self.shm = SharedMemory(create=True, size=self.size)
+        else:
+            self.shm = SharedMemory(name=name)
+        self.data = self.shm.buf[:self.color_bytes].cast('d')
+        self.counts = self.shm.buf[self.color_bytes:count_end].cast('d')
+        self.squares = self.shm.buf[count_end:square_end].cast('d')
+        self.costs = self.shm.buf[square_end:cost_end].cast('d')
+        self.features = self.shm.buf[cost_end:self.size].cast('d')
+
+    def __reduce__(self):
+        # Other processes attach to the same memory instead of copying it
+        return (FrameBuffer, (self.width, self.height, self.shm.name, self.lock))
+
+    def add_tile(self, x0, y0, x1, y1, colors, squares, samples, costs=None, features=None):
+        '''Add the summed colors, squared luminances and optionally render costs and features of a tile (row-major, y0 is the top row) rendered with some samples per pixel'''
+        data = self.data
+        counts = self.counts
+        sums = self.squares
+        colors = iter(colors)
+        squares = iter(squares)
+        with self.lock:
+            for row in range(y0, y1):
+                p = row * self.width + x0
+                k = 3 * p
+                for _ in range(x0, x1):
+                    r, g, b = next(colors)
+                    data[k] += r
+                    data[k + 1] += g
+                    data[k + 2] += b
+                    counts[p] += samples
+                    sums[p] += next(squares)
+                    k += 3
+                    p += 1
+            if costs is not None:
+                costs = iter(costs)
+                for row in range(y0, y1):
+                    for p in range(row * self.width + x0, row * self.width + x1):
+                        self.costs[p] += next(costs)
+            if features is not None:
+                features = iter(features)
+                for row in range(y0, y1):
+                    for p in range(row * self.width + x0, row * self.width + x1):
+                        for k, value in enumerate(next(features), FEATURE_COUNT * p):
+                            self.features[k] += value
+
+    def pixel(self, row, col):
+        '''Summed color and sample count of one pixel (row 0 is the top row)'''
+        p = row * self.width + col
+        return self.data[3 * p], self.data[3 * p + 1], self.data[3 * p + 2], self.counts[p]
+
+    def tile_samples(self, x0, y0, x1, y1):
+        '''Lowest sample count of the pixels in a tile'''
+        return min(min(self.counts[row * self.width + x0:row * self.width + x1]) for row in range(y0, y1))
+
+    def uniform_tiles(self, x0, y0, x1, y1):
+        '''Split a tile into tiles whose pixels all have the same sample count (halving the longer side of mixed ones), so a task
+        can number the samples of every pixel from the same first sample'''
+        counts = self.counts
+        first = counts[y0 * self.width + x0]
+        rows = (counts[row * self.width + x0:row * self.width + x1] for row in range(y0, y1))
+        if all(min(row_counts) == first == max(row_counts) for row_counts in rows):
+            return [(x0, y0, x1, y1)]
+        if x1 - x0 >= y1 - y0:
+            middle = (x0 + x1) // 2
+            return self.uniform_tiles(x0, y0, middle, y1) + self.uniform_tiles(middle, y0, x1, y1)
+        middle = (y0 + y1) // 2
+        return self.uniform_tiles(x0, y0, x1, middle) + self.uniform_tiles(x0, middle, x1, y1)
+
+    def pixel_error(self, p):
+        '''Standard error of the mean luminance of pixel p, relative to that luminance (with a floor for dark pixels)'''
+        n = self.counts[p]
+        if n < 2:
+            return float('inf')
+        mean = luminance(self.data[3 * p], self.data[3 * p + 1], self.data[3 * p + 2]) / n
+        variance = max(self.squares[p] / n - mean * mean, 0.0) * n / (n - 1)
+        return (variance / n) ** 0.5 / (mean + 0.01)
+
+    def tile_error(self, x0, y0, x1, y1):
+        '''Average relative error of the pixels in a tile'''
+        errors = [self.pixel_error(row * self.width + col) for row in range(y0, y1) for col in range(x0, x1)]
+        return sum(errors) / len(errors)
+
+    def write_ppm(self, filename):
+        '''Average, tone-map (same gamma as Color.write_color) and write the image as a plain PPM file in one pass'''
+        inv_gamma = 1 / 1.5
+        data = self.data
+        counts = self.counts
+
+        with open(filename, 'w') as img_fileobj:
+            img_fileobj.write(f'P3 {self.width} {self.height}\n255\n')
+            for row in range(self.height):
+                values = []
+                for p in range(row * self.width, (row + 1) * self.width):
+                    scl = 1.0 / counts[p] if counts[p] > 0 else 0.0
+                    for k in range(3 * p, 3 * p + 3):
+                        c = data[k] * scl
+                        # NaN and negative values are written as 0
+                        if c > 0:
+                            values.append(int(256 * min(c ** inv_gamma, 0.999)))
+                        else:
+                            values.append(0)
+                img_fileobj.write(' '.join(map(str, values)))
+                img_fileobj.write(' \n')
+
+    def write_heatmap(self, filename):
+        '''Write the render cost of every pixel as a false color PPM file, scaled so the 99th percentile cost is white'''
+        costs = sorted(self.costs)
+        scale = costs[min(int(0.99 * len(costs)), len(costs) - 1)] or costs[-1] or 1.0
+
+        with open(filename, 'w') as img_fileobj:
+            img_fileobj.write(f'P3 {self.width} {self.height}\n255\n')
+            for row in range(self.height):
+                values = []
+                for p in range(row * self.width, (row + 1) * self.width):
+                    values.extend(int(255 * c) for c in heat_color(self.costs[p] / scale))
+                img_fileobj.write(' '.join(map(str, values)))
+                img_fileobj.write(' \n')
+
+    def write_features(self, albedo_filename, normal_filename, depth_filename):
+        '''Write the average first-hit albedo, normal (mapped from -1..1 to 0..1) and depth (scaled so the farthest pixel is white) as PPM files'''
+        features = self.features
+        counts = self.counts
+        depths = [features[FEATURE_COUNT * p + 6] / counts[p] for p in range(self.width * self.height) if counts[p] > 0]
+        scale = 1.0 / (max(depths) or 1.0) if depths else 0.0
+
+        layers = ((albedo_filename, lambda k, scl: [features[k] * scl, features[k + 1] * scl, features[k + 2] * scl]),
+                  (normal_filename, lambda k, scl: [0.5 + 0.5 * features[k + 3] * scl, 0.5 + 0.5 * features[k + 4] * scl, 0.5 + 0.5 * features[k + 5] * scl]),
+                  (depth_filename, lambda k, scl: [features[k + 6] * scl * scale] * 3))
+        for filename, pixel_values in layers:
+            with open(filename, 'w') as img_fileobj:
+                img_fileobj.write(f'P3 {self.width} {self.height}\n255\n')
+                for row in range(self.height):
+                    values = []
+                    for p in range(row * self.width, (row + 1) * self.width):
+                        scl = 1.0 / counts[p] if counts[p] > 0 else 0.0
+                        values.extend(int(255 * min(max(c, 0.0), 1.0)) for c in pixel_values(FEATURE_COUNT * p, scl))
+                    img_fileobj.write(' '.join(map(str, values)))
+                    img_fileobj.write(' \n')
+
+    def save_checkpoint(self, filename):
+        '''Write the color sums, sample counts, squared luminance sums, costs and features to a binary checkpoint file (replaced atomically)'''
+        temp_filename = f'{filename}.tmp'
+        with open(temp_filename, 'wb') as checkpoint_fileobj:
+            checkpoint_fileobj.write(CHECKPOINT_HEADER.pack(CHECKPOINT_MAGIC, CHECKPOINT_VERSION, self.width, self.height))
+            with self.lock:
+                checkpoint_fileobj.write(self.shm.buf[:self.size])
+        os.replace(temp_filename, filename)
+
+    def load_checkpoint(self, filename):
+        '''Replace the framebuffer contents with those from a checkpoint file of the same size'''
+        with open(filename, 'rb') as checkpoint_fileobj:
+            header = checkpoint_fileobj.read(CHECKPOINT_HEADER.size)
+            if len(header) < CHECKPOINT_HEADER.size:
+                raise ValueError(f'{filename} is not a render checkpoint (version {CHECKPOINT_VERSION})')
+            magic, version, width, height = CHECKPOINT_HEADER.unpack(header)
+            if magic != CHECKPOINT_MAGIC or version != CHECKPOINT_VERSION:
+                raise ValueError(f'{filename} is not a render checkpoint (version {CHECKPOINT_VERSION})')
+            if (width, height) != (self.width, self.height):
+                raise ValueError(f'Checkpoint {filename} is {width}x{height}, but the image is {self.width}x{self.height}')
+
+            # Read everything before touching the framebuffer, so a truncated (half-written) checkpoint leaves it unchanged
+            contents = bytearray(self.size)
+            view = memoryview(contents)
+            read = 0
+            while read < self.size:
+                n = checkpoint_fileobj.readinto(view[read:])
+                if not n:
+                    break
+                read += n
+            if read < self.size:
+                raise ValueError(f'Checkpoint {filename} is truncated ({read} of {self.size} bytes of image data)')
+            with self.lock:
+                self.shm.buf[:self.size] = contents
+
+    def close(self):
+        '''Detach this process from the shared memory'''
+        self.data.release()
+        self.counts.release()
+        self.squares.release()
+        self.costs.release()
+        self.features.release()
+        self.shm.close()
+
+    def unlink(self):
+        '''Free the shared memory (called once, by the process that created it)'''
+        self.shm.unlink()
@@ -10,26 +10,43 @@ from math import sin, cos
 
 
 class HitRecord:
-    '''Stores information when a ray hits a hittable object'''
+    '''Stores information when a ray hits a hittable object
+
+    Intersection only sets t, the object that computes the rest of the surface data (obj) and data it needs for that (inner);
+    the point, normal, face, UV coordinates and material are filled in by obj.surface once the closest hit is known.
+
+    du and dv are how fast the UV coordinates change per unit of length on the surface, and footprint is the width of the area the
+    ray stands for at the hit (set by the renderer, 0 for a single point), so textures can be filtered over that area.
+    '''
+
+    __slots__ = ('t', 'obj', 'inner', 'p', 'mat', 'normal', 'front_face', 'u', 'v', 'du', 'dv', 'footprint')
 
     def __init__(self):
-        pass
+        self.du = 0.0
+        self.dv = 0.0
+        self.footprint = 0.0
 
     def set_face_normal(self, ray, outward_normal):
-        self.front_face = (ray.dir.dot(outward_normal) < 0)
+        d = ray.dir
+        self.front_face = (d.x * outward_normal.x + d.y * outward_normal.y + d.z * outward_normal.z < 0)
         if self.front_face:
             self.normal = outward_normal
         else:
-            self.normal = - outward_normal
+            self.normal = Vec3(-outward_normal.x, -outward_normal.y, -outward_normal.z)
 
     def replace_values(self, other):
         self.t = other.t
+        self.obj = other.obj
+        self.inner = other.inner
         self.p = other.p
         self.mat = other.mat
         self.normal = other.normal
         self.front_face = other.front_face
         self.u = other.u
         self.v = other.v
+        self.du = other.du
+        self.dv = other.dv
+        self.footprint = other.footprint
 
     def clear(self):
         self.t = float('inf')
@@ -42,8 +59,35 @@ class Hittable:
         pass
 
     def hit(self, ray, t_min, t_max, rec):
+        '''Closest hit between t_min and t_max, with all surface data filled in'''
+        if not self.intersect(ray, t_min, t_max, rec):
+            return False
+        rec.obj.surface(ray, rec)
+        return True
+
+    def intersect(self, ray, t_min, t_max, rec):
+        '''Closest hit between t_min and t_max, only setting rec.t, rec.obj and rec.inner (rec is left alone if nothing is hit)
+
+        Objects written for the older interface, which only override hit, are hit through it: their hit fills in the whole record
+        right away, and their surface (the no-op of Hittable unless they override it) leaves it as it is.
+        '''
+        if type(self).hit is Hittable.hit:
+            return False
+        if not self.hit(ray, t_min, t_max, rec):
+            return False
+        rec.obj = self
+        rec.inner = None
+        return True
+
+    def surface(self, ray, rec):
+        '''Fill in the point, normal, face, UV coordinates (with their rates du and dv) and material of the hit at rec.t found by
+        intersect'''
         pass
 
+    def occluded(self, ray, t_min, t_max):
+        '''Whether anything is hit between t_min and t_max (stopping at the first hit found, which need not be the closest)'''
+        return self.intersect(ray, t_min, t_max, HitRecord())
+
     def bounding_box(self, t0, t1, output_box):
         pass
 
@@ -67,16 +111,32 @@ class Translate(Hittable):
         output_box.replace_values(AABB(output_box._min + self.offset, output_box._max + self.offset))
         return True
 
-    def hit(self, ray, t_min, t_max, rec):
-        moved_r = Ray(ray.orig - self.offset, ray.dir, ray.time)
+    def intersect(self, ray, t_min, t_max, rec):
+        offset = self.offset
+        moved_r = Ray(Vec3(ray.orig.x - offset.x, ray.orig.y - offset.y, ray.orig.z - offset.z), ray.dir, ray.time)
 
-        if not self.obj.hit(moved_r, t_min, t_max, rec):
+        if not self.obj.intersect(moved_r, t_min, t_max, rec):
             return False
-        
-        rec.p += self.offset
-        rec.set_face_normal(moved_r, rec.normal)
+
+        # Remember the hit object inside, whose surface is computed in the moved frame
+        rec.inner = (rec.obj, rec.inner)
+        rec.obj = self
         return True
 
+    def occluded(self, ray, t_min, t_max):
+        offset = self.offset
+        return self.obj.occluded(Ray(Vec3(ray.orig.x - offset.x, ray.orig.y - offset.y, ray.orig.z - offset.z), ray.dir, ray.time), t_min, t_max)
+
+    def surface(self, ray, rec):
+        obj, rec.inner = rec.inner
+        offset = self.offset
+        moved_r = Ray(Vec3(ray.orig.x - offset.x, ray.orig.y - offset.y, ray.orig.z - offset.z), ray.dir, ray.time)
+        obj.surface(moved_r, rec)
+
+        # The hit point is always a new vector made by the hit object, so it can be moved in place
+        rec.p += offset
+        rec.set_face_normal(moved_r, rec.normal)
+
 
 class RotateY(Hittable):
     '''Rotate a hittable object with an angle indicating the rotation about the Y-axis'''
@@ -116,34 +176,40 @@ class RotateY(Hittable):
         output_box.replace_values(self.bbox)
         return self.hasbox
 
-    def hit(self, ray, t_min, t_max, rec):
-        origin = ray.orig.copy()
-        direction = ray.dir.copy()
-
-        origin[0] = self.cos_theta * ray.orig[0] - self.sin_theta * ray.orig[2]
-        origin[2] = self.sin_theta * ray.orig[0] + self.cos_theta * ray.orig[2]
+    def rotate_ray(self, ray):
+        '''Ray in the rotated frame of the object'''
+        cos_theta = self.cos_theta
+        sin_theta = self.sin_theta
+        o = ray.orig
+        d = ray.dir
 
-        direction[0] = self.cos_theta * ray.dir[0] - self.sin_theta * ray.dir[2]
-        direction[2] = self.sin_theta * ray.dir[0] + self.cos_theta * ray.dir[2]
+        origin = Vec3(cos_theta * o.x - sin_theta * o.z, o.y, sin_theta * o.x + cos_theta * o.z)
+        direction = Vec3(cos_theta * d.x - sin_theta * d.z, d.y, sin_theta * d.x + cos_theta * d.z)
+        return Ray(origin, direction, ray.time)
 
-        rotated_r = Ray(origin, direction, ray.time)
-
-        if not self.obj.hit(rotated_r, t_min, t_max, rec):
+    def intersect(self, ray, t_min, t_max, rec):
+        if not self.obj.intersect(self.rotate_ray(ray), t_min, t_max, rec):
             return False
-        
-        p = rec.p.copy()
-        normal = rec.normal.copy()
 
-        p[0] =  self.cos_theta * rec.p[0] + self.sin_theta * rec.p[2]
-        p[2] = -self.sin_theta * rec.p[0] + self.cos_theta * rec.p[2]
+        # Remember the hit object inside, whose surface is computed in the rotated frame
+        rec.inner = (rec.obj, rec.inner)
+        rec.obj = self
+        return True
 
-        normal[0] =  self.cos_theta * rec.normal[0] + self.sin_theta * rec.normal[2]
-        normal[2] = -self.sin_theta * rec.normal[0] + self.cos_theta * rec.normal[2]
+    def occluded(self, ray, t_min, t_max):
+        return self.obj.occluded(self.rotate_ray(ray), t_min, t_max)
 
-        rec.p = p
-        rec.set_face_normal(rotated_r, normal)
+    def surface(self, ray, rec):
+        obj, rec.inner = rec.inner
+        rotated_r = self.rotate_ray(ray)
+        obj.surface(rotated_r, rec)
 
-        return True
+        cos_theta = self.cos_theta
+        sin_theta = self.sin_theta
+        p = rec.p
+        n = rec.normal
+        rec.p = Vec3(cos_theta * p.x + sin_theta * p.z, p.y, -sin_theta * p.x + cos_theta * p.z)
+        rec.set_face_normal(rotated_r, Vec3(cos_theta * n.x + sin_theta * n.z, n.y, -sin_theta * n.x + cos_theta * n.z))
 
 
 class FlipFace(Hittable):
@@ -155,8 +221,17 @@ class FlipFace(Hittable):
     def bounding_box(self, t0, t1, output_box):
         return self.p.bounding_box(t0, t1, output_box)
 
-    def hit(self, ray, t_min, t_max, rec):
-        if not self.p.hit(ray, t_min, t_max, rec):
+    def intersect(self, ray, t_min, t_max, rec):
+        if not self.p.intersect(ray, t_min, t_max, rec):
             return False
-        rec.front_face = not rec.front_face
-        return True
\ No newline at end of file
+        rec.inner = (rec.obj, rec.inner)
+        rec.obj = self
+        return True
+
+    def occluded(self, ray, t_min, t_max):
+        return self.p.occluded(ray, t_min, t_max)
+
+    def surface(self, ray, rec):
+        obj, rec.inner = rec.inner
+        obj.surface(ray, rec)
+        rec.front_face = not rec.front_face
\ No newline at end of file
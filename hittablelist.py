@@ -1,17 +1,17 @@
 # Custom libraries
-from hittable import Hittable, HitRecord
+from hittable import Hittable
 from material import Lambertian, Metal
 from aabb import AABB
-
-# 3rd party library
-from random import uniform
+from sampler import sample_1d
 
 
 class HittableList(Hittable):
     '''Store a list of hittable objects'''
 
-    def __init__(self, objects=[]):
-        if not isinstance(objects, list):
+    def __init__(self, objects=None):
+        if objects is None:
+            self.objects = []
+        elif not isinstance(objects, list):
             self.objects = [objects]
         else:
             self.objects = objects
@@ -45,19 +45,23 @@ class HittableList(Hittable):
         
         return True
 
-    def hit(self, r_in, t_min, t_max, rec):
-        temp = HitRecord()
-        dist_min = t_max
+    def intersect(self, r_in, t_min, t_max, rec):
+        # Every hit narrows the search to closer hits, so the record ends up with the closest one
         hit_anything = False
 
         for obj in self.objects:
-            if obj.hit(r_in, t_min, dist_min, temp):
+            if obj.intersect(r_in, t_min, t_max, rec):
                 hit_anything = True
-                dist_min = temp.t
-                rec.replace_values(temp)
+                t_max = rec.t
         
         return hit_anything
 
+    def occluded(self, r_in, t_min, t_max):
+        for obj in self.objects:
+            if obj.occluded(r_in, t_min, t_max):
+                return True
+        return False
+
     def pdf_value(self, o, v):
         weight = 1.0 / len(self.objects)
         s = 0.0
@@ -69,4 +73,4 @@ class HittableList(Hittable):
 
     def random(self, o):
         int_size = int(len(self.objects))
-        return self.objects[int(uniform(0, int_size))].random(o)
\ No newline at end of file
+        return self.objects[min(int(sample_1d() * int_size), int_size - 1)].random(o)
\ No newline at end of file
@@ -0,0 +1,168 @@
+# Custom libraries
+from hittable import Hittable
+from aabb import AABB
+from point3 import Point3
+from vec3 import Vec3
+from ray import Ray
+from utils import deg_to_rad
+
+# 3rd party library
+from math import sin, cos, sqrt
+
+
+class Transform:
+    '''Affine transform stored as the top three rows of a 4x4 matrix (row-major, 12 values), with its inverse precomputed'''
+
+    __slots__ = ('m', 'inv')
+
+    def __init__(self, rows=None):
+        if rows is None:
+            rows = ((1, 0, 0, 0), (0, 1, 0, 0), (0, 0, 1, 0))
+        if len(rows) == 4 and tuple(rows[3]) != (0, 0, 0, 1):
+            raise ValueError('Only affine transforms are supported (last row must be 0 0 0 1)')
+        self.m = tuple(float(value) for row in rows[:3] for value in row)
+
+        a, b, c, tx, d, e, f, ty, g, h, i, tz = self.m
+        # Inverse of the 3x3 part from its cofactors, and the inverse translation
+        det = a * (e * i - f * h) - b * (d * i - f * g) + c * (d * h - e * g)
+        if det == 0:
+            raise ValueError('Transform is not invertible')
+        s = 1 / det
+        ia, ib, ic = (e * i - f * h) * s, (c * h - b * i) * s, (b * f - c * e) * s
+        id_, ie, if_ = (f * g - d * i) * s, (a * i - c * g) * s, (c * d - a * f) * s
+        ig, ih, ii = (d * h - e * g) * s, (b * g - a * h) * s, (a * e - b * d) * s
+        self.inv = (ia, ib, ic, -(ia * tx + ib * ty + ic * tz),
+                    id_, ie, if_, -(id_ * tx + ie * ty + if_ * tz),
+                    ig, ih, ii, -(ig * tx + ih * ty + ii * tz))
+
+    @classmethod
+    def translate(cls, offset):
+        return cls(((1, 0, 0, offset.x), (0, 1, 0, offset.y), (0, 0, 1, offset.z)))
+
+    @classmethod
+    def scale(cls, sx, sy=None, sz=None):
+        '''Scale along the axes (uniformly if only sx is given)'''
+        sy = sx if sy is None else sy
+        sz = sx if sz is None else sz
+        return cls(((sx, 0, 0, 0), (0, sy, 0, 0), (0, 0, sz, 0)))
+
+    @classmethod
+    def rotate(cls, axis, angle):
+        '''Rotate by an angle in degrees around an axis through the origin (same direction as RotateY for the Y axis)'''
+        axis = axis.unit_vector()
+        x, y, z = axis.x, axis.y, axis.z
+        radians = deg_to_rad(angle)
+        c = cos(radians)
+        s = sin(radians)
+        k = 1 - c
+        return cls(((c + x * x * k,     x * y * k - z * s, x * z * k + y * s, 0),
+                    (y * x * k + z * s, c + y * y * k,     y * z * k - x * s, 0),
+                    (z * x * k - y * s, z * y * k + x * s, c + z * z * k,     0)))
+
+    def __matmul__(self, other):
+        '''Transform applying other first and then self'''
+        m = self.m
+        n = other.m
+        rows = []
+        for r in range(3):
+            a, b, c, t = m[4 * r:4 * r + 4]
+            rows.append((a * n[0] + b * n[4] + c * n[8],
+                         a * n[1] + b * n[5] + c * n[9],
+                         a * n[2] + b * n[6] + c * n[10],
+                         a * n[3] + b * n[7] + c * n[11] + t))
+        return Transform(rows)
+
+    def length_scale(self):
+        '''Factor by which the transform scales lengths on average (the cube root of how much it scales volumes)'''
+        a, b, c, _, d, e, f, _, g, h, i, _ = self.m
+        return abs(a * (e * i - f * h) - b * (d * i - f * g) + c * (d * h - e * g)) ** (1 / 3)
+
+    def rows(self):
+        '''The full 4x4 matrix as a tuple of rows'''
+        m = self.m
+        return (m[0:4], m[4:8], m[8:12], (0.0, 0.0, 0.0, 1.0))
+
+    def point(self, p):
+        a, b, c, tx, d, e, f, ty, g, h, i, tz = self.m
+        return Vec3(a * p.x + b * p.y + c * p.z + tx, d * p.x + e * p.y + f * p.z + ty, g * p.x + h * p.y + i * p.z + tz)
+
+    def vector(self, v):
+        a, b, c, _, d, e, f, _, g, h, i, _ = self.m
+        return Vec3(a * v.x + b * v.y + c * v.z, d * v.x + e * v.y + f * v.z, g * v.x + h * v.y + i * v.z)
+
+    def normal(self, n):
+        '''Transform a normal (by the inverse transpose, so it stays perpendicular to transformed surfaces), not normalized'''
+        a, b, c, _, d, e, f, _, g, h, i, _ = self.inv
+        return Vec3(a * n.x + d * n.y + g * n.z, b * n.x + e * n.y + h * n.z, c * n.x + f * n.y + i * n.z)
+
+    def box(self, box):
+        '''Axis-aligned box around a transformed box'''
+        lo = []
+        hi = []
+        m = self.m
+        for r in range(3):
+            row = m[4 * r:4 * r + 4]
+            # Every input axis adds its smallest and largest contribution to the output axis
+            low = [row[k] * box._min[k] for k in range(3)]
+            high = [row[k] * box._max[k] for k in range(3)]
+            lo.append(row[3] + sum(min(a, b) for a, b in zip(low, high)))
+            hi.append(row[3] + sum(max(a, b) for a, b in zip(low, high)))
+        return AABB(Point3(*lo), Point3(*hi))
+
+
+class Instance(Hittable):
+    '''Object placed in the scene by an affine transform, sharing its geometry (typically a BVH) with every other instance of it
+
+    A BVH over instances (for example a LinearBvh) is the top level of a two-level hierarchy: its leaves transform the ray into
+    object space once and traverse the shared bottom-level BVH there. Rays are not normalized by the transform, so hit distances
+    are the same in both spaces. Nested instances are merged into one transform.
+    '''
+
+    def __init__(self, obj, transform):
+        if isinstance(obj, Instance):
+            transform = transform @ obj.transform
+            obj = obj.obj
+        self.obj = obj
+        self.transform = transform
+        self.length_scale = transform.length_scale()
+
+    def bounding_box(self, t0, t1, output_box):
+        box = AABB()
+        if not self.obj.bounding_box(t0, t1, box):
+            return False
+        output_box.replace_values(self.transform.box(box))
+        return True
+
+    def local_ray(self, ray):
+        '''Ray in the object space of the instance'''
+        a, b, c, tx, d, e, f, ty, g, h, i, tz = self.transform.inv
+        o = ray.orig
+        v = ray.dir
+        return Ray(Vec3(a * o.x + b * o.y + c * o.z + tx, d * o.x + e * o.y + f * o.z + ty, g * o.x + h * o.y + i * o.z + tz),
+                   Vec3(a * v.x + b * v.y + c * v.z, d * v.x + e * v.y + f * v.z, g * v.x + h * v.y + i * v.z), ray.time)
+
+    def intersect(self, ray, t_min, t_max, rec):
+        local_r = self.local_ray(ray)
+        if not self.obj.intersect(local_r, t_min, t_max, rec):
+            return False
+
+        # Keep the object space ray with the hit object inside, so the surface is computed without transforming again
+        rec.inner = (rec.obj, rec.inner, local_r)
+        rec.obj = self
+        return True
+
+    def occluded(self, ray, t_min, t_max):
+        return self.obj.occluded(self.local_ray(ray), t_min, t_max)
+
+    def surface(self, ray, rec):
+        obj, rec.inner, local_r = rec.inner
+        obj.surface(local_r, rec)
+
+        # The normal already faces against the object space ray, and affine transforms keep that side, so front_face stays
+        transform = self.transform
+        rec.p = transform.point(rec.p)
+        n = transform.normal(rec.normal)
+        length = sqrt(n.x * n.x + n.y * n.y + n.z * n.z)
+        rec.normal = Vec3(n.x / length, n.y / length, n.z / length)
+        rec.du /= self.length_scale
+        rec.dv /= self.length_scale
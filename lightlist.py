@@ -0,0 +1,168 @@
+# Custom libraries
+from hittablelist import HittableList
+from hittable import FlipFace
+from aarect import xyRect, xzRect, yzRect
+from sphere import Sphere
+from bvh import SahBvh, LinearBvh
+from aabb import AABB
+from material import DiffuseLight
+from framebuffer import luminance
+from sampler import sample_1d
+
+# 3rd party libraries
+from math import pi
+
+
+# Shadow rays stop this much (relative to the distance) short of a sampled light point, so rounding does not let the light itself
+# block them
+SHADOW_EPSILON = 1e-4
+
+
+class AliasTable:
+    '''Walker's alias table (built with Vose's method) for choosing an index with probability proportional to its weight in O(1)'''
+
+    def __init__(self, weights):
+        n = len(weights)
+        total = sum(weights)
+        if not total > 0:
+            weights = [1.0] * n
+            total = float(n)
+        self.pdfs = [w / total for w in weights]
+
+        # Every column holds the probability of keeping its own index, and the index it gives away the rest of its column to
+        scaled = [p * n for p in self.pdfs]
+        self.prob = [1.0] * n
+        self.alias = list(range(n))
+        small = [i for i, s in enumerate(scaled) if s < 1]
+        large = [i for i, s in enumerate(scaled) if s >= 1]
+        while small and large:
+            s = small.pop()
+            l = large.pop()
+            self.prob[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] -= 1 - scaled[s]
+            if scaled[l] < 1:
+                small.append(l)
+            else:
+                large.append(l)
+
+    def __len__(self):
+        return len(self.prob)
+
+    def sample(self, u):
+        '''Index chosen by a random number u in [0, 1)'''
+        n = len(self.prob)
+        x = u * n
+        i = min(int(x), n - 1)
+        if x - i < self.prob[i]:
+            return i
+        return self.alias[i]
+
+
+def light_shape(obj):
+    '''The rectangle or sphere of a light, without the FlipFace wrappers that only change which side it faces'''
+    while isinstance(obj, FlipFace):
+        obj = obj.p
+    return obj
+
+
+def light_inner(obj):
+    '''The rec.inner chain that intersect leaves for a hit of a light through its FlipFace wrappers (see FlipFace.surface)'''
+    if isinstance(obj, FlipFace):
+        return (obj.p, light_inner(obj.p))
+    return None
+
+
+def light_area(shape):
+    if isinstance(shape, xyRect):
+        return (shape.x1 - shape.x0) * (shape.y1 - shape.y0)
+    if isinstance(shape, xzRect):
+        return (shape.x1 - shape.x0) * (shape.z1 - shape.z0)
+    if isinstance(shape, yzRect):
+        return (shape.y1 - shape.y0) * (shape.z1 - shape.z0)
+    if isinstance(shape, Sphere):
+        return 4 * pi * shape.r * shape.r
+    raise ValueError(f'Light type {type(shape).__name__} is not supported')
+
+
+def light_power(shape):
+    '''Emitted power of a light up to a constant (luminance of its emission at its center times its area), or just its area for
+    shapes without an emitting material (which are sampled as if they were lights)'''
+    area = light_area(shape)
+    if not isinstance(shape.mat, DiffuseLight):
+        return area
+    box = AABB()
+    shape.bounding_box(0, 1, box)
+    center = (box._min + box._max) * 0.5
+    emit = shape.mat.emit.value(0.5, 0.5, center)
+    return luminance(emit.x, emit.y, emit.z) * area
+
+
+def find_lights(obj):
+    '''All emitting rectangles and spheres in a hittable tree that can be sampled directly (lights inside instances, transforms and
+    media are left out, and only reached by scattered rays)'''
+    if isinstance(obj, HittableList):
+        return [light for child in obj.objects for light in find_lights(child)]
+    if isinstance(obj, SahBvh):
+        return [light for child in obj.objects for light in find_lights(child)]
+    if isinstance(obj, LinearBvh):
+        return [light for child in obj.primitives for light in find_lights(child)]
+    shape = light_shape(obj)
+    if isinstance(shape, (xyRect, xzRect, yzRect, Sphere)) and isinstance(shape.mat, DiffuseLight):
+        return [obj]
+    return []
+
+
+class LightList(HittableList):
+    '''Lights chosen in proportion to their emitted power through an alias table built once per scene
+
+    sample and light_pdf work on one light at a time in O(1), and index finds the light of an object hit by a ray, so the
+    integrator never loops over all lights. The lights sample directions uniformly over the solid angle they cover, and return the
+    density with every sample. pdf_value and random keep the HittableList interface (for HittablePDF), with the
+    lights weighted by power.
+    '''
+
+    def __init__(self, objects=None):
+        super().__init__(objects)
+        self.shapes = [light_shape(obj) for obj in self.objects]
+        self.inners = [light_inner(obj) for obj in self.objects]
+        self.table = AliasTable([light_power(shape) for shape in self.shapes])
+        self.pdfs = self.table.pdfs
+        self.indices = {id(obj): i for i, obj in enumerate(self.objects)}
+
+    def add(self, obj):
+        super().add(obj)
+        self.__init__(self.objects)
+
+    def index(self, obj):
+        '''Position of a light in the list, or None if the object is not one of the lights'''
+        return self.indices.get(id(obj))
+
+    def sample(self, o):
+        '''Choose a light and a direction from o towards it, returning the light index, the direction (unit length), the distance to
+        the light and the density of the choice'''
+        i = self.table.sample(sample_1d())
+        direction, distance, pdf = self.shapes[i].sample_light(o)
+        return i, direction, distance, self.pdfs[i] * pdf
+
+    def emitted(self, i, ray, distance, rec):
+        '''Light emitted by light i towards the origin of ray from the point at distance along it (a direction and distance returned
+        by sample), filling in rec for that point without tracing the ray'''
+        rec.t = distance
+        rec.obj = self.objects[i]
+        rec.inner = self.inners[i]
+        rec.obj.surface(ray, rec)
+        return rec.mat.emitted(ray, rec, rec.u, rec.v, rec.p)
+
+    def light_pdf(self, i, o, v):
+        '''Density of sample choosing light i and a direction v from o that hits it (in closed form, without tracing v)'''
+        return self.pdfs[i] * self.shapes[i].light_pdf(o, v)
+
+    def pdf_value(self, o, v):
+        s = 0.0
+        for shape, pdf in zip(self.shapes, self.pdfs):
+            s += pdf * shape.pdf_value(o, v)
+        return s
+
+    def random(self, o):
+        return self.sample(o)[1]
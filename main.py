@@ -11,19 +11,23 @@ from camera import Camera
 from material import *
 from scene import *
 from pdf import *
+from scheduler import RenderPool, print_utilisation, print_sample_usage, SampleBudget, TILE_ORDERS
+from framebuffer import FrameBuffer, luminance
+from stats import RenderStats
+from lightlist import LightList, find_lights, SHADOW_EPSILON
+from sampler import make_sampler, use_sampler, sample_1d, set_dimension, SAMPLERS, CAMERA_DIMENSIONS, BOUNCE_DIMENSIONS
 
 # 3rd party libraries
-from random import random, uniform
 import argparse
-from multiprocessing import Value, Process, cpu_count
-import tempfile
-from pathlib import Path
-import os
-import stat
+from multiprocessing import cpu_count
 import time
 from math import isnan
+from time import perf_counter
 
 
+# Number of bounces before paths may be ended by Russian roulette
+RUSSIAN_ROULETTE_DEPTH = 3
+
 def vec_to_col(v):
     '''Convert a Vec3 object to a Color object'''
     return Color(v[0], v[1], v[2])
@@ -41,70 +45,212 @@ def de_nan(c):
     return temp
 
 
-def split_range(count, parts):
-    '''Split some value count into multiple ranges'''
-    d, r = divmod(count, parts)
-    return [(i*d + min(i, r), (i+1)*d + min(i+1, r)) for i in range(parts)]
+def ray_color(ray, background, world, lights, depth, stats=None, features=None, spread=0.0):
+    '''Determine the color of a ray based on the objects in a scene (iterative up to a max depth, with Russian roulette), adding
+    the albedo, normal and distance of the first hit to a features list of seven sums if given
 
+    The ray stands for a cone widening by spread (the angle a pixel covers) with the distance the path has travelled, so textures
+    are filtered over the width of the cone at every hit.
 
-def ray_color(ray, background, world, lights, depth):
-    '''Determine the color of a ray based on the objects in a scene (recursive with a max depth)'''
+    At every diffuse hit a light (chosen by power from a LightList) and a point on it are sampled and connected by a shadow ray
+    (next event estimation), and the material samples the next direction. Light reaching the hit through either strategy is
+    weighted with the power heuristic, so a light hit by the scattered ray only adds the part of its light that the light sample
+    did not already count.
+    '''
     rec = HitRecord()
-
-    # Don't exceed ray bounce limit
-    if depth <= 0:
-        return Vec3(0, 0, 0)
-
-    # If the ray hits nothing, return background color
-    if not world.hit(ray, 0.001, float('inf'), rec):
-        return background
-
-    # Determine if the object emits light or has a specular material
-    srec = ScatterRecord()
-    emitted = rec.mat.emitted(ray, rec, rec.u, rec.v, rec.p)
-    if not rec.mat.scatter(ray, rec, srec):
-        return emitted
-    if srec.is_specular:
-        return srec.attenuation * ray_color(srec.specular_ray, background, world, lights, depth - 1)
-
-    # Use PDFs to determine the next ray and call ray_color() again
-    light_ptr = HittablePDF(lights, rec.p)
-    p = MixturePDF(light_ptr, srec.pdf_ptr)
-    scattered = Ray(rec.p, p.generate(), ray.time)
-    pdf_val = p.value(scattered.dir)
-    del srec.pdf_ptr
-
-    return emitted + srec.attenuation * rec.mat.scattering_pdf(ray, rec, scattered) * ray_color(scattered, background, world, lights, depth - 1) / pdf_val
-
-
-def render(scene, hmin, hmax, part_file, rows_done, samples_per_pixel, max_depth, background):
-    '''Render horizontal strip of a scene (from hmin to hmax) by shooting multiple rays through each pixel'''
-    width  = scene.width
-    height = scene.height
-    aspect_ratio = width / height
-    world = scene.world
-    lights = scene.lights
-
-    camera = scene.camera
-
-    with open(part_file, 'w') as part_fileobj:
-
-        for j in range(hmax, hmin, -1):
-            for i in range(width):
+    srec = scatter_record()
+    shadow = HitRecord()
+    # Shadow and scattered rays are reused for every bounce (the scattered direction is overwritten in place)
+    shadow_ray = Ray(ray.orig, ray.dir, ray.time)
+    scattered = Ray(ray.orig, Vec3(0, 0, 0), ray.time)
+    has_lights = len(lights) > 0
+
+    # Radiance gathered so far and the throughput of the path
+    r, g, b = 0.0, 0.0, 0.0
+    tr, tg, tb = 1.0, 1.0, 1.0
+    # Density of the material sample that chose the current ray (0 for camera and specular rays, whose emitter hits count fully)
+    bsdf_pdf = 0.0
+    travelled = 0.0
+
+    for bounce in range(depth):
+        # Every decision of a bounce uses the sample dimension reserved for it (see BOUNCE_DIMENSIONS)
+        dimension = CAMERA_DIMENSIONS + bounce * BOUNCE_DIMENSIONS
+        set_dimension(dimension)
+        if bounce >= RUSSIAN_ROULETTE_DEPTH:
+            roulette = sample_1d()
+        set_dimension(dimension + 1)
+
+        # If the ray hits nothing, add the background color
+        if not world.hit(ray, 0.001, float('inf'), rec):
+            r += tr * background.x
+            g += tg * background.y
+            b += tb * background.z
+            if features is not None and bounce == 0:
+                features[0] += background.x
+                features[1] += background.y
+                features[2] += background.z
+            break
+
+        travelled += rec.t * ray.dir.length()
+        rec.footprint = spread * travelled
+
+        # Determine if the object emits light or has a specular material
+        emitted = rec.mat.emitted(ray, rec, rec.u, rec.v, rec.p)
+        if emitted.x > 0 or emitted.y > 0 or emitted.z > 0:
+            weight = 1.0
+            if bsdf_pdf > 0:
+                # Emitters that are not in the light list can only be found this way
+                index = lights.index(rec.obj)
+                if index is not None:
+                    weight = power_heuristic(bsdf_pdf, lights.light_pdf(index, ray.orig, ray.dir))
+            r += tr * emitted.x * weight
+            g += tg * emitted.y * weight
+            b += tb * emitted.z * weight
+        set_dimension(dimension + 2)
+        scatters = rec.mat.sample(ray, rec, srec)
+
+        if features is not None and bounce == 0:
+            # Lights have no albedo, so their (clamped) emission stands in for it
+            albedo = srec.attenuation if scatters else emitted
+            features[0] += min(albedo.x, 1.0)
+            features[1] += min(albedo.y, 1.0)
+            features[2] += min(albedo.z, 1.0)
+            features[3] += rec.normal.x
+            features[4] += rec.normal.y
+            features[5] += rec.normal.z
+            features[6] += travelled
+
+        if not scatters:
+            break
+
+        attenuation = srec.attenuation
+        if srec.is_specular:
+            tr *= attenuation.x
+            tg *= attenuation.y
+            tb *= attenuation.z
+            ray = srec.specular_ray
+            bsdf_pdf = 0.0
+        else:
+            mat = rec.mat
+            if has_lights:
+                # Sample a point on a light and add the light it emits towards the hit, unless anything lies in between
+                set_dimension(dimension + 5)
+                index, to_light, distance, light_pdf = lights.sample(rec.p)
+                if light_pdf > 0:
+                    set_dimension(dimension + 8)
+                    shadow_ray.orig = rec.p
+                    shadow_ray.dir = to_light
+                    shadow_ray.time = ray.time
+                    light_emitted = lights.emitted(index, shadow_ray, distance, shadow)
+                    if light_emitted.x > 0 or light_emitted.y > 0 or light_emitted.z > 0:
+                        if stats is not None:
+                            stats.record_shadow_rays(1)
+                        if not world.occluded(shadow_ray, 0.001, distance * (1 - SHADOW_EPSILON)):
+                            lx, ly, lz = to_light.x, to_light.y, to_light.z
+                            weight = mat.bsdf_value(rec, lx, ly, lz) * power_heuristic(light_pdf, mat.bsdf_pdf(rec, srec, lx, ly, lz)) / light_pdf
+                            r += tr * attenuation.x * light_emitted.x * weight
+                            g += tg * attenuation.y * light_emitted.y * weight
+                            b += tb * attenuation.z * light_emitted.z * weight
+
+            # Continue in the direction the material chose
+            pdf_val = srec.pdf
+            if not pdf_val > 0:
+                break
+            dx, dy, dz = srec.dx, srec.dy, srec.dz
+            weight = mat.bsdf_value(rec, dx, dy, dz) / pdf_val
+            direction = scattered.dir
+            direction.x, direction.y, direction.z = dx, dy, dz
+            scattered.orig = rec.p
+            scattered.time = ray.time
+            tr *= attenuation.x * weight
+            tg *= attenuation.y * weight
+            tb *= attenuation.z * weight
+            ray = scattered
+            bsdf_pdf = pdf_val if has_lights else 0.0
+
+        # Stop paths that can no longer carry light, and randomly stop dim paths (boosting the survivors to stay unbiased)
+        survival = max(tr, tg, tb)
+        if not survival > 0:
+            break
+        if bounce >= RUSSIAN_ROULETTE_DEPTH and survival < 1:
+            if roulette >= survival:
+                break
+            tr /= survival
+            tg /= survival
+            tb /= survival
+
+    if stats is not None:
+        stats.record_path(bounce + 1)
+    return Vec3(r, g, b)
+
+
+class ScalarRenderer:
+    '''Renders image tiles one ray at a time by shooting multiple rays through each pixel, with the random numbers of every sample
+    taken from a sampler (see sampler.py)'''
+
+    def __init__(self, scene, max_depth, background, sampler=None):
+        self.scene = scene
+        self.max_depth = max_depth
+        self.background = background
+        self.sampler = make_sampler('independent') if sampler is None else sampler
+        self.stats = None
+        self.heatmap = False
+        self.features = False
+
+    def set_view(self, camera, width, height):
+        '''Render the same world from another camera or at another image size'''
+        self.scene = Scene(camera, self.scene.world, self.scene.lights, width, height)
+
+    def render_tile(self, x0, y0, x1, y1, samples_per_pixel, first_sample=0):
+        '''Summed colors, squared luminances and (with heatmap or features set, else None) render seconds and first-hit features of some
+        samples, numbered from first_sample, for each pixel in a tile (row-major, y0 is the top row)'''
+        width  = self.scene.width
+        height = self.scene.height
+        world  = self.scene.world
+        lights = self.scene.lights
+        camera = self.scene.camera
+        sampler = self.sampler
+        use_sampler(sampler)
+        sampler.start_pass(first_sample, samples_per_pixel)
+        # Angle covered by a pixel, which widens the texture footprint of the camera rays
+        spread = camera.viewport_height / (height - 1)
+
+        colors = []
+        squares = []
+        costs = [] if self.heatmap else None
+        features = [] if self.features else None
+        for row in range(y0, y1):
+            j = height - 1 - row
+            for i in range(x0, x1):
+                start = perf_counter()
                 pixel_color = Color(0, 0, 0)
-                for s in range(samples_per_pixel):
-                    u = (i + random()) / (width  - 1)
-                    v = (j + random()) / (height - 1)
+                square = 0.0
+                pixel_features = [0.0] * 7 if features is not None else None
+                for s in range(first_sample, first_sample + samples_per_pixel):
+                    sampler.start(row * width + i, s)
+                    du, dv = sampler.get_2d()
+                    u = (i + du) / (width  - 1)
+                    v = (j + dv) / (height - 1)
                     r = camera.get_ray(u, v)
-                    pixel_color += de_nan(ray_color(r, background, world, lights, max_depth))
-                part_fileobj.write(vec_to_col(pixel_color).write_color(samples_per_pixel))
-            part_fileobj.write('\n')
+                    sample = de_nan(ray_color(r, self.background, world, lights, self.max_depth, self.stats, pixel_features, spread))
+                    pixel_color += sample
+                    square += luminance(sample.x, sample.y, sample.z) ** 2
+                colors.append((pixel_color.x, pixel_color.y, pixel_color.z))
+                squares.append(square)
+                if costs is not None:
+                    costs.append(perf_counter() - start)
+                if features is not None:
+                    features.append(pixel_features)
+        return colors, squares, costs, features
+
+
+def make_renderer(scene, engine, max_depth, background, seed=None, sampler='independent'):
+    '''Create the tile renderer of the chosen engine (called once in every worker process)'''
+    if engine == 'wavefront':
+        from wavefront import WavefrontRenderer
+        return WavefrontRenderer(scene, max_depth, background, seed)
+    return ScalarRenderer(scene, max_depth, background, make_sampler(sampler, seed))
 
-            if rows_done:
-                with rows_done.get_lock():
-                    rows_done.value += 1
-                    print(f'  {float(rows_done.value)/float(height) * 100:3.1f}%', end='\r')
-            
 
 def main():
     '''Set up the scene and camera and create multiple processes to render it'''
@@ -118,20 +264,35 @@ def main():
     # Multi-process calculations
     parser = argparse.ArgumentParser()
     parser.add_argument('-p', '--processes', action='store', type=int, dest='processes', default=0, help='Number of processes (auto=0)')
+    parser.add_argument('-e', '--engine', action='store', choices=['scalar', 'wavefront'], dest='engine', default='scalar', help='Render engine (wavefront requires NumPy)')
+    parser.add_argument('--sampler', action='store', choices=SAMPLERS, dest='sampler', default='independent', help='Sample pattern of the scalar engine')
+    parser.add_argument('--seed', action='store', type=int, dest='seed', default=0, help='Random seed (the same seed gives the same image on any number of processes)')
+    parser.add_argument('-t', '--tile-size', action='store', type=int, dest='tile_size', default=16, help='Width and height of the tiles handed to processes')
+    parser.add_argument('-o', '--tile-order', action='store', choices=TILE_ORDERS, dest='tile_order', default='spiral', help='Order in which tiles are rendered')
+    parser.add_argument('-w', '--width', action='store', type=int, dest='width', default=image_width, help='Image width in pixels')
+    parser.add_argument('-s', '--samples', action='store', type=int, dest='samples', default=samples_per_pixel, help='Samples per pixel')
+    parser.add_argument('--pass-samples', action='store', type=int, dest='pass_samples', default=0, help='Samples per pixel in each progressive pass (all at once=0)')
+    parser.add_argument('-a', '--adaptive-threshold', action='store', type=float, dest='threshold', default=0.0, help='Stop sampling tiles once their relative error is below this (off=0)')
+    parser.add_argument('--min-samples', action='store', type=int, dest='min_samples', default=16, help='Samples per pixel before adaptive sampling may stop a tile')
+    parser.add_argument('-c', '--checkpoint', action='store', dest='checkpoint', default=None, help='File to periodically save the accumulated samples to')
+    parser.add_argument('--checkpoint-interval', action='store', type=float, dest='checkpoint_interval', default=60.0, help='Seconds between checkpoints')
+    parser.add_argument('-r', '--resume', action='store_true', dest='resume', help='Continue from the checkpoint file, adding samples up to --samples')
+    parser.add_argument('--heatmap', action='store_true', dest='heatmap', help='Also write the render cost of every pixel (seconds, or rays for wavefront) as a false color image')
+    parser.add_argument('--features', action='store_true', dest='features', help='Also write the albedo, normal and depth of the first hits as images')
+    parser.add_argument('--denoise', action='store_true', dest='denoise', help='Also write a denoised image guided by the first-hit features (requires NumPy)')
+    parser.add_argument('--stats', action='store_true', dest='stats', help='Count rays, BVH nodes, primitive tests and time per material, and print them')
+    parser.add_argument('--stats-json', action='store', dest='stats_json', default=None, help='Also write the render statistics of every process to this JSON file')
     args = parser.parse_args()
+    if args.resume and not args.checkpoint:
+        parser.error('--resume requires --checkpoint')
+    image_width = args.width
+    image_height = int(image_width / aspect_ratio)
+    samples_per_pixel = args.samples
     if args.processes == 0:
         process_count = cpu_count()
     else:
         process_count = args.processes
     print(f'Starting {process_count} processes...')
-    ranges = split_range(image_height, process_count)
-
-    # Lights
-    lights = HittableList()
-    #lights.add(Sphere(Point3(190, 90, 190), 90, 0))
-    lights.add(xzRect(213, 343, 227, 332, 554, Material()))
-    #lights.add(Sphere(Point3(190, 90, 190), 90, Material()))
-    #lights.add(xzRect(123, 423, 147, 412, 554, Material()))
 
     # World
     #world = final_scene()
@@ -142,7 +303,10 @@ def main():
     #world = two_perlin_spheres()
     #world = two_spheres()
     #world = random_scene()
-    
+
+    # Lights (every emitting rectangle and sphere of the world)
+    lights = LightList(find_lights(world))
+
     # Camera
     lookfrom      = Point3(278, 278, -800)
     lookat        = Point3(278, 278,    0)
@@ -157,33 +321,53 @@ def main():
     scene = Scene(camera, world, lights, image_width, image_height)
 
     # Render scene
-    with open('filename.ppm', 'w') as img_fileobj:
-
-        temp_dir = Path(tempfile.mkdtemp())
-        temp_file_tmpl = 'part-{}.temp'
-        processes = []
-
+    framebuffer = FrameBuffer(image_width, image_height)
+    try:
+        if args.resume:
+            framebuffer.load_checkpoint(args.checkpoint)
+            print(f'Resuming from {args.checkpoint}')
+
+        instrument = args.stats or args.stats_json is not None
+        pool = RenderPool(scene, make_renderer, (args.engine, max_depth, background, args.seed, args.sampler), process_count, instrument, args.heatmap, args.features or args.denoise)
+        print(f'Started {process_count} processes in {pool.startup_time:.2f} s (renderer setup up to {max(pool.setup_times):.2f} s per process)')
+
+        start_time = time.time()
+        budget = SampleBudget(samples_per_pixel, args.pass_samples, args.min_samples, args.threshold)
         try:
-            rows_done = Value('i', 0)
-            print(f'  {float(rows_done.value)/float(image_height) * 100:3.1f}%', end='\r')
-            for hmin, hmax in ranges:
-                part_file = temp_dir / temp_file_tmpl.format(hmin)
-                processes.append(Process(target=render, args=(scene, hmin, hmax, part_file, rows_done, samples_per_pixel, max_depth, background)))
-
-            for process in processes:
-                process.start()
-            for process in processes:
-                process.join()
-            
-            img_fileobj.write(f'P3 {image_width} {image_height}\n255\n')
-            for hmin, _ in reversed(ranges):
-                part_file = temp_dir / temp_file_tmpl.format(hmin)
-                img_fileobj.write(open(part_file, 'r').read())
-
+            stats = pool.render(camera, framebuffer, budget, args.tile_size, args.tile_order, None, args.checkpoint, args.checkpoint_interval)
         finally:
-            os.chmod(temp_dir, stat.S_IWRITE)
-            os.remove(temp_dir)
+            pool.close()
+        elapsed = time.time() - start_time
+        samples = sum(s['samples'] for s in stats)
+        print(f'Rendered {samples} samples in {elapsed:.1f} s ({samples / elapsed:.0f} camera rays per second)')
+        print_utilisation(stats, elapsed)
+        print_sample_usage(framebuffer, budget)
+
+        if instrument:
+            counters = RenderStats()
+            for s in stats:
+                counters.merge(s['counters'].as_dict())
+            counters.report()
+            if args.stats_json:
+                counters.write_json(args.stats_json, [s['counters'] for s in stats])
+
+        framebuffer.write_ppm('filename.ppm')
+        if args.heatmap:
+            framebuffer.write_heatmap('filename_cost.ppm')
+            unit = 'rays' if args.engine == 'wavefront' else 's'
+            print(f'Wrote filename_cost.ppm (pixel cost up to {max(framebuffer.costs):.4g} {unit}, average {sum(framebuffer.costs) / len(framebuffer.costs):.4g} {unit})')
+        if args.features:
+            framebuffer.write_features('filename_albedo.ppm', 'filename_normal.ppm', 'filename_depth.ppm')
+        if args.denoise:
+            from denoise import denoise_framebuffer
+            start_time = time.time()
+            denoise_framebuffer(framebuffer, 'filename_denoised.ppm')
+            print(f'Wrote filename_denoised.ppm (denoised in {time.time() - start_time:.2f} s)')
+
+    finally:
+        framebuffer.close()
+        framebuffer.unlink()
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -5,14 +5,26 @@ from color import Color
 from texture import *
 from onb import ONB
 from pdf import *
+from bsdf import cosine_sample, cosine_pdf, uniform_sphere_sample, UNIFORM_SPHERE_PDF
+from sampler import sample_1d, sample_2d
 
 # 3rd party libraries
 from math import sqrt, pi
-from random import random
+import threading
+
+
+# Emission of materials that do not emit light, shared by all of them (never changed in place)
+NO_EMISSION = Color(0, 0, 0)
+
+# Scatter records reused by the renderers of each thread
+_local = threading.local()
 
 
 class ScatterRecord:
-    '''Class to store ray properties when a ray hits a material'''
+    '''Class to store ray properties when a ray hits a material, and the direction (dx, dy, dz) and density (pdf) chosen by
+    Material.sample for non-specular materials'''
+
+    __slots__ = ('specular_ray', 'is_specular', 'attenuation', 'pdf_ptr', 'dx', 'dy', 'dz', 'pdf')
 
     def __init__(self):
         pass
@@ -22,10 +34,26 @@ class ScatterRecord:
         self.is_specular = other.is_specular
         self.attenuation = other.attenuation
         self.pdf_ptr = other.pdf_ptr
+        self.dx = other.dx
+        self.dy = other.dy
+        self.dz = other.dz
+        self.pdf = other.pdf
+
+
+def scatter_record():
+    '''Scatter record of the current thread, reused for every bounce it renders'''
+    record = getattr(_local, 'scatter_record', None)
+    if record is None:
+        record = _local.scatter_record = ScatterRecord()
+    return record
 
 
 class Material:
-    '''Parent material class storing light interaction properties of certain material types'''
+    '''Parent material class storing light interaction properties of certain material types
+
+    The renderer calls sample, bsdf_value and bsdf_pdf, which work on plain numbers and the reused scatter record. scatter and
+    scattering_pdf (with PDF objects) are the older interface, which the defaults of the others fall back on.
+    '''
 
     def __init__(self):
         pass
@@ -37,7 +65,26 @@ class Material:
         return 0
 
     def emitted(self, ray, rec, u, v, p):
-        return Color(0, 0, 0)
+        return NO_EMISSION
+
+    def sample(self, ray, rec, srec):
+        '''Scatter a ray like scatter, choosing the direction (unit length) and density of non-specular materials into srec'''
+        if not self.scatter(ray, rec, srec):
+            return False
+        if not srec.is_specular:
+            direction = srec.pdf_ptr.generate().unit_vector()
+            srec.dx, srec.dy, srec.dz = direction.x, direction.y, direction.z
+            srec.pdf = srec.pdf_ptr.value(direction)
+        return True
+
+    def bsdf_value(self, rec, dx, dy, dz):
+        '''Scattering density (the BSDF times the cosine, without the color) towards a direction'''
+        return self.scattering_pdf(None, rec, Ray(rec.p, Vec3(dx, dy, dz)))
+
+    def bsdf_pdf(self, rec, srec, dx, dy, dz):
+        '''Density of sample choosing a direction, given the scatter record sample filled in for the hit (by default the density of
+        its pdf_ptr, like sample)'''
+        return srec.pdf_ptr.value(Vec3(dx, dy, dz))
 
 
 class Lambertian(Material):
@@ -68,6 +115,23 @@ class Lambertian(Material):
             return 0
         return cosine / pi
 
+    def sample(self, ray, rec, srec):
+        srec.is_specular = False
+        width = rec.footprint
+        srec.attenuation = self.a.value(rec.u, rec.v, rec.p, width * rec.du, width * rec.dv)
+        n = rec.normal
+        u1, u2 = sample_2d()
+        cosine_sample(n.x, n.y, n.z, u1, u2, srec)
+        return True
+
+    def bsdf_value(self, rec, dx, dy, dz):
+        n = rec.normal
+        return cosine_pdf(n.x, n.y, n.z, dx, dy, dz)
+
+    def bsdf_pdf(self, rec, srec, dx, dy, dz):
+        n = rec.normal
+        return cosine_pdf(n.x, n.y, n.z, dx, dy, dz)
+
 
 class Metal(Material):
     '''Metallic (reflective) material stored as a texture and a fuzz variable indicating the clearness of the reflections'''
@@ -134,7 +198,7 @@ class Dielectric(Material):
         else:
             reflect_prob = 1.0
 
-        if random() < reflect_prob:
+        if sample_1d() < reflect_prob:
             srec.specular_ray = Ray(rec.p, reflected)
         else:
             srec.specular_ray = Ray(rec.p, refracted)
@@ -152,9 +216,9 @@ class DiffuseLight(Material):
 
     def emitted(self, ray, rec, u, v, p):
         if rec.front_face:
-            return self.emit.value(u, v, p)
+            return self.emit.value(u, v, p, rec.footprint * rec.du, rec.footprint * rec.dv)
         else:
-            return Color(0, 0, 0)
+            return NO_EMISSION
 
 
 class Isotropic(Material):
@@ -166,7 +230,26 @@ class Isotropic(Material):
         else:
             self.albedo = a
 
-    def scatter(self, ray, rec, attenuation, scattered):
-        scattered.replace_values(Ray(rec.p, Vec3.random_in_unit_sphere(), ray.time))
-        attenuation.replace_values(self.albedo.value(rec.u, rec.v, rec.p))
-        return True
\ No newline at end of file
+    def scatter(self, ray, rec, srec):
+        # Scattered like a diffuse surface (with a uniform phase function), so medium points also sample the lights
+        srec.is_specular = False
+        srec.pdf_ptr = SpherePDF()
+        srec.attenuation = self.albedo.value(rec.u, rec.v, rec.p)
+        return True
+
+    def scattering_pdf(self, ray, rec, scattered):
+        return UNIFORM_SPHERE_PDF
+
+    def sample(self, ray, rec, srec):
+        srec.is_specular = False
+        width = rec.footprint
+        srec.attenuation = self.albedo.value(rec.u, rec.v, rec.p, width * rec.du, width * rec.dv)
+        u1, u2 = sample_2d()
+        uniform_sphere_sample(u1, u2, srec)
+        return True
+
+    def bsdf_value(self, rec, dx, dy, dz):
+        return UNIFORM_SPHERE_PDF
+
+    def bsdf_pdf(self, rec, srec, dx, dy, dz):
+        return UNIFORM_SPHERE_PDF
\ No newline at end of file
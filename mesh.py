@@ -0,0 +1,433 @@
+# Custom libraries
+from hittable import Hittable
+from bvh import SahBvh, BvhLeaf
+from aabb import AABB
+from point3 import Point3
+from vec3 import Vec3
+
+# 3rd party libraries
+from array import array
+from math import sqrt
+import argparse
+import mmap
+import struct
+import sys
+import time
+
+
+# Binary mesh file header: magic, format version, number of BVH nodes and leaves, estimated BVH cost, and the length of every array
+MESH_HEADER = struct.Struct('<4sIIId10Q')
+MESH_MAGIC = b'PRTM'
+MESH_VERSION = 1
+
+# Arrays stored in a binary mesh file, in order (each starting at a multiple of 8 bytes)
+MESH_ARRAYS = (('positions', 'd'), ('normals', 'd'), ('uvs', 'd'), ('bounds', 'd'), ('indices', 'i'), ('normal_indices', 'i'),
+               ('uv_indices', 'i'), ('offsets', 'i'), ('counts', 'i'), ('triangles', 'i'))
+
+# Factor for the far distance of the box tests, so rounding errors never make a ray miss a box it touches (Ize 2013)
+ROBUST_SCALE = 1 + 2 * (3 * 2 ** -53) / (1 - 3 * 2 ** -53)
+
+
+class TriangleBvh(SahBvh):
+    '''SAH bounding volume hierarchy over the triangles of a mesh, whose primitives are triangle indices'''
+
+    def __init__(self, mesh, leaf_size=4, bins=12):
+        self.mesh = mesh
+        super().__init__(range(mesh.triangle_count), 0, 1, leaf_size, bins)
+
+    def primitive_bounds(self):
+        positions = self.mesh.positions
+        indices = self.mesh.indices
+        for k in range(0, len(indices), 3):
+            a = 3 * indices[k]
+            b = 3 * indices[k + 1]
+            c = 3 * indices[k + 2]
+            xs = (positions[a], positions[b], positions[c])
+            ys = (positions[a + 1], positions[b + 1], positions[c + 1])
+            zs = (positions[a + 2], positions[b + 2], positions[c + 2])
+            yield (min(xs), min(ys), min(zs)), (max(xs), max(ys), max(zs))
+
+    def __str__(self):
+        return f'Triangle BVH over {len(self.objects)} triangles: {self.node_count} nodes, {self.leaf_count} leaves, built in {self.build_time:.3f} s, estimated cost {self.cost:.2f}'
+
+
+class TriangleMesh(Hittable):
+    '''Triangle mesh with one material, stored in flat typed arrays and traversed through its own flattened BVH
+
+    Vertex positions (xyz), normals (xyz) and UV coordinates (uv) are arrays of doubles. Every triangle has three position indices,
+    and optionally three normal and three UV indices (as in OBJ files; -1 where a triangle has none). Without normals the geometric
+    normal is used, and without UV coordinates the barycentric coordinates of the hit are used instead.
+
+    A mesh saved to a binary file and opened with load_mesh reads all arrays straight from the memory-mapped file, so every render
+    process shares the same pages. Such a mesh is pickled as its filename and material only.
+    '''
+
+    def __init__(self, positions, indices, material, normals=None, normal_indices=None, uvs=None, uv_indices=None, leaf_size=4):
+        self.positions = array('d', positions)
+        self.indices = array('i', indices)
+        self.normals = array('d', normals or ())
+        self.uvs = array('d', uvs or ())
+        # Per-vertex attributes share the position indices
+        self.normal_indices = array('i', self.indices if normals and normal_indices is None else normal_indices or ())
+        self.uv_indices = array('i', self.indices if uvs and uv_indices is None else uv_indices or ())
+        self.mat = material
+        self.filename = None
+        self.triangle_count = len(self.indices) // 3
+        if self.triangle_count == 0:
+            raise ValueError('A triangle mesh needs at least one triangle')
+
+        tree = TriangleBvh(self, leaf_size)
+        start = time.perf_counter()
+
+        # Same node layout as LinearBvh, with the triangle indices of every leaf stored together
+        self.bounds = array('d')
+        self.offsets = array('i')
+        self.counts = array('i')
+        self.triangles = array('i')
+        self.flatten(tree.root)
+
+        self.node_count = tree.node_count
+        self.leaf_count = tree.leaf_count
+        self.cost = tree.cost
+        self.build_time = tree.build_time + time.perf_counter() - start
+        self.box = tree.root.box
+
+    def __getstate__(self):
+        # Memory-mapped meshes are mapped again from their file instead of copying the arrays
+        if self.filename is not None:
+            return {'filename': self.filename, 'mat': self.mat}
+        return self.__dict__
+
+    def __setstate__(self, state):
+        if 'positions' in state:
+            self.__dict__.update(state)
+        else:
+            self.map_file(state['filename'], state['mat'])
+
+    def __str__(self):
+        return f'Triangle mesh with {len(self.positions) // 3} vertices and {self.triangle_count} triangles: {len(self.counts)} BVH nodes ({self.leaf_count} leaves), {"loaded" if self.filename else "built"} in {self.build_time:.3f} s, estimated cost {self.cost:.2f}'
+
+    def save(self, filename):
+        '''Write the vertex data and the flattened BVH to a binary mesh file that load_mesh can memory-map'''
+        lengths = [len(getattr(self, name)) for name, _ in MESH_ARRAYS]
+        with open(filename, 'wb') as mesh_fileobj:
+            mesh_fileobj.write(MESH_HEADER.pack(MESH_MAGIC, MESH_VERSION, self.node_count, self.leaf_count, self.cost, *lengths))
+            for name, typecode in MESH_ARRAYS:
+                mesh_fileobj.write(b'\0' * (-mesh_fileobj.tell() % 8))
+                mesh_fileobj.write(array(typecode, getattr(self, name)).tobytes())
+
+    def map_file(self, filename, material):
+        '''Use the arrays of a binary mesh file, memory-mapped read-only, as the data of this mesh'''
+        start = time.perf_counter()
+        if sys.byteorder != 'little':
+            raise ValueError('Binary mesh files can only be memory-mapped on little-endian machines')
+        with open(filename, 'rb') as mesh_fileobj:
+            self.mapping = mmap.mmap(mesh_fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, self.node_count, self.leaf_count, self.cost, *lengths = MESH_HEADER.unpack_from(self.mapping)
+        if magic != MESH_MAGIC or version != MESH_VERSION:
+            raise ValueError(f'{filename} is not a binary mesh file (version {MESH_VERSION})')
+        view = memoryview(self.mapping)
+        position = MESH_HEADER.size
+        for (name, typecode), length in zip(MESH_ARRAYS, lengths):
+            position += -position % 8
+            size = length * array(typecode).itemsize
+            if position + size > len(self.mapping):
+                raise ValueError(f'Binary mesh file {filename} is truncated')
+            setattr(self, name, view[position:position + size].cast(typecode))
+            position += size
+
+        self.mat = material
+        self.filename = filename
+        self.triangle_count = len(self.indices) // 3
+        self.box = AABB(Point3(*self.bounds[0:3]), Point3(*self.bounds[3:6]))
+        self.build_time = time.perf_counter() - start
+
+    def flatten(self, node):
+        index = len(self.counts)
+        box = node.box
+        self.bounds.extend((box._min.x, box._min.y, box._min.z, box._max.x, box._max.y, box._max.z))
+
+        if isinstance(node, BvhLeaf):
+            self.offsets.append(len(self.triangles))
+            self.counts.append(len(node.objects))
+            self.triangles.extend(node.objects)
+            return index
+
+        self.offsets.append(0)
+        self.counts.append(-1 - node.axis)
+        self.flatten(node.left)
+        self.offsets[index] = self.flatten(node.right)
+        return index
+
+    def bounding_box(self, t0, t1, output_box):
+        output_box.replace_values(self.box)
+        return True
+
+    def intersect(self, ray, t_min, t_max, rec):
+        found = self.traverse(ray, t_min, t_max, False)
+        if found is None:
+            return False
+        rec.t, rec.inner = found
+        rec.obj = self
+        return True
+
+    def occluded(self, ray, t_min, t_max):
+        return self.traverse(ray, t_min, t_max, True) is not None
+
+    def traverse(self, ray, t_min, t_max, any_hit):
+        '''Closest (or with any_hit, the first found) triangle hit as (t, (triangle, b1, b2)), or None'''
+        ox, oy, oz = ray.orig.x, ray.orig.y, ray.orig.z
+        dx, dy, dz = ray.dir.x, ray.dir.y, ray.dir.z
+        ix = 1.0 / dx if dx != 0 else float('inf')
+        iy = 1.0 / dy if dy != 0 else float('inf')
+        iz = 1.0 / dz if dz != 0 else float('inf')
+
+        # Offsets of the near and far slab planes in the bounds array, depending on the ray direction
+        nx, fx = (3, 0) if ix < 0 else (0, 3)
+        ny, fy = (4, 1) if iy < 0 else (1, 4)
+        nz, fz = (5, 2) if iz < 0 else (2, 5)
+        negative = (ix < 0, iy < 0, iz < 0)
+
+        # Watertight ray-triangle test (Woop, Benthin and Wald 2013): shear and scale the triangles into a space where the ray
+        # points along +z from the origin, so edges shared by two triangles are tested identically and rays cannot slip through.
+        # The axes are permuted so that z is the largest direction component, keeping the winding by swapping x and y.
+        ad = (abs(dx), abs(dy), abs(dz))
+        kz = 0 if ad[0] >= ad[1] and ad[0] >= ad[2] else (1 if ad[1] >= ad[2] else 2)
+        kx = (kz + 1) % 3
+        ky = (kx + 1) % 3
+        d = (dx, dy, dz)
+        if d[kz] < 0:
+            kx, ky = ky, kx
+        sz = 1.0 / d[kz]
+        sx = d[kx] * sz
+        sy = d[ky] * sz
+        o = (ox, oy, oz)
+        okx, oky, okz = o[kx], o[ky], o[kz]
+
+        bounds = self.bounds
+        offsets = self.offsets
+        counts = self.counts
+        triangles = self.triangles
+        positions = self.positions
+        indices = self.indices
+
+        found = None
+        stack = []
+        node = 0
+
+        while True:
+            b = 6 * node
+            t0 = (bounds[b + nx] - ox) * ix
+            t1 = (bounds[b + fx] - ox) * ix
+            ty0 = (bounds[b + ny] - oy) * iy
+            ty1 = (bounds[b + fy] - oy) * iy
+            if ty0 > t0:
+                t0 = ty0
+            if ty1 < t1:
+                t1 = ty1
+            tz0 = (bounds[b + nz] - oz) * iz
+            tz1 = (bounds[b + fz] - oz) * iz
+            if tz0 > t0:
+                t0 = tz0
+            if tz1 < t1:
+                t1 = tz1
+            t1 *= ROBUST_SCALE
+            if t0 < t_min:
+                t0 = t_min
+            if t1 > t_max:
+                t1 = t_max
+
+            # Inclusive, as flat triangles (for example of axis-aligned faces) have flat bounds
+            if t0 <= t1:
+                count = counts[node]
+                if count >= 0:
+                    offset = offsets[node]
+                    for k in range(offset, offset + count):
+                        tri = triangles[k]
+                        va = 3 * indices[3 * tri]
+                        vb = 3 * indices[3 * tri + 1]
+                        vc = 3 * indices[3 * tri + 2]
+
+                        # Vertices relative to the ray origin, sheared
+                        az = positions[va + kz] - okz
+                        bz = positions[vb + kz] - okz
+                        cz = positions[vc + kz] - okz
+                        ax = positions[va + kx] - okx - sx * az
+                        ay = positions[va + ky] - oky - sy * az
+                        bx = positions[vb + kx] - okx - sx * bz
+                        by = positions[vb + ky] - oky - sy * bz
+                        cx = positions[vc + kx] - okx - sx * cz
+                        cy = positions[vc + ky] - oky - sy * cz
+
+                        # Scaled barycentric coordinates, which must all have the same sign (both windings are hit)
+                        u = cx * by - cy * bx
+                        v = ax * cy - ay * cx
+                        w = bx * ay - by * ax
+                        if (u < 0 or v < 0 or w < 0) and (u > 0 or v > 0 or w > 0):
+                            continue
+                        det = u + v + w
+                        if det == 0:
+                            continue
+
+                        t = (u * az + v * bz + w * cz) * sz / det
+                        if not t_min < t < t_max:
+                            continue
+                        found = (t, (tri, v / det, w / det))
+                        if any_hit:
+                            return found
+                        t_max = t
+                else:
+                    # Visit the child on the near side of the split axis first, keep the other for later
+                    if negative[-1 - count]:
+                        stack.append(node + 1)
+                        node = offsets[node]
+                    else:
+                        stack.append(offsets[node])
+                        node = node + 1
+                    continue
+
+            if not stack:
+                return found
+            node = stack.pop()
+
+    def surface(self, ray, rec):
+        tri, b1, b2 = rec.inner
+        b0 = 1.0 - b1 - b2
+        positions = self.positions
+        k = 3 * tri
+        a = 3 * self.indices[k]
+        b = 3 * self.indices[k + 1]
+        c = 3 * self.indices[k + 2]
+
+        rec.p = Vec3(b0 * positions[a] + b1 * positions[b] + b2 * positions[c],
+                     b0 * positions[a + 1] + b1 * positions[b + 1] + b2 * positions[c + 1],
+                     b0 * positions[a + 2] + b1 * positions[b + 2] + b2 * positions[c + 2])
+
+        # Geometric normal from the counter-clockwise winding, which decides the front face
+        e1x, e1y, e1z = positions[b] - positions[a], positions[b + 1] - positions[a + 1], positions[b + 2] - positions[a + 2]
+        e2x, e2y, e2z = positions[c] - positions[a], positions[c + 1] - positions[a + 1], positions[c + 2] - positions[a + 2]
+        gx = e1y * e2z - e1z * e2y
+        gy = e1z * e2x - e1x * e2z
+        gz = e1x * e2y - e1y * e2x
+        d = ray.dir
+        rec.front_face = d.x * gx + d.y * gy + d.z * gz < 0
+
+        nx, ny, nz = gx, gy, gz
+        normal_indices = self.normal_indices
+        if normal_indices and normal_indices[k] >= 0:
+            normals = self.normals
+            na = 3 * normal_indices[k]
+            nb = 3 * normal_indices[k + 1]
+            nc = 3 * normal_indices[k + 2]
+            nx = b0 * normals[na] + b1 * normals[nb] + b2 * normals[nc]
+            ny = b0 * normals[na + 1] + b1 * normals[nb + 1] + b2 * normals[nc + 1]
+            nz = b0 * normals[na + 2] + b1 * normals[nb + 2] + b2 * normals[nc + 2]
+            # Shading normals on the other side of the surface than the geometry (from bad input) are turned around
+            if nx * gx + ny * gy + nz * gz < 0:
+                nx, ny, nz = -nx, -ny, -nz
+
+        # The normal always points against the ray
+        scale = (1.0 if rec.front_face else -1.0) / sqrt(nx * nx + ny * ny + nz * nz)
+        rec.normal = Vec3(nx * scale, ny * scale, nz * scale)
+
+        uv_indices = self.uv_indices
+        if uv_indices and uv_indices[k] >= 0:
+            uvs = self.uvs
+            ua = 2 * uv_indices[k]
+            ub = 2 * uv_indices[k + 1]
+            uc = 2 * uv_indices[k + 2]
+            rec.u = b0 * uvs[ua] + b1 * uvs[ub] + b2 * uvs[uc]
+            rec.v = b0 * uvs[ua + 1] + b1 * uvs[ub + 1] + b2 * uvs[uc + 1]
+            uv_area = abs((uvs[ub] - uvs[ua]) * (uvs[uc + 1] - uvs[ua + 1]) - (uvs[uc] - uvs[ua]) * (uvs[ub + 1] - uvs[ua + 1]))
+        else:
+            rec.u = b1
+            rec.v = b2
+            uv_area = 1.0
+        # The same rate in both directions, from the ratio of the triangle's areas in UV and in space (both doubled)
+        rec.du = rec.dv = sqrt(uv_area / max(sqrt(gx * gx + gy * gy + gz * gz), 1e-300))
+        rec.mat = self.mat
+
+
+def load_obj(filename, material, leaf_size=4):
+    '''Load a Wavefront OBJ file as one triangle mesh, reading it line by line straight into typed arrays
+
+    Supports vertex positions, normals and texture coordinates, and faces with any number of vertices (split into triangle fans),
+    with positive or negative (relative) indices. Groups, objects, smoothing groups and materials are ignored.
+    '''
+    positions = array('d')
+    normals = array('d')
+    uvs = array('d')
+    indices = array('i')
+    normal_indices = array('i')
+    uv_indices = array('i')
+
+    def resolve(value, count):
+        # OBJ indices start at 1, negative ones count back from the last vertex read so far
+        if not value:
+            return -1
+        index = int(value)
+        return index - 1 if index > 0 else count + index
+
+    with open(filename) as obj_fileobj:
+        for line_number, line in enumerate(obj_fileobj, 1):
+            fields = line.split()
+            if not fields:
+                continue
+            keyword = fields[0]
+            if keyword == 'v':
+                positions.extend((float(fields[1]), float(fields[2]), float(fields[3])))
+            elif keyword == 'vn':
+                normals.extend((float(fields[1]), float(fields[2]), float(fields[3])))
+            elif keyword == 'vt':
+                uvs.extend((float(fields[1]), float(fields[2]) if len(fields) > 2 else 0.0))
+            elif keyword == 'f':
+                if len(fields) < 4:
+                    raise ValueError(f'{filename}:{line_number}: face with fewer than three vertices')
+                corners = []
+                for corner in fields[1:]:
+                    parts = corner.split('/') + ['', '']
+                    corners.append((resolve(parts[0], len(positions) // 3), resolve(parts[2], len(normals) // 3), resolve(parts[1], len(uvs) // 2)))
+                for i in range(1, len(corners) - 1):
+                    for p, n, t in (corners[0], corners[i], corners[i + 1]):
+                        indices.append(p)
+                        normal_indices.append(n)
+                        uv_indices.append(t)
+
+    if len(positions) == 0 or len(indices) == 0:
+        raise ValueError(f'{filename} contains no triangles')
+    if min(indices) < 0 or max(indices) >= len(positions) // 3:
+        raise ValueError(f'{filename} has faces referring to missing vertices')
+    # Attribute indices are only kept if they are used at all
+    if normal_indices and max(normal_indices) < 0:
+        normal_indices = array('i')
+    if uv_indices and max(uv_indices) < 0:
+        uv_indices = array('i')
+    if (normal_indices and max(normal_indices) >= len(normals) // 3) or (uv_indices and max(uv_indices) >= len(uvs) // 2):
+        raise ValueError(f'{filename} has faces referring to missing normals or texture coordinates')
+
+    return TriangleMesh(positions, indices, material, normals, normal_indices, uvs, uv_indices, leaf_size)
+
+
+def load_mesh(filename, material):
+    '''Open a binary mesh file written by TriangleMesh.save, memory-mapped so that nothing is copied or built'''
+    mesh = TriangleMesh.__new__(TriangleMesh)
+    mesh.map_file(filename, material)
+    return mesh
+
+
+def main():
+    '''Convert an OBJ file to a binary mesh file with a prebuilt BVH'''
+    parser = argparse.ArgumentParser(description='Convert an OBJ file to a binary mesh file that loads instantly and is shared between render processes')
+    parser.add_argument('obj', help='OBJ file to convert')
+    parser.add_argument('output', help='Binary mesh file to write')
+    parser.add_argument('-l', '--leaf-size', action='store', type=int, dest='leaf_size', default=4, help='Maximum number of triangles per BVH leaf')
+    args = parser.parse_args()
+
+    mesh = load_obj(args.obj, None, args.leaf_size)
+    print(mesh)
+    mesh.save(args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,10 +2,7 @@
 from hittable import Hittable
 from aabb import AABB
 from vec3 import Vec3
-from sphere import Sphere
-
-# 3rd party library
-from math import sqrt, atan2, asin, pi
+from sphere import Sphere, hit_sphere, sphere_surface
 
 
 class MovingSphere(Hittable):
@@ -28,43 +25,26 @@ class MovingSphere(Hittable):
         output_box.replace_values(AABB.surrounding_box(self.box0, self.box1))
         return True
 
-    def hit(self, ray, t_min, t_max, hit_rec):
-        oc = ray.orig - self.center(ray.time)
-        
-        a = ray.dir.length_squared()
-        half_b = oc.dot(ray.dir)
-        c = oc.length_squared() - self.r * self.r
-
-        discriminant = half_b * half_b - a * c
-
-        if discriminant > 0:
-            root = sqrt(discriminant)
-            
-            temp = (-half_b - root) / a
-            if t_min < temp < t_max:
-                hit_rec.t = temp
-                hit_rec.p = ray.at(hit_rec.t)
-                outward_normal = (hit_rec.p - self.center(ray.time)) / self.r
-                get_sphere_uv((hit_rec.p - self.center(ray.time)) / self.r, hit_rec)
-                hit_rec.set_face_normal(ray, outward_normal)
-                hit_rec.mat = self.mat
-                return True
-
-            temp = (-half_b + root) / a
-            if t_min < temp < t_max:
-                hit_rec.t = temp
-                hit_rec.p = ray.at(hit_rec.t)
-                outward_normal = (hit_rec.p - self.center(ray.time)) / self.r
-                get_sphere_uv((hit_rec.p - self.center(ray.time)) / self.r, hit_rec)
-                hit_rec.set_face_normal(ray, outward_normal)
-                hit_rec.mat = self.mat
-                return True
-        return False
-
+    def intersect(self, ray, t_min, t_max, hit_rec):
+        c0 = self.center0
+        c1 = self.center1
+        s = (ray.time - self.time0) / (self.time1 - self.time0)
+        t = hit_sphere(ray, c0.x + s * (c1.x - c0.x), c0.y + s * (c1.y - c0.y), c0.z + s * (c1.z - c0.z), self.r, t_min, t_max)
+        if t is None:
+            return False
+        hit_rec.t = t
+        hit_rec.obj = self
+        hit_rec.inner = None
+        return True
 
-def get_sphere_uv(p, hit_rec):
-    '''Calculate UV coordinates on a sphere'''
-    phi = atan2(p.z, p.x)
-    theta = asin(p.y)
-    hit_rec.u = 1 - (phi + pi) / (2 * pi)
-    hit_rec.v = (theta + pi / 2) / pi
\ No newline at end of file
+    def occluded(self, ray, t_min, t_max):
+        c0 = self.center0
+        c1 = self.center1
+        s = (ray.time - self.time0) / (self.time1 - self.time0)
+        return hit_sphere(ray, c0.x + s * (c1.x - c0.x), c0.y + s * (c1.y - c0.y), c0.z + s * (c1.z - c0.z), self.r, t_min, t_max) is not None
+
+    def surface(self, ray, hit_rec):
+        c0 = self.center0
+        c1 = self.center1
+        s = (ray.time - self.time0) / (self.time1 - self.time0)
+        sphere_surface(ray, c0.x + s * (c1.x - c0.x), c0.y + s * (c1.y - c0.y), c0.z + s * (c1.z - c0.z), self.r, self.mat, hit_rec)
@@ -2,10 +2,17 @@
 from vec3 import Vec3
 from onb import ONB
 from point3 import Point3
+from sampler import sample_1d, sample_2d
 
 # 3rd party libraries
-from math import pi
-from random import random
+from math import pi, sqrt, cos, sin
+
+
+def power_heuristic(pdf, other_pdf):
+    '''Multiple importance sampling weight of a sample drawn with one density that another density could also have drawn (Veach's
+    power heuristic with exponent 2)'''
+    squared = pdf * pdf
+    return squared / (squared + other_pdf * other_pdf)
 
 
 class PDF:
@@ -38,6 +45,20 @@ class CosinePDF(PDF):
         return self.uvw.local(Vec3.random_cosine_direction())
 
 
+class SpherePDF(PDF):
+    '''Uniform probability density function over all directions'''
+
+    def value(self, direction):
+        return 1 / (4 * pi)
+
+    def generate(self):
+        r1, r2 = sample_2d()
+        z = 1 - 2 * r1
+        r = sqrt(max(1 - z * z, 0.0))
+        phi = 2 * pi * r2
+        return Vec3(r * cos(phi), r * sin(phi), z)
+
+
 class HittablePDF(PDF):
     '''Probabiltiy density function stored as a hittable object with an origin point'''
 
@@ -62,6 +83,6 @@ class MixturePDF(PDF):
         return 0.5 * self.p[0].value(direction) + 0.5 * self.p[1].value(direction)
 
     def generate(self):
-        if random() < 0.5:
+        if sample_1d() < 0.5:
             return self.p[0].generate()
         return self.p[1].generate()
\ No newline at end of file
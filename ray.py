@@ -6,13 +6,17 @@ from vec3 import Vec3
 class Ray:
     '''A ray described by an origin, direction and time (for motion blur)'''
 
+    __slots__ = ('orig', 'dir', 'time')
+
     def __init__(self, origin=Point3(0, 0, 0), direction=Vec3(1, 1, 1), time=0.0):
         self.orig = origin
         self.dir = direction
         self.time = time
 
     def at(self, t):
-        return self.orig + t * self.dir
+        o = self.orig
+        d = self.dir
+        return Vec3(o.x + t * d.x, o.y + t * d.y, o.z + t * d.z)
 
     def __str__(self):
         return f'orig: {self.orig}, dir: {self.dir}'
@@ -0,0 +1,316 @@
+# 3rd party libraries
+from math import ceil, sqrt
+import random
+
+
+# Dimensions used by the camera: pixel position (2), time (1) and lens position (2)
+CAMERA_DIMENSIONS = 5
+
+# Dimensions reserved for every bounce, so the same decision of every sample of a pixel uses the same dimension: Russian roulette (1),
+# medium distance (1), material scattering including the direction of diffuse materials (3), light choice (1), point on the light
+# (2) and medium distance along the shadow ray (1) (decisions beyond these move the following ones further along)
+BOUNCE_DIMENSIONS = 9
+
+# Names of the samplers that can be chosen
+SAMPLERS = ('independent', 'stratified', 'halton', 'sobol')
+
+MASK = 0xffffffff
+
+# Bit reversals of all bytes
+REVERSED_BYTES = bytes(int(f'{b:08b}'[::-1], 2) for b in range(256))
+
+
+def first_primes(count):
+    '''The first count prime numbers'''
+    primes = []
+    n = 2
+    while len(primes) < count:
+        if all(n % p for p in primes if p * p <= n):
+            primes.append(n)
+        n += 1
+    return primes
+
+
+# Bases of the Halton dimensions, enough for 99 bounces (dimensions beyond these are random)
+PRIMES = first_primes(CAMERA_DIMENSIONS + 99 * BOUNCE_DIMENSIONS)
+
+
+def sobol_tables():
+    '''Generator matrix of the second Sobol dimension (from the primitive polynomial x + 1) as lookup tables of the four index bytes,
+    giving the bits of the points in reverse order'''
+    directions = [1]
+    for _ in range(31):
+        directions.append(directions[-1] ^ (directions[-1] << 1))
+    tables = []
+    for byte in range(4):
+        table = []
+        for b in range(256):
+            x = 0
+            for bit in range(8):
+                if b >> bit & 1:
+                    x ^= directions[8 * byte + bit]
+            table.append(x)
+        tables.append(table)
+    return tables
+
+
+SOBOL_TABLES = sobol_tables()
+
+
+def hash_int(x):
+    '''Well-mixed 32-bit hash of an integer (lowbias32 by Chris Wellons)'''
+    x &= MASK
+    x ^= x >> 16
+    x = (x * 0x7feb352d) & MASK
+    x ^= x >> 15
+    x = (x * 0x846ca68b) & MASK
+    x ^= x >> 16
+    return x
+
+
+def hash_combine(seed, value):
+    '''32-bit hash of a seed and another integer'''
+    return hash_int(seed ^ (hash_int(value) + 0x9e3779b9 + (seed << 6) + (seed >> 2)))
+
+
+def reverse_bits(x):
+    '''Reverse the order of the 32 bits of x'''
+    return REVERSED_BYTES[x & 255] << 24 | REVERSED_BYTES[x >> 8 & 255] << 16 | REVERSED_BYTES[x >> 16 & 255] << 8 | REVERSED_BYTES[x >> 24]
+
+
+def permute(i, length, seed):
+    '''Element i of a random permutation of range(length) chosen by seed (Kensler, "Correlated Multi-Jittered Sampling")'''
+    w = length - 1
+    w |= w >> 1
+    w |= w >> 2
+    w |= w >> 4
+    w |= w >> 8
+    w |= w >> 16
+    while True:
+        i ^= seed
+        i = (i * 0xe170893d) & MASK
+        i ^= seed >> 16
+        i ^= (i & w) >> 4
+        i ^= seed >> 8
+        i = (i * 0x0929eb3f) & MASK
+        i ^= seed >> 23
+        i ^= (i & w) >> 1
+        i = (i * (1 | seed >> 27)) & MASK
+        i = (i * 0x6935fa69) & MASK
+        i ^= (i & w) >> 11
+        i = (i * 0x74dcb303) & MASK
+        i ^= (i & w) >> 2
+        i = (i * 0x9e501cc3) & MASK
+        i ^= (i & w) >> 2
+        i = (i * 0xc860a3df) & MASK
+        i &= w
+        i ^= i >> 5
+        if i < length:
+            return (i + seed) % length
+
+
+def laine_karras_permutation(x, seed):
+    '''Owen scrambling of a base 2 fraction given with its 32 bits in reverse order (Laine and Karras, as in Burley 2020)'''
+    x = (x + seed) & MASK
+    x ^= (x * 0x6c50b47c) & MASK
+    x ^= (x * 0xb82f1e52) & MASK
+    x ^= (x * 0xc7afe638) & MASK
+    x ^= (x * 0x8d22f6e6) & MASK
+    return x
+
+
+def scrambled_radical_inverse(base, i, limit, seed, tail):
+    '''Digits of i (up to as many as limit has) in a base mirrored around the decimal point, each digit position shuffled by its own
+    random permutation, with a random number from 0 to 1 (tail) filling in the digits after those'''
+    inv_base = 1.0 / base
+    f = 1.0
+    r = 0.0
+    position = 0
+    while limit:
+        i, digit = divmod(i, base)
+        limit //= base
+        f *= inv_base
+        r += permute(digit, base, hash_combine(seed, position)) * f
+        position += 1
+    return r + tail * f
+
+
+class Sampler:
+    '''Parent class of the samplers, which give every sample of every pixel its own sequence of random numbers in [0, 1)
+
+    The renderer calls start_pass before the samples of a tile, start before each sample of a pixel and set_dimension before each
+    decision of a bounce. The numbers only depend on the seed, the pixel, the sample index and the dimension, so an image comes out
+    the same on any number of processes.
+    '''
+
+    def __init__(self, seed=None):
+        self.seed = random.randrange(1 << 32) if seed is None else seed
+        self.first = 0
+        self.count = 1
+        self.pixel_seed = 0
+        self.index = 0
+        self.dimension = 0
+
+    def start_pass(self, first_sample, samples):
+        '''Begin rendering samples first_sample up to first_sample + samples of the pixels of a tile'''
+        self.first = first_sample
+        self.count = samples
+
+    def start(self, pixel, index):
+        '''Begin a sample of a pixel'''
+        self.pixel_seed = hash_combine(self.seed, pixel)
+        self.index = index
+        self.dimension = 0
+
+    def set_dimension(self, dimension):
+        # Never back to a dimension already used, which would make two decisions of a sample depend on each other
+        if dimension > self.dimension:
+            self.dimension = dimension
+
+    def random(self, dimension):
+        '''Hashed random number of the current sample in a dimension'''
+        return hash_combine(hash_combine(self.pixel_seed, self.index), dimension) * 2.0 ** -32
+
+    def get_1d(self):
+        value = self.random(self.dimension)
+        self.dimension += 1
+        return value
+
+    def get_2d(self):
+        values = self.random(self.dimension), self.random(self.dimension + 1)
+        self.dimension += 2
+        return values
+
+
+class IndependentSampler(Sampler):
+    '''Uncorrelated random numbers (white noise), from a random number generator seeded for every tile pass, or without a seed from
+    the global random number generator (not reproducible)'''
+
+    def __init__(self, seed=None):
+        super().__init__(seed)
+        self.rng = random if seed is None else random.Random()
+        self.reseed = False
+
+    def start_pass(self, first_sample, samples):
+        self.reseed = self.rng is not random
+
+    def start(self, pixel, index):
+        # Seeding is slow, so it is done once per tile pass, from the first sample of its first pixel (the tiles and the order of their
+        # pixels do not depend on the number of processes)
+        if self.reseed:
+            self.rng.seed(hash_combine(hash_combine(self.seed, pixel), index))
+            self.reseed = False
+
+    def set_dimension(self, dimension):
+        pass
+
+    def get_1d(self):
+        return self.rng.random()
+
+    def get_2d(self):
+        return self.rng.random(), self.rng.random()
+
+
+class StratifiedSampler(Sampler):
+    '''Jittered stratification of the samples of each pass: every sample of a pixel falls in a different one of as many strata (a grid
+    in two dimensions), in an order shuffled per pixel and dimension'''
+
+    def get_1d(self):
+        n = self.count
+        seed = hash_combine(hash_combine(self.pixel_seed, self.first), self.dimension)
+        value = (permute((self.index - self.first) % n, n, seed) + self.random(self.dimension)) / n
+        self.dimension += 1
+        return value
+
+    def get_2d(self):
+        n = self.count
+        sx = ceil(sqrt(n))
+        sy = ceil(n / sx)
+        seed = hash_combine(hash_combine(self.pixel_seed, self.first), self.dimension)
+        cell = permute((self.index - self.first) % n, sx * sy, seed)
+        values = (cell % sx + self.random(self.dimension)) / sx, (cell // sx + self.random(self.dimension + 1)) / sy
+        self.dimension += 2
+        return values
+
+
+class HaltonSampler(Sampler):
+    '''Halton sequence per pixel (a prime base per dimension) with random digit permutations per pixel and dimension, which keep the
+    first samples of the large bases of later dimensions spread out and uncorrelated'''
+
+    def get_1d(self):
+        value = self.halton(self.dimension)
+        self.dimension += 1
+        return value
+
+    def get_2d(self):
+        values = self.halton(self.dimension), self.halton(self.dimension + 1)
+        self.dimension += 2
+        return values
+
+    def halton(self, dimension):
+        if dimension >= len(PRIMES):
+            return self.random(dimension)
+        value = scrambled_radical_inverse(PRIMES[dimension], self.index, self.first + self.count - 1, hash_combine(self.pixel_seed, dimension), self.random(dimension))
+        return min(value, 1.0 - 2.0 ** -53)
+
+
+class SobolSampler(Sampler):
+    '''Owen-scrambled Sobol points (Burley, "Practical Hash-based Owen Scrambling", 2020)
+
+    Every dimension (or pair of dimensions) uses the first two Sobol dimensions with its own scrambling and its own shuffled order of
+    the sample indices, which keeps the dimensions uncorrelated with each other and the pixels uncorrelated with their neighbours.
+    The points are computed with their bits in reverse order, where the first Sobol dimension is the sample index itself.
+    '''
+
+    def start(self, pixel, index):
+        super().start(pixel, index)
+        self.reversed_index = reverse_bits(index)
+
+    def get_1d(self):
+        seed = hash_combine(self.pixel_seed, self.dimension)
+        index = reverse_bits(laine_karras_permutation(self.reversed_index, seed))
+        self.dimension += 1
+        return reverse_bits(laine_karras_permutation(index, hash_int(seed + 1))) * 2.0 ** -32
+
+    def get_2d(self):
+        seed = hash_combine(self.pixel_seed, self.dimension)
+        index = reverse_bits(laine_karras_permutation(self.reversed_index, seed))
+        y = SOBOL_TABLES[0][index & 255] ^ SOBOL_TABLES[1][index >> 8 & 255] ^ SOBOL_TABLES[2][index >> 16 & 255] ^ SOBOL_TABLES[3][index >> 24]
+        self.dimension += 2
+        return (reverse_bits(laine_karras_permutation(index, hash_int(seed + 1))) * 2.0 ** -32,
+                reverse_bits(laine_karras_permutation(y, hash_int(seed + 2))) * 2.0 ** -32)
+
+
+def make_sampler(name, seed=None):
+    '''Create a sampler by name (one of SAMPLERS)'''
+    samplers = {'independent': IndependentSampler, 'stratified': StratifiedSampler, 'halton': HaltonSampler, 'sobol': SobolSampler}
+    return samplers[name](seed)
+
+
+# Sampler that the sampling functions of the renderer draw from
+_sampler = IndependentSampler()
+
+
+def use_sampler(sampler):
+    '''Make the sampling functions draw from a sampler'''
+    global _sampler
+    _sampler = sampler
+
+
+def current_sampler():
+    return _sampler
+
+
+def sample_1d():
+    '''Next random number of the current sample'''
+    return _sampler.get_1d()
+
+
+def sample_2d():
+    '''Next pair of random numbers of the current sample'''
+    return _sampler.get_2d()
+
+
+def set_dimension(dimension):
+    '''Continue the current sample at a dimension (or where it is, if that is further along)'''
+    _sampler.set_dimension(dimension)
@@ -11,7 +11,8 @@ from aarect import *
 from box import Box
 from hittable import *
 from constantmedium import ConstantMedium
-from bvh import BvhNode
+from bvh import LinearBvh
+from instance import Instance, Transform
 
 # 3rd party library
 from random import random, uniform
@@ -66,7 +67,10 @@ def random_scene():
     material3 = Metal(Color(0.7, 0.6, 0.5), 0.0)
     world.add(Sphere(Point3( 4,  1,  0), 1.0, material3))
 
-    return world
+    bvh = LinearBvh(world, 0.0, 1.0)
+    print(bvh)
+
+    return HittableList(bvh)
 
 
 def two_spheres():
@@ -128,12 +132,10 @@ def cornell_box():
     glass = Dielectric(1.5)
 
     box1 = Box(Point3(0, 0,  0), Point3(165, 330, 165), aluminum)
-    box1 = RotateY(box1, 15)
-    box1 = Translate(box1, Vec3(265, 0, 295))
+    box1 = Instance(box1, Transform.translate(Vec3(265, 0, 295)) @ Transform.rotate(Vec3(0, 1, 0), 15))
 
     box2 = Box(Point3(0, 0, 0), Point3(165, 165, 165), white)
-    box2 = RotateY(box2, -18)
-    box2 = Translate(box2, Vec3(130, 0, 65))
+    box2 = Instance(box2, Transform.translate(Vec3(130, 0, 65)) @ Transform.rotate(Vec3(0, 1, 0), -18))
 
     world.add(yzRect(0, 555, 0, 555, 555, green))
     world.add(yzRect(0, 555, 0, 555,   0, red  ))
@@ -158,12 +160,10 @@ def cornell_smoke():
     light = DiffuseLight(Color(7, 7, 7))
 
     box1 = Box(Point3(0, 0,  0), Point3(165, 330, 165), white)
-    box1 = RotateY(box1, 15)
-    box1 = Translate(box1, Vec3(265, 0, 295))
+    box1 = Instance(box1, Transform.translate(Vec3(265, 0, 295)) @ Transform.rotate(Vec3(0, 1, 0), 15))
 
     box2 = Box(Point3(0, 0, 0), Point3(165, 165, 165), white)
-    box2 = RotateY(box2, -18)
-    box2 = Translate(box2, Vec3(130, 0, 65))
+    box2 = Instance(box2, Transform.translate(Vec3(130, 0, 65)) @ Transform.rotate(Vec3(0, 1, 0), -18))
 
     world.add(yzRect(0, 555, 0, 555, 555, green))
     world.add(yzRect(0, 555, 0, 555,   0, red  ))
@@ -174,7 +174,7 @@ def cornell_smoke():
     world.add(ConstantMedium(box1, 0.01, Color(0, 0, 0)))
     world.add(ConstantMedium(box2, 0.01, Color(1, 1, 1)))
 
-    world.add(xzRect(113, 443, 127, 432, 554, light))
+    world.add(FlipFace(xzRect(113, 443, 127, 432, 554, light)))
 
     return world
 
@@ -198,10 +198,12 @@ def final_scene():
 
     world = HittableList()
 
-    world.add(BvhNode(boxes1, 0, 1))
+    bvh1 = LinearBvh(boxes1, 0, 1)
+    print(bvh1)
+    world.add(bvh1)
 
     light = DiffuseLight(Color(7, 7, 7))
-    world.add(xzRect(123, 423, 147, 412, 554, light))
+    world.add(FlipFace(xzRect(123, 423, 147, 412, 554, light)))
 
     center1 = Point3(400, 400, 200)
     center2 = center1 + Vec3(50, 0, 0)
@@ -227,7 +229,9 @@ def final_scene():
     ns = 1000
     for j in range(ns):
         boxes2.add(Sphere(Point3.random(0, 165), 10, white))
-    
-    world.add(Translate(RotateY(BvhNode(boxes2, 0, 1), 15), Vec3(-100, 270, 395)))
+
+    bvh2 = LinearBvh(boxes2, 0, 1)
+    print(bvh2)
+    world.add(Instance(bvh2, Transform.translate(Vec3(-100, 270, 395)) @ Transform.rotate(Vec3(0, 1, 0), 15)))
 
     return world
\ No newline at end of file
@@ -0,0 +1,329 @@
+# Custom libraries
+from framebuffer import FrameBuffer
+from stats import RenderStats
+
+# 3rd party libraries
+from multiprocessing import Process, Queue, Pipe, Lock, get_start_method, resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from queue import Empty
+from math import atan2
+import pickle
+import time
+import traceback
+
+
+TILE_ORDERS = ['scanline', 'spiral', 'hilbert']
+
+# Seconds between checks that all render processes are still alive while waiting for their results
+POLL_INTERVAL = 1.0
+
+
+def hilbert_index(n, x, y):
+    '''Position of cell (x, y) along a Hilbert curve filling an n by n grid (n a power of two)'''
+    d = 0
+    s = n // 2
+    while s > 0:
+        rx = 1 if x & s else 0
+        ry = 1 if y & s else 0
+        d += s * s * ((3 * rx) ^ ry)
+        if ry == 0:
+            if rx == 1:
+                x = s - 1 - x
+                y = s - 1 - y
+            x, y = y, x
+        s //= 2
+    return d
+
+
+def make_tiles(width, height, tile_size, order='scanline', crop=None):
+    '''Split an image (or the crop rectangle (x0, y0, x1, y1) of it) into tiles (x0, y0, x1, y1), with y0 the top row, sorted in the given order'''
+    left, top, right, bottom = crop if crop is not None else (0, 0, width, height)
+    columns = (right - left + tile_size - 1) // tile_size
+    rows = (bottom - top + tile_size - 1) // tile_size
+    cells = [(tx, ty) for ty in range(rows) for tx in range(columns)]
+
+    if order == 'spiral':
+        # Rings around the centre tile, each ring walked by angle
+        cx = (columns - 1) / 2
+        cy = (rows - 1) / 2
+        cells.sort(key=lambda c: (max(abs(c[0] - cx), abs(c[1] - cy)), atan2(c[1] - cy, c[0] - cx)))
+    elif order == 'hilbert':
+        n = 1
+        while n < max(columns, rows):
+            n *= 2
+        cells.sort(key=lambda c: hilbert_index(n, c[0], c[1]))
+    elif order != 'scanline':
+        raise ValueError(f'Unknown tile order {order}, expected one of {TILE_ORDERS}')
+
+    return [(left + tx * tile_size, top + ty * tile_size, min(left + (tx + 1) * tile_size, right), min(top + (ty + 1) * tile_size, bottom)) for tx, ty in cells]
+
+
+# Scene handed to forked workers by copy-on-write inheritance instead of pickling
+_inherited_scene = None
+
+
+def load_scene(source):
+    '''Get the pool's scene in a worker, either inherited through fork or unpickled from shared memory'''
+    if source is None:
+        return _inherited_scene
+    name, size = source
+    shm = SharedMemory(name=name)
+    try:
+        return pickle.loads(shm.buf[:size])
+    finally:
+        shm.close()
+
+
+def render_worker(worker_id, make_renderer, renderer_args, scene_source, lock, control, tasks, results, instrument=False, heatmap=False, features=False):
+    '''Build the renderer once, then render tiles of any job taken from the task queue until a stop signal (an exception is sent to
+    the pool as an error message with its traceback, which ends the worker)'''
+    framebuffer = None
+    try:
+        start = time.perf_counter()
+        renderer = make_renderer(load_scene(scene_source), *renderer_args)
+        stats = None
+        if instrument:
+            stats = RenderStats()
+            stats.enable()
+            renderer.stats = stats
+        renderer.heatmap = heatmap
+        renderer.features = features
+        results.put(('ready', worker_id, time.perf_counter() - start))
+
+        job_id = None
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            task_job, tile, first_sample, samples = task
+
+            # Job settings arrive on this worker's own pipe before any of the job's tiles are queued
+            # (skipping jobs this worker got no tiles of, whose framebuffers may be gone already)
+            if task_job != job_id:
+                job_id = None
+                while job_id != task_job:
+                    job_id, camera, width, height, framebuffer_name = control.recv()
+                if framebuffer is not None:
+                    framebuffer.close()
+                framebuffer = FrameBuffer(width, height, framebuffer_name, lock)
+                renderer.set_view(camera, width, height)
+
+            tile_start = time.perf_counter()
+            colors, squares, costs, tile_features = renderer.render_tile(*tile, samples, first_sample)
+            framebuffer.add_tile(*tile, colors, squares, samples, costs, tile_features)
+            busy = time.perf_counter() - tile_start
+
+            # Statistics are sent with every tile, and counted from zero again for the next one
+            counters = None
+            if stats is not None:
+                counters = stats.as_dict()
+                stats.reset()
+            results.put(('tile', worker_id, (tile, busy, (tile[2] - tile[0]) * (tile[3] - tile[1]) * samples, counters)))
+    except Exception:
+        results.put(('error', worker_id, traceback.format_exc()))
+    finally:
+        if framebuffer is not None:
+            framebuffer.close()
+
+
+class SampleBudget:
+    '''Decides how many more samples a tile gets: passes of pass_samples up to samples_per_pixel, but with a threshold above 0
+    a tile stops early once it has min_samples and its estimated relative error is below the threshold'''
+
+    def __init__(self, samples_per_pixel, pass_samples=0, min_samples=16, threshold=0.0):
+        self.samples_per_pixel = samples_per_pixel
+        self.min_samples = min(min_samples, samples_per_pixel)
+        self.threshold = threshold
+        if pass_samples <= 0:
+            # Adaptive sampling needs several passes to measure the error in between
+            pass_samples = self.min_samples if threshold > 0 else samples_per_pixel
+        self.pass_samples = pass_samples
+
+    def next_samples(self, framebuffer, tile):
+        done = int(framebuffer.tile_samples(*tile))
+        remaining = self.samples_per_pixel - done
+        if remaining <= 0:
+            return 0
+        if self.threshold > 0 and done >= self.min_samples and framebuffer.tile_error(*tile) <= self.threshold:
+            return 0
+        if done < self.min_samples:
+            return self.min_samples - done
+        return min(self.pass_samples, remaining)
+
+
+class RenderPool:
+    '''Persistent pool of render processes that receive the scene once and then render any number of jobs (cameras, sample counts, crops)
+
+    With the fork start method the workers inherit the scene copy-on-write, otherwise it is pickled once into shared memory that every
+    worker unpickles from. Tiles are handed out on demand through a shared queue. With instrument set, every worker counts render
+    statistics (see RenderStats), returned in the 'counters' entry of its worker statistics. With heatmap set, the workers also add
+    the render cost of every pixel to the framebuffer, and with features set the albedo, normal and depth of the first hits.
+    '''
+
+    def __init__(self, scene, make_renderer, renderer_args, process_count, instrument=False, heatmap=False, features=False):
+        global _inherited_scene
+        start = time.perf_counter()
+
+        self.process_count = process_count
+        self.instrument = instrument
+        self.lock = Lock()
+        self.tasks = Queue()
+        self.results = Queue()
+        self.job_id = 0
+        self.scene_shm = None
+
+        # Workers attaching to shared memory must all report to this process's resource tracker, or their own trackers would
+        # free the memory when they exit
+        resource_tracker.ensure_running()
+        if get_start_method() == 'fork':
+            _inherited_scene = scene
+            scene_source = None
+        else:
+            payload = pickle.dumps(scene, protocol=pickle.HIGHEST_PROTOCOL)
+            self.scene_shm = SharedMemory(create=True, size=len(payload))
+            self.scene_shm.buf[:len(payload)] = payload
+            scene_source = (self.scene_shm.name, len(payload))
+
+        self.controls = []
+        self.processes = []
+        for i in range(process_count):
+            receiver, sender = Pipe(duplex=False)
+            self.controls.append(sender)
+            self.processes.append(Process(target=render_worker, args=(i, make_renderer, renderer_args, scene_source, self.lock, receiver, self.tasks, self.results, instrument, heatmap, features)))
+        for process in self.processes:
+            process.start()
+
+        # Wait for every worker to have its renderer ready
+        self.setup_times = [0.0] * process_count
+        try:
+            for _ in range(process_count):
+                _, worker_id, setup = self.receive()
+                self.setup_times[worker_id] = setup
+        finally:
+            _inherited_scene = None
+            if self.scene_shm is not None:
+                self.scene_shm.close()
+                self.scene_shm.unlink()
+        self.startup_time = time.perf_counter() - start
+
+    def render(self, camera, framebuffer, budget, tile_size=16, order='scanline', crop=None, checkpoint=None, checkpoint_interval=60.0):
+        '''Render a camera view progressively into a framebuffer (optionally only a crop rectangle of it), returning worker statistics
+
+        Each tile is queued again after every pass for as long as the sample budget gives it more samples, so noisy tiles get more samples
+        than converged ones. Samples already in the framebuffer (for example from a loaded checkpoint) are not rendered again. If a checkpoint
+        filename is given, the framebuffer is saved to it every checkpoint_interval seconds and when the render is done.
+        '''
+        self.job_id += 1
+        # Locks can only reach the workers by inheritance, so the workers attach to the framebuffer by name with the pool's lock
+        framebuffer.lock = self.lock
+        for control in self.controls:
+            control.send((self.job_id, camera, framebuffer.width, framebuffer.height, framebuffer.shm.name))
+
+        # Pixels of a tile can have different sample counts (for example after resuming with another tile size or crop), and a task
+        # numbers the samples of all its pixels from the same first sample, so such tiles are split until their counts agree
+        tiles = [part for tile in make_tiles(framebuffer.width, framebuffer.height, tile_size, order, crop) for part in framebuffer.uniform_tiles(*tile)]
+        stats = [{'worker': i, 'tiles': 0, 'samples': 0, 'busy': 0.0, 'counters': RenderStats() if self.instrument else None} for i in range(self.process_count)]
+        # A crop (or a resume) can leave nothing to render
+        if not tiles:
+            return stats
+
+        outstanding = 0
+        for tile in tiles:
+            samples = budget.next_samples(framebuffer, tile)
+            if samples > 0:
+                self.tasks.put((self.job_id, tile, int(framebuffer.tile_samples(*tile)), samples))
+                outstanding += 1
+
+        tiles_done = len(tiles) - outstanding
+        last_checkpoint = time.perf_counter()
+        print(f'  {tiles_done / len(tiles) * 100:3.1f}%', end='\r')
+
+        while outstanding > 0:
+            if checkpoint and time.perf_counter() - last_checkpoint >= checkpoint_interval:
+                framebuffer.save_checkpoint(checkpoint)
+                last_checkpoint = time.perf_counter()
+
+            message = self.receive(checkpoint_interval if checkpoint else None)
+            if message is None:
+                continue
+            _, worker_id, (tile, busy, samples, counters) = message
+            stats[worker_id]['tiles'] += 1
+            stats[worker_id]['samples'] += samples
+            stats[worker_id]['busy'] += busy
+            if counters is not None:
+                stats[worker_id]['counters'].merge(counters)
+
+            outstanding -= 1
+            samples = budget.next_samples(framebuffer, tile)
+            if samples > 0:
+                self.tasks.put((self.job_id, tile, int(framebuffer.tile_samples(*tile)), samples))
+                outstanding += 1
+            else:
+                tiles_done += 1
+                print(f'  {tiles_done / len(tiles) * 100:3.1f}%', end='\r')
+
+        if checkpoint:
+            framebuffer.save_checkpoint(checkpoint)
+
+        return stats
+
+    def receive(self, timeout=None):
+        '''Next message from the workers, or None if none arrived within timeout seconds
+
+        A worker that reported an error, or exited without one (for example killed), stops the whole pool with a RuntimeError.
+        '''
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        while True:
+            wait = POLL_INTERVAL if deadline is None else max(min(POLL_INTERVAL, deadline - time.perf_counter()), 0.0)
+            try:
+                message = self.results.get(timeout=wait)
+            except Empty:
+                dead = [process for process in self.processes if process.exitcode is not None]
+                if dead:
+                    # An error message sent just before the exit may still be on its way
+                    try:
+                        message = self.results.get(timeout=POLL_INTERVAL)
+                    except Empty:
+                        self.terminate()
+                        raise RuntimeError(f'Render process {self.processes.index(dead[0])} exited with code {dead[0].exitcode}')
+                elif deadline is not None and time.perf_counter() >= deadline:
+                    return None
+                else:
+                    continue
+            if message[0] == 'error':
+                self.terminate()
+                raise RuntimeError(f'Render process {message[1]} failed:\n{message[2]}')
+            return message
+
+    def terminate(self):
+        '''Stop the worker processes at once (after a worker failed, when the others' results are no longer needed)'''
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+        for process in self.processes:
+            process.join()
+
+    def close(self):
+        '''Stop the worker processes'''
+        for _ in self.processes:
+            self.tasks.put(None)
+        for process in self.processes:
+            process.join()
+
+
+def print_utilisation(stats, wall_time):
+    '''Print how much of the wall time each worker spent rendering tiles'''
+    print('Worker utilisation:')
+    for s in stats:
+        print(f'  worker {s["worker"]:2d}: {s["tiles"]:5d} tiles, {s["samples"]:10d} samples, '
+              f'rendering {s["busy"]:8.2f} s ({s["busy"] / wall_time * 100:5.1f}% of wall time)')
+    busy = sum(s['busy'] for s in stats)
+    print(f'  average utilisation {busy / (wall_time * len(stats)) * 100:.1f}%')
+
+
+def print_sample_usage(framebuffer, budget):
+    '''Print how many samples were taken compared to sampling every pixel up to the maximum'''
+    counts = framebuffer.counts
+    total = sum(counts)
+    full = len(counts) * budget.samples_per_pixel
+    print(f'Samples per pixel: {min(counts):.0f} to {max(counts):.0f}, average {total / len(counts):.1f} ({total / full * 100:.1f}% of {budget.samples_per_pixel} per pixel)')
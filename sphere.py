@@ -1,12 +1,13 @@
 # Custom libraries
-from hittable import Hittable, HitRecord
+from hittable import Hittable
 from aabb import AABB
 from vec3 import Vec3
 from onb import ONB
 from ray import Ray
+from sampler import sample_2d
 
 # 3rd party library
-from math import sqrt, atan2, asin, pi
+from math import sqrt, atan2, asin, pi, cos, sin
 
 
 class Sphere(Hittable):
@@ -21,55 +22,126 @@ class Sphere(Hittable):
         output_box.replace_values(AABB(self.c - Vec3(self.r, self.r, self.r), self.c + Vec3(self.r, self.r, self.r)))
         return True
 
-    def hit(self, ray, t_min, t_max, hit_rec):
-        oc = ray.orig - self.c
-        
-        a = ray.dir.length_squared()
-        half_b = oc.dot(ray.dir)
-        c = oc.length_squared() - self.r * self.r
-
-        discriminant = half_b * half_b - a * c
-
-        if discriminant > 0:
-            root = sqrt(discriminant)
-            
-            temp = (-half_b - root) / a
-            if t_min < temp < t_max:
-                hit_rec.t = temp
-                hit_rec.p = ray.at(hit_rec.t)
-                outward_normal = (hit_rec.p - self.c) / self.r
-                get_sphere_uv((hit_rec.p - self.c) / self.r, hit_rec)
-                hit_rec.set_face_normal(ray, outward_normal)
-                hit_rec.mat = self.mat
-                return True
-
-            temp = (-half_b + root) / a
-            if t_min < temp < t_max:
-                hit_rec.t = temp
-                hit_rec.p = ray.at(hit_rec.t)
-                outward_normal = (hit_rec.p - self.c) / self.r
-                get_sphere_uv((hit_rec.p - self.c) / self.r, hit_rec)
-                hit_rec.set_face_normal(ray, outward_normal)
-                hit_rec.mat = self.mat
-                return True
-        return False
+    def intersect(self, ray, t_min, t_max, hit_rec):
+        c = self.c
+        t = hit_sphere(ray, c.x, c.y, c.z, self.r, t_min, t_max)
+        if t is None:
+            return False
+        hit_rec.t = t
+        hit_rec.obj = self
+        hit_rec.inner = None
+        return True
+
+    def occluded(self, ray, t_min, t_max):
+        c = self.c
+        return hit_sphere(ray, c.x, c.y, c.z, self.r, t_min, t_max) is not None
+
+    def surface(self, ray, hit_rec):
+        c = self.c
+        sphere_surface(ray, c.x, c.y, c.z, self.r, self.mat, hit_rec)
 
     def pdf_value(self, o, v):
-        rec = HitRecord()
-        if not self.hit(Ray(o, v), 0.001, float('inf'), rec):
+        if not self.occluded(Ray(o, v), 0.001, float('inf')):
             return 0
-    
-        cos_theta_max = sqrt(1 - self.r * self.r / (self.c - o).length_squared())
-        solid_angle = 2 * pi * (1 - cos_theta_max)
+        return self.light_pdf(o, v)
 
-        return 1 / solid_angle
+    def light_pdf(self, o, v):
+        '''Density of sample_light choosing a direction v from o that hits the sphere'''
+        oc = self.c - o
+        distance_squared = oc.length_squared()
+        r2 = self.r * self.r
+        if distance_squared > r2:
+            # Uniform over the cone of directions the sphere covers, with 1 - cos(theta max) written to keep small spheres exact
+            x = r2 / distance_squared
+            return 1 / (2 * pi * x / (1 + sqrt(1 - x)))
 
-    def random(self, o):
-        direction = self.c - o
-        distance_squared = direction.length_squared()
+        # From inside, uniform by area: the density is converted to solid angle at the point hit
+        length = v.length()
+        b = oc.dot(v) / length
+        t = b + sqrt(max(b * b - distance_squared + r2, 0.0))
+        cosine = abs(t - b) / self.r
+        return t * t / (max(cosine, 1e-12) * 4 * pi * r2)
+
+    def sample_light(self, o):
+        '''Direction (unit length) from o to a point of the sphere chosen uniformly over the cone of directions it covers (or by area
+        from inside it), with its distance and density'''
+        r1, r2 = sample_2d()
+        oc = self.c - o
+        distance_squared = oc.length_squared()
+        r_squared = self.r * self.r
+
+        if distance_squared <= r_squared:
+            z = 1 - 2 * r1
+            r = sqrt(max(1 - z * z, 0.0))
+            phi = 2 * pi * r2
+            normal = Vec3(r * cos(phi), r * sin(phi), z)
+            to_point = oc + self.r * normal
+            distance = to_point.length()
+            direction = to_point / distance
+            cosine = abs(normal.dot(direction))
+            return direction, distance, distance * distance / (max(cosine, 1e-12) * 4 * pi * r_squared)
+
+        x = r_squared / distance_squared
+        one_minus_cos_max = x / (1 + sqrt(1 - x))
+        cos_theta = 1 - r2 * one_minus_cos_max
+        sin_theta = sqrt(max(1 - cos_theta * cos_theta, 0.0))
+        phi = 2 * pi * r1
         uvw = ONB()
-        uvw.build_from_w(direction)
-        return uvw.local(Vec3.random_to_sphere(self.r, distance_squared))
+        uvw.build_from_w(oc)
+        direction = uvw.local(Vec3(cos(phi) * sin_theta, sin(phi) * sin_theta, cos_theta))
+
+        # Distance to the near side of the sphere along the direction
+        distance_center = sqrt(distance_squared)
+        distance = distance_center * cos_theta - sqrt(max(r_squared - distance_squared * sin_theta * sin_theta, 0.0))
+        return direction, distance, 1 / (2 * pi * one_minus_cos_max)
+
+    def random(self, o):
+        return self.sample_light(o)[0]
+
+
+def hit_sphere(ray, cx, cy, cz, r, t_min, t_max):
+    '''Closest distance between t_min and t_max at which a ray hits a sphere given by its center coordinates and radius, or None
+    (shared by Sphere and MovingSphere)'''
+    o = ray.orig
+    d = ray.dir
+    ocx = o.x - cx
+    ocy = o.y - cy
+    ocz = o.z - cz
+
+    a = d.x * d.x + d.y * d.y + d.z * d.z
+    half_b = ocx * d.x + ocy * d.y + ocz * d.z
+    c = ocx * ocx + ocy * ocy + ocz * ocz - r * r
+
+    discriminant = half_b * half_b - a * c
+    if discriminant <= 0:
+        return None
+
+    root = sqrt(discriminant)
+    temp = (-half_b - root) / a
+    if not t_min < temp < t_max:
+        temp = (-half_b + root) / a
+        if not t_min < temp < t_max:
+            return None
+    return temp
+
+
+def sphere_surface(ray, cx, cy, cz, r, mat, hit_rec):
+    '''Fill in the point, normal, UV coordinates and material where a ray hits a sphere at hit_rec.t'''
+    o = ray.orig
+    d = ray.dir
+    t = hit_rec.t
+    px = o.x + t * d.x
+    py = o.y + t * d.y
+    pz = o.z + t * d.z
+    outward_normal = Vec3((px - cx) / r, (py - cy) / r, (pz - cz) / r)
+
+    hit_rec.p = Vec3(px, py, pz)
+    get_sphere_uv(outward_normal, hit_rec)
+    # v runs over half a great circle, and u around a circle of latitude (which shrinks towards the poles)
+    hit_rec.du = 1 / (2 * pi * r * max(sqrt(outward_normal.x * outward_normal.x + outward_normal.z * outward_normal.z), 1e-6))
+    hit_rec.dv = 1 / (pi * r)
+    hit_rec.set_face_normal(ray, outward_normal)
+    hit_rec.mat = mat
 
 
 def get_sphere_uv(p, hit_rec):
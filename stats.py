@@ -0,0 +1,236 @@
+# Custom libraries
+from aabb import AABB
+from bvh import BvhNode, BvhLeaf, LinearBvh
+from sphere import Sphere
+from movingsphere import MovingSphere
+from aarect import xyRect, xzRect, yzRect
+from mesh import TriangleMesh
+from constantmedium import ConstantMedium
+from material import Lambertian, Metal, Dielectric, DiffuseLight, Isotropic
+from pdf import HittablePDF
+from lightlist import LightList
+from perlin import Perlin
+
+# 3rd party libraries
+from collections import defaultdict
+import json
+import sys
+import time
+
+
+# Primitives whose hit tests are counted per type
+PRIMITIVES = (Sphere, MovingSphere, xyRect, xzRect, yzRect, TriangleMesh, ConstantMedium)
+
+# Rectangle types by the axis of their normal, for counting the rectangles of the wavefront engine
+RECT_TYPES = ('yzRect', 'xzRect', 'xyRect')
+
+# Materials whose sampling, scattering density and emission time is measured per type (the older scatter and scattering_pdf are
+# left out, since the default sample and bsdf_value call them and would be timed twice)
+MATERIALS = (Lambertian, Metal, Dielectric, DiffuseLight, Isotropic)
+MATERIAL_METHODS = ('sample', 'bsdf_value', 'bsdf_pdf', 'emitted')
+
+
+class RenderStats:
+    '''Opt-in hot-path counters of one render process: rays per bounce, BVH nodes visited, primitive tests per type and time per material
+
+    Nothing is measured until enable() wraps the hot methods with counting versions, so a render without statistics runs the plain
+    methods. The wrappers are per process, so every render process keeps its own statistics, which are merged afterwards. The
+    wavefront engine counts a BVH node or primitive test for every ray it is done for, like the scalar engine.
+    '''
+
+    def __init__(self):
+        self.counts = defaultdict(int)
+        self.times = defaultdict(float)
+        # Number of rays traced at each bounce (index 0 are camera rays)
+        self.rays = []
+        self.wrapped = []
+
+    def record_rays(self, bounce, count):
+        '''Add rays traced at a bounce'''
+        while len(self.rays) <= bounce:
+            self.rays.append(0)
+        self.rays[bounce] += count
+
+    def record_path(self, length):
+        '''Add one path made of length rays'''
+        for bounce in range(length):
+            self.record_rays(bounce, 1)
+
+    def record_shadow_rays(self, count):
+        '''Add shadow rays traced towards sampled light points'''
+        self.counts['shadow_rays'] += count
+
+    def enable(self):
+        '''Start counting by wrapping the hot methods of all primitives, BVHs, materials, light sampling and Perlin noise'''
+        if self.wrapped:
+            return
+        counts = self.counts
+
+        def counted_linear_bvh_intersect(bvh, ray, t_min, t_max, rec):
+            return bvh.intersect_counted(ray, t_min, t_max, rec, counts)
+
+        def counted_linear_bvh_occluded(bvh, ray, t_min, t_max):
+            return bvh.occluded_counted(ray, t_min, t_max, counts)
+
+        # Closest-hit and any-hit (occlusion) queries are counted together
+        self.wrap(LinearBvh, 'intersect', lambda intersect: counted_linear_bvh_intersect)
+        self.wrap(LinearBvh, 'occluded', lambda occluded: counted_linear_bvh_occluded)
+        for name in ('intersect', 'occluded'):
+            self.wrap(BvhNode, name, lambda method: self.counted(method, 'bvh_nodes'))
+            self.wrap(BvhLeaf, name, lambda method: self.counted(method, 'bvh_nodes'))
+        for cls in PRIMITIVES:
+            self.wrap(cls, 'intersect', lambda method, cls=cls: self.counted(method, f'tests.{cls.__name__}'))
+            # Primitives without their own occlusion test fall back on intersect, which is counted already
+            if 'occluded' in cls.__dict__:
+                self.wrap(cls, 'occluded', lambda method, cls=cls: self.counted(method, f'tests.{cls.__name__}'))
+        self.wrap(AABB, 'hit', lambda hit: self.counted(hit, 'aabb_tests'))
+        for cls in MATERIALS:
+            for name in MATERIAL_METHODS:
+                self.wrap(cls, name, lambda method, cls=cls: self.timed(method, f'material.{cls.__name__}'))
+        self.wrap(HittablePDF, 'value', lambda method: self.timed(method, 'light_sampling'))
+        self.wrap(HittablePDF, 'generate', lambda method: self.timed(method, 'light_sampling'))
+        self.wrap(LightList, 'sample', lambda method: self.timed(method, 'light_sampling'))
+        self.wrap(LightList, 'light_pdf', lambda method: self.timed(method, 'light_sampling'))
+        self.wrap(Perlin, 'turb', lambda method: self.timed(method, 'perlin'))
+
+        # The wavefront engine (which requires NumPy) is only counted when it has been loaded to render
+        wavefront = sys.modules.get('wavefront')
+        if wavefront is not None:
+            self.enable_wavefront(wavefront)
+
+    def enable_wavefront(self, wavefront):
+        '''Count the BVH nodes and primitive tests of the instance groups of the wavefront engine'''
+        import numpy as np
+        counts = self.counts
+        group_class = wavefront.InstanceGroup
+
+        def count_tests(group, kind, local, rays):
+            for k, name in ((wavefront.SPHERE, 'Sphere'), (wavefront.MOVING_SPHERE, 'MovingSphere')):
+                tested = np.count_nonzero(kind == k)
+                if tested:
+                    counts[f'tests.{name}'] += rays * tested
+            axes = group.rect_axes[local[kind == wavefront.RECT], 0]
+            for name, tested in zip(RECT_TYPES, np.bincount(axes, minlength=3)):
+                if tested:
+                    counts[f'tests.{name}'] += rays * int(tested)
+
+        def counted_test_boxes(test_boxes):
+            def counted(group, o, inv_d, t_min, t_best, ray, node):
+                counts['bvh_nodes'] += len(ray)
+                return test_boxes(group, o, inv_d, t_min, t_best, ray, node)
+            return counted
+
+        def counted_intersect_leaves(intersect_leaves):
+            def counted(group, o, d, time, t_min, t_best, prim, ray, node):
+                leaf_counts = group.node_count[node]
+                ends = np.cumsum(leaf_counts)
+                item = np.repeat(group.node_first[node] - ends + leaf_counts, leaf_counts) + np.arange(ends[-1] if len(ends) else 0)
+                count_tests(group, group.item_kind[item], group.item_local[item], 1)
+                return intersect_leaves(group, o, d, time, t_min, t_best, prim, ray, node)
+            return counted
+
+        def counted_intersect_all(intersect_all):
+            def counted(group, o, d, time, t_min, t_best, prim):
+                kind = np.concatenate((np.full(len(group.sph_r), wavefront.SPHERE), np.full(len(group.mov_r), wavefront.MOVING_SPHERE),
+                                       np.full(len(group.rect_k), wavefront.RECT)))
+                local = np.concatenate((np.arange(len(group.sph_r)), np.arange(len(group.mov_r)), np.arange(len(group.rect_k))))
+                count_tests(group, kind, local, len(o))
+                return intersect_all(group, o, d, time, t_min, t_best, prim)
+            return counted
+
+        self.wrap(group_class, 'test_boxes', counted_test_boxes)
+        self.wrap(group_class, 'intersect_leaves', counted_intersect_leaves)
+        self.wrap(group_class, 'intersect_all', counted_intersect_all)
+
+    def disable(self):
+        '''Stop counting by restoring the plain methods'''
+        for cls, name, original in reversed(self.wrapped):
+            if original is None:
+                delattr(cls, name)
+            else:
+                setattr(cls, name, original)
+        self.wrapped = []
+
+    def wrap(self, cls, name, make_wrapper):
+        # Inherited methods are wrapped on the class itself and removed again by disable()
+        self.wrapped.append((cls, name, cls.__dict__.get(name)))
+        setattr(cls, name, make_wrapper(getattr(cls, name)))
+
+    def counted(self, method, key):
+        counts = self.counts
+        def counted_method(*args):
+            counts[key] += 1
+            return method(*args)
+        return counted_method
+
+    def timed(self, method, key):
+        counts = self.counts
+        times = self.times
+        def timed_method(*args):
+            start = time.perf_counter()
+            try:
+                return method(*args)
+            finally:
+                times[key] += time.perf_counter() - start
+                counts[key] += 1
+        return timed_method
+
+    def reset(self):
+        '''Clear all statistics (the methods stay wrapped)'''
+        self.counts.clear()
+        self.times.clear()
+        self.rays = []
+
+    def as_dict(self):
+        return {'counts': dict(self.counts), 'times': dict(self.times), 'rays': list(self.rays)}
+
+    def merge(self, other):
+        '''Add the statistics of another process (as given by as_dict)'''
+        for key, value in other['counts'].items():
+            self.counts[key] += value
+        for key, value in other['times'].items():
+            self.times[key] += value
+        for bounce, count in enumerate(other['rays']):
+            self.record_rays(bounce, count)
+
+    def path_lengths(self):
+        '''Number of paths of each length (in rays), derived from the rays traced per bounce'''
+        rays = self.rays + [0]
+        return {bounce + 1: rays[bounce] - rays[bounce + 1] for bounce in range(len(self.rays)) if rays[bounce] > rays[bounce + 1]}
+
+    def report(self):
+        '''Print all statistics, with counts also given per ray'''
+        camera_rays = self.rays[0] if self.rays else 0
+        shadow_rays = self.counts.get('shadow_rays', 0)
+        total_rays = sum(self.rays)
+        per_ray = 1.0 / (total_rays + shadow_rays) if total_rays else 0.0
+
+        print('Render statistics:')
+        print(f'  camera rays       {camera_rays:12d}')
+        print(f'  secondary rays    {total_rays - camera_rays:12d} ({(total_rays - camera_rays) / max(camera_rays, 1):.2f} per camera ray)')
+        if shadow_rays:
+            print(f'  shadow rays       {shadow_rays:12d} ({shadow_rays / max(camera_rays, 1):.2f} per camera ray)')
+        lengths = self.path_lengths()
+        if lengths:
+            print('  path lengths      ' + ', '.join(f'{length}: {count / camera_rays * 100:.1f}%' for length, count in sorted(lengths.items())))
+
+        for key, label in (('bvh_nodes', 'BVH nodes visited'), ('aabb_tests', 'AABB tests')):
+            count = self.counts.get(key, 0)
+            if count:
+                print(f'  {label:17s} {count:12d} ({count * per_ray:.2f} per ray)')
+
+        tests = {key[6:]: count for key, count in self.counts.items() if key.startswith('tests.')}
+        if tests:
+            print(f'  primitive tests   {sum(tests.values()):12d} ({sum(tests.values()) * per_ray:.2f} per ray)')
+            for name, count in sorted(tests.items(), key=lambda item: -item[1]):
+                print(f'    {name:15s} {count:12d} ({count * per_ray:.2f} per ray)')
+
+        if self.times:
+            print('  time (including nested calls):')
+            for key, seconds in sorted(self.times.items(), key=lambda item: -item[1]):
+                print(f'    {key:24s} {seconds:8.2f} s in {self.counts[key]} calls')
+
+    def write_json(self, filename, workers=()):
+        '''Write the statistics, and optionally those of every worker, to a JSON file'''
+        with open(filename, 'w') as stats_fileobj:
+            json.dump({'total': self.as_dict(), 'path_lengths': self.path_lengths(), 'workers': [w.as_dict() for w in workers]}, stats_fileobj, indent=2)
@@ -5,7 +5,7 @@ from perlin import Perlin
 from utils import clamp
 
 # 3rd party library
-from math import sin
+from math import sin, sqrt, floor, log2
 from PIL import Image # Used for importing image
 
 
@@ -15,7 +15,9 @@ class Texture:
     def __init__(self):
         pass
 
-    def value(self, u, v, p):
+    def value(self, u, v, p, du=0.0, dv=0.0):
+        '''Color at the UV coordinates (u, v) and point p, averaged over a footprint of du by dv in UV units by textures that
+        filter'''
         pass
 
 
@@ -25,7 +27,7 @@ class SolidColor(Texture):
     def __init__(self, color):
         self.color = color
 
-    def value(self, u, v, p):
+    def value(self, u, v, p, du=0.0, dv=0.0):
         return self.color
 
 
@@ -41,12 +43,12 @@ class CheckerTexture(Texture):
             self.odd  = t1
         self.scl = scl
 
-    def value(self, u, v, p):
+    def value(self, u, v, p, du=0.0, dv=0.0):
         sines = sin(self.scl * p.x) * sin(self.scl * p.y) * sin(self.scl * p.z)
         if sines < 0:
-            return self.odd.value(u, v, p)
+            return self.odd.value(u, v, p, du, dv)
         else:
-            return self.even.value(u, v, p)
+            return self.even.value(u, v, p, du, dv)
 
 
 class NoiseTexture(Texture):
@@ -56,18 +58,24 @@ class NoiseTexture(Texture):
         self.noise = Perlin()
         self.scale = scale
 
-    def value(self, u, v, p):
+    def value(self, u, v, p, du=0.0, dv=0.0):
         return Color(1, 1, 1) * 0.5 * (1.0 + sin(self.scale * p.z + 10 * self.noise.turb(p))) # Marble texture using Perlin noise
         #return Color(1, 1, 1) * self.noise.turb(self.scale * p)                # Turbulent Perlin noise
         #return Color(1, 1, 1) * 0.5 * (1.0 + self.noise.noise(self.scale * p)) # Regular Perlin noise
 
 
 class ImageTexture(Texture):
-    '''Image texture, imported with its filename'''
+    '''Image texture, imported with its filename
+
+    The image is decoded once into a mip pyramid: RGB bytes at full resolution and at every halving of it down to one pixel
+    (averaged over boxes of pixels). Lookups over a footprint (du by dv in UV units) are filtered trilinearly between the two
+    levels whose bilinear filters are closest to the footprint in width, or bilinearly for footprints smaller than a texel.
+    Lookups without a footprint (du = dv = 0, like lights looked up at a point) take the nearest texel, as unfiltered lookups.
+    '''
 
     def __init__(self, filename=None):
         if filename is None:
-            self.data = None
+            self.levels = None
             self.width = 0
             self.height = 0
         else:
@@ -75,29 +83,90 @@ class ImageTexture(Texture):
 
     def load_img(self, filename):
         try:
-            self.data = Image.open(filename)
-            self.width, self.height = self.data.size
+            image = Image.open(filename).convert('RGB')
         except:
-            self.data = None
+            self.levels = None
             self.width = 0
             self.height = 0
-
-    def value(self, u, v, p):
-        if self.data is None:
+            return
+
+        self.width, self.height = image.size
+        self.levels = []
+        while True:
+            width, height = image.size
+            self.levels.append((width, height, image.tobytes()))
+            if width == 1 and height == 1:
+                break
+            image = image.resize((max(width // 2, 1), max(height // 2, 1)), Image.BOX)
+
+    def value(self, u, v, p, du=0.0, dv=0.0):
+        if self.levels is None:
             return Color(0, 1, 1)
-        
+
         u = clamp(u, 0.0, 1.0)
         v = 1.0 - clamp(v, 0.0, 1.0)
 
-        i = int(u * self.width)
-        j = int(v * self.height)
-
-        if i >= self.width:
-            i = self.width - 1
-        if j >= self.height:
-            j = self.height - 1
-        
-        scl = 1 / 255
-        r, g, b = self.data.getpixel((i, j))
-
-        return Color(r * scl, g * scl, b * scl)
\ No newline at end of file
+        if du == 0.0 and dv == 0.0:
+            width, height, data = self.levels[0]
+            i = min(int(u * width), width - 1)
+            k = 3 * (min(int(v * height), height - 1) * width + i)
+            scl = 1 / 255
+            return Color(data[k] * scl, data[k + 1] * scl, data[k + 2] * scl)
+
+        # The level of detail is where the bilinear filter, two texels wide, is as wide as the footprint (averaged over both
+        # directions, so footprints stretched along one of them are not blurred in the other)
+        texels = sqrt(du * self.width * dv * self.height) * 0.5
+        if texels <= 1:
+            return Color(*self.bilinear(0, u, v))
+        level = log2(texels)
+        last = len(self.levels) - 1
+        if level >= last:
+            return Color(*self.bilinear(last, u, v))
+
+        lower = int(level)
+        f = level - lower
+        r0, g0, b0 = self.bilinear(lower, u, v)
+        r1, g1, b1 = self.bilinear(lower + 1, u, v)
+        return Color(r0 + f * (r1 - r0), g0 + f * (g1 - g0), b0 + f * (b1 - b0))
+
+    def bilinear(self, level, u, v):
+        '''Color (as r, g, b in [0, 1]) of a mip level at (u, v), interpolated between the four nearest texel centers'''
+        width, height, data = self.levels[level]
+        x = u * width - 0.5
+        y = v * height - 0.5
+        i = floor(x)
+        j = floor(y)
+        fx = x - i
+        fy = y - j
+
+        # Texels beyond the border repeat the border (clamped with branches, which is cheaper than calling min and max)
+        if i < 0:
+            i0 = i1 = 0
+        elif i >= width - 1:
+            i0 = i1 = width - 1
+        else:
+            i0 = i
+            i1 = i + 1
+        row = 3 * width
+        if j < 0:
+            j0 = j1 = 0
+        elif j >= height - 1:
+            j0 = j1 = row * (height - 1)
+        else:
+            j0 = row * j
+            j1 = j0 + row
+        a = j0 + 3 * i0
+        b = j0 + 3 * i1
+        c = j1 + 3 * i0
+        d = j1 + 3 * i1
+
+        gx = 1 - fx
+        s = (1 - fy) * (1 / 255)
+        t = fy * (1 / 255)
+        w00 = gx * s
+        w10 = fx * s
+        w01 = gx * t
+        w11 = fx * t
+        return (data[a] * w00 + data[b] * w10 + data[c] * w01 + data[d] * w11,
+                data[a + 1] * w00 + data[b + 1] * w10 + data[c + 1] * w01 + data[d + 1] * w11,
+                data[a + 2] * w00 + data[b + 2] * w10 + data[c + 2] * w01 + data[d + 2] * w11)
@@ -1,10 +1,23 @@
+# Custom libraries
+from sampler import sample_1d, sample_2d
+
 # 3rd party libraries
 from math import sqrt, pi, cos, sin
-from random import uniform, random
+from random import uniform
+
+
+# Names of the coordinates, for indexing
+AXES = ('x', 'y', 'z')
 
 
 class Vec3:
-    '''3D vector storing XYZ coordinates and multiple helper functions'''
+    '''3D vector storing XYZ coordinates and multiple helper functions
+
+    Vectors use slots instead of a dict, and the in-place operators (+=, -=, *=, /= and add_scaled) change the vector itself instead of
+    creating a new one, so only use them on vectors that are not shared.
+    '''
+
+    __slots__ = ('x', 'y', 'z')
 
     def __init__(self, x=0, y=0, z=0):
         self.x = x
@@ -18,21 +31,10 @@ class Vec3:
         return Vec3(-self.x, -self.y, -self.z)
 
     def __getitem__(self, key):
-        if key == 0:
-            return self.x
-        if key == 1:
-            return self.y
-        if key == 2:
-            return self.z
-        return None
+        return (self.x, self.y, self.z)[key]
 
     def __setitem__(self, key, value):
-        if key == 0:
-            self.x = value
-        if key == 1:
-            self.y = value
-        if key == 2:
-            self.z = value
+        setattr(self, AXES[key], value)
 
     def __add__(self, other):
         return Vec3(self.x + other.x, self.y + other.y, self.z + other.z)
@@ -43,7 +45,6 @@ class Vec3:
     def __mul__(self, other):
         if isinstance(other, Vec3):
             return Vec3(self.x * other.x, self.y * other.y, self.z * other.z)
-        assert not isinstance(other, Vec3)
         return Vec3(self.x * other, self.y * other, self.z * other)
 
     def __rmul__(self, other):
@@ -54,11 +55,57 @@ class Vec3:
             return Vec3(float('NaN'), float('NaN'), float('NaN'))
         return Vec3(self.x / other, self.y / other, self.z / other)
 
+    def __iadd__(self, other):
+        self.x += other.x
+        self.y += other.y
+        self.z += other.z
+        return self
+
+    def __isub__(self, other):
+        self.x -= other.x
+        self.y -= other.y
+        self.z -= other.z
+        return self
+
+    def __imul__(self, other):
+        if isinstance(other, Vec3):
+            self.x *= other.x
+            self.y *= other.y
+            self.z *= other.z
+        else:
+            self.x *= other
+            self.y *= other
+            self.z *= other
+        return self
+
+    def __itruediv__(self, other):
+        if other == 0:
+            self.x = self.y = self.z = float('NaN')
+            return self
+        inv = 1.0 / other
+        self.x *= inv
+        self.y *= inv
+        self.z *= inv
+        return self
+
+    def add_scaled(self, other, scale):
+        '''Add other * scale to this vector in place (fused multiply-add)'''
+        self.x += other.x * scale
+        self.y += other.y * scale
+        self.z += other.z * scale
+        return self
+
+    def set(self, x, y, z):
+        self.x = x
+        self.y = y
+        self.z = z
+        return self
+
     def copy(self):
         return Vec3(self.x, self.y, self.z)
 
     def length(self):
-        return sqrt(self.length_squared())
+        return sqrt(self.x * self.x + self.y * self.y + self.z * self.z)
 
     def length_squared(self):
         return self.x * self.x + self.y * self.y + self.z * self.z
@@ -73,10 +120,14 @@ class Vec3:
         return Vec3(x, y, z)
 
     def unit_vector(self):
-        return self / self.length()
+        length = sqrt(self.x * self.x + self.y * self.y + self.z * self.z)
+        if length == 0:
+            return Vec3(float('NaN'), float('NaN'), float('NaN'))
+        return Vec3(self.x / length, self.y / length, self.z / length)
 
     def reflect(self, other):
-        return self - 2 * self.dot(other) * other
+        scale = 2 * (self.x * other.x + self.y * other.y + self.z * other.z)
+        return Vec3(self.x - scale * other.x, self.y - scale * other.y, self.z - scale * other.z)
     
     def refract(self, other, etai_over_etat):
         cos_theta = (-self).dot(other)
@@ -95,10 +146,13 @@ class Vec3:
 
     @classmethod
     def random_in_unit_sphere(self):
-        while True:
-            p = Vec3.random(-1, 1)
-            if p.length_squared() >= 1: continue
-            return p
+        # A uniform direction at a radius growing with the cube root, so every point takes exactly three sample dimensions
+        r1, r2 = sample_2d()
+        z = 1 - 2 * r1
+        r = sqrt(max(1 - z * z, 0.0))
+        phi = 2 * pi * r2
+        radius = sample_1d() ** (1 / 3)
+        return Vec3(radius * r * cos(phi), radius * r * sin(phi), radius * z)
 
     @classmethod
     def random_unit_vector(self):
@@ -116,16 +170,23 @@ class Vec3:
 
     @classmethod
     def random_in_unit_disk(self):
-        while True:
-            p = Vec3(uniform(-1, 1), uniform(-1, 1), 0)
-            if p.length_squared() >= 1:
-                continue
-            return p
+        # Concentric mapping of the unit square onto the disk (Shirley and Chiu), which keeps stratified samples stratified
+        a, b = sample_2d()
+        a = 2 * a - 1
+        b = 2 * b - 1
+        if a == 0 and b == 0:
+            return Vec3(0, 0, 0)
+        if abs(a) > abs(b):
+            r = a
+            phi = pi / 4 * (b / a)
+        else:
+            r = b
+            phi = pi / 2 - pi / 4 * (a / b)
+        return Vec3(r * cos(phi), r * sin(phi), 0)
 
     @classmethod
     def random_cosine_direction(self):
-        r1 = random()
-        r2 = random()
+        r1, r2 = sample_2d()
         z = sqrt(1 - r2)
 
         phi = 2 * pi * r1
@@ -136,8 +197,7 @@ class Vec3:
 
     @classmethod
     def random_to_sphere(self, radius, distance_squared):
-        r1 = random()
-        r2 = random()
+        r1, r2 = sample_2d()
         z = 1 + r2 * (sqrt(1 - radius * radius / distance_squared) - 1)
 
         phi = 2 * pi * r1
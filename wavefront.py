@@ -0,0 +1,1251 @@
+# Custom libraries
+from hittable import Translate, RotateY, FlipFace
+from instance import Instance
+from hittablelist import HittableList
+from bvh import BvhNode, BvhLeaf, SahBvh, LinearBvh
+from box import Box
+from sphere import Sphere
+from movingsphere import MovingSphere
+from aarect import xyRect, xzRect, yzRect
+from constantmedium import ConstantMedium
+from material import Lambertian, Metal, Dielectric, DiffuseLight, Isotropic
+from texture import SolidColor, CheckerTexture, NoiseTexture, ImageTexture
+from framebuffer import LUMINANCE
+from scene import Scene
+from pdf import power_heuristic
+from lightlist import LightList, SHADOW_EPSILON
+
+# 3rd party libraries
+import numpy as np
+from math import pi
+
+
+# Material kinds
+LAMBERTIAN, METAL, DIELECTRIC, LIGHT, ISOTROPIC = range(5)
+
+# Primitive kinds
+SPHERE, MOVING_SPHERE, RECT = range(3)
+
+# Number of bounces before paths may be ended by Russian roulette
+RUSSIAN_ROULETTE_DEPTH = 3
+
+# Number of rays traced together in one wavefront
+TILE_RAYS = 1 << 16
+
+# Largest number of primitives in a leaf of the BVH of an instance group
+LEAF_SIZE = 4
+
+# Instance groups with at most this many primitives test every ray against all of them instead of building a BVH (a breadth first
+# traversal step costs more than testing a few primitives at once)
+BRUTE_FORCE_SIZE = 32
+
+# Largest number of (ray, primitive) pairs tested at once by groups without a BVH
+PAIR_BUDGET = 1 << 22
+
+
+def vec_to_array(v):
+    '''Convert a Vec3 object to a NumPy array'''
+    return np.array([v.x, v.y, v.z], dtype=np.float64)
+
+
+def dot(a, b):
+    '''Row-wise dot product of two (n, 3) arrays'''
+    return np.einsum('ij,ij->i', a, b)
+
+
+def unit(a):
+    '''Row-wise normalized copy of an (n, 3) array'''
+    return a / np.sqrt(dot(a, a))[:, None]
+
+
+def random_in_unit_sphere(rng, n):
+    '''Uniformly distributed points inside the unit sphere'''
+    d = unit(rng.standard_normal((n, 3)))
+    return d * np.cbrt(rng.random(n))[:, None]
+
+
+def random_in_unit_disk(rng, n):
+    '''Uniformly distributed points inside the unit disk (in the XY-plane)'''
+    r = np.sqrt(rng.random(n))
+    phi = 2 * pi * rng.random(n)
+    return r * np.cos(phi), r * np.sin(phi)
+
+
+def sphere_uv(outward):
+    '''UV coordinates of points on spheres with outward unit normals (like Sphere.get_sphere_uv)'''
+    phi = np.arctan2(outward[:, 2], outward[:, 0])
+    theta = np.arcsin(np.clip(outward[:, 1], -1.0, 1.0))
+    return 1 - (phi + pi) / (2 * pi), (theta + pi / 2) / pi
+
+
+def build_onb(w):
+    '''Build orthonormal bases (u, v, w) around the rows of w, the same way as ONB.build_from_w'''
+    w = unit(w)
+    a = np.zeros_like(w)
+    use_y = np.abs(w[:, 0]) > 0.9
+    a[use_y, 1] = 1.0
+    a[~use_y, 0] = 1.0
+    v = unit(np.cross(w, a))
+    u = np.cross(w, v)
+    return u, v, w
+
+
+def compile_texture(tex):
+    '''Turn a texture object into a function evaluating it for arrays of (u, v, p) and footprints (du, dv) in UV units'''
+    if isinstance(tex, SolidColor):
+        color = vec_to_array(tex.color)
+        return lambda u, v, p, du, dv: np.broadcast_to(color, p.shape)
+
+    if isinstance(tex, CheckerTexture):
+        even = compile_texture(tex.even)
+        odd = compile_texture(tex.odd)
+        scl = tex.scl
+
+        def checker(u, v, p, du, dv):
+            sines = np.sin(scl * p[:, 0]) * np.sin(scl * p[:, 1]) * np.sin(scl * p[:, 2])
+            return np.where((sines < 0)[:, None], odd(u, v, p, du, dv), even(u, v, p, du, dv))
+        return checker
+
+    if isinstance(tex, NoiseTexture):
+        noise = PerlinArrays(tex.noise)
+        scale = tex.scale
+
+        def marble(u, v, p, du, dv):
+            value = 0.5 * (1.0 + np.sin(scale * p[:, 2] + 10 * noise.turb(p)))
+            return np.repeat(value[:, None], 3, axis=1)
+        return marble
+
+    if isinstance(tex, ImageTexture):
+        if tex.levels is None:
+            return lambda u, v, p, du, dv: np.broadcast_to(np.array([0.0, 1.0, 1.0]), p.shape)
+        return MipMapArrays(tex).lookup
+
+    raise ValueError(f'Texture type {type(tex).__name__} is not supported by the wavefront engine')
+
+
+class PerlinArrays:
+    '''Array copy of a Perlin noise generator, evaluating noise for many points at once'''
+
+    def __init__(self, perlin):
+        self.ranvec = np.array([vec_to_array(v) for v in perlin.ranvec])
+        self.perm_x = np.array(perlin.perm_x, dtype=np.int64)
+        self.perm_y = np.array(perlin.perm_y, dtype=np.int64)
+        self.perm_z = np.array(perlin.perm_z, dtype=np.int64)
+
+    def noise(self, p):
+        floored = np.floor(p)
+        frac = p - floored
+        i, j, k = floored.astype(np.int64).T
+        u, v, w = frac.T
+
+        uu = u * u * (3 - 2 * u)
+        vv = v * v * (3 - 2 * v)
+        ww = w * w * (3 - 2 * w)
+
+        accum = np.zeros(len(p))
+        for di in range(2):
+            for dj in range(2):
+                for dk in range(2):
+                    c = self.ranvec[self.perm_x[(i + di) & 255] ^ self.perm_y[(j + dj) & 255] ^ self.perm_z[(k + dk) & 255]]
+                    weight = (di * uu + (1 - di) * (1 - uu)) * (dj * vv + (1 - dj) * (1 - vv)) * (dk * ww + (1 - dk) * (1 - ww))
+                    accum += weight * (c[:, 0] * (u - di) + c[:, 1] * (v - dj) + c[:, 2] * (w - dk))
+        return accum
+
+    def turb(self, p, depth=7):
+        accum = np.zeros(len(p))
+        temp_p = p.copy()
+        weight = 1.0
+
+        for _ in range(depth):
+            accum += weight * self.noise(temp_p)
+            weight *= 0.5
+            temp_p *= 2
+
+        return np.abs(accum)
+
+
+class MipMapArrays:
+    '''Mip pyramid of an ImageTexture stored as one flat byte array, with trilinear (or, without a footprint, nearest texel)
+    lookups for arrays of coordinates like ImageTexture.value'''
+
+    def __init__(self, tex):
+        self.width = tex.width
+        self.height = tex.height
+        self.widths = np.array([level[0] for level in tex.levels], dtype=np.int64)
+        self.heights = np.array([level[1] for level in tex.levels], dtype=np.int64)
+        self.offsets = np.concatenate(([0], np.cumsum(3 * self.widths * self.heights)[:-1]))
+        self.texels = np.frombuffer(b''.join(level[2] for level in tex.levels), dtype=np.uint8)
+
+    def lookup(self, u, v, p, du, dv):
+        u = np.clip(u, 0.0, 1.0)
+        v = 1.0 - np.clip(v, 0.0, 1.0)
+        last = len(self.widths) - 1
+        # Level of detail chosen like ImageTexture.value
+        texels = np.sqrt(du * self.width * dv * self.height) * 0.5
+        level = np.minimum(np.log2(np.maximum(texels, 1.0)), last)
+        lower = level.astype(np.int64)
+        f = (level - lower)[:, None]
+        color = (1 - f) * self.bilinear(lower, u, v) + f * self.bilinear(np.minimum(lower + 1, last), u, v)
+
+        # Lookups without a footprint take the nearest texel
+        point = np.flatnonzero((du == 0) & (dv == 0))
+        i = np.minimum((u[point] * self.width).astype(np.int64), self.width - 1)
+        j = np.minimum((v[point] * self.height).astype(np.int64), self.height - 1)
+        color[point] = self.texels[(3 * (j * self.width + i))[:, None] + np.arange(3)] / 255
+        return color
+
+    def bilinear(self, level, u, v):
+        '''Colors of mip levels (one per coordinate) at (u, v), interpolated between the four nearest texel centers'''
+        width = self.widths[level]
+        height = self.heights[level]
+        base = self.offsets[level][:, None] + np.arange(3)
+        x = u * width - 0.5
+        y = v * height - 0.5
+        i = np.floor(x).astype(np.int64)
+        j = np.floor(y).astype(np.int64)
+        fx = (x - i)[:, None]
+        fy = (y - j)[:, None]
+
+        # Texels beyond the border repeat the border
+        i0 = np.clip(i, 0, width - 1)
+        i1 = np.clip(i + 1, 0, width - 1)
+        j0 = np.clip(j, 0, height - 1)
+        j1 = np.clip(j + 1, 0, height - 1)
+        texel = lambda i, j: self.texels[base + (3 * (j * width + i))[:, None]]
+        top = (1 - fx) * texel(i0, j0) + fx * texel(i1, j0)
+        bottom = (1 - fx) * texel(i0, j1) + fx * texel(i1, j1)
+        return ((1 - fy) * top + fy * bottom) / 255
+
+
+class MaterialTable:
+    '''Material parameters of a scene stored as arrays indexed by material id'''
+
+    def __init__(self):
+        self.index = {}
+        self.kinds = []
+        self.colors = []
+        self.textures = []
+        self.fuzz = []
+        self.ref_idx = []
+
+    def add(self, mat):
+        key = id(mat)
+        if key in self.index:
+            return self.index[key]
+
+        color, texture, fuzz, ref_idx = (0.0, 0.0, 0.0), None, 0.0, 1.0
+        if isinstance(mat, Lambertian):
+            kind, texture = LAMBERTIAN, mat.a
+        elif isinstance(mat, Metal):
+            kind, color, fuzz = METAL, vec_to_array(mat.a), mat.fuzz
+        elif isinstance(mat, Dielectric):
+            kind, ref_idx = DIELECTRIC, mat.ref_idx
+        elif isinstance(mat, DiffuseLight):
+            kind, texture = LIGHT, mat.emit
+        elif isinstance(mat, Isotropic):
+            kind, texture = ISOTROPIC, mat.albedo
+        else:
+            raise ValueError(f'Material type {type(mat).__name__} is not supported by the wavefront engine')
+
+        # Solid colors are looked up from the color table, other textures are evaluated per material
+        if isinstance(texture, SolidColor):
+            color, texture = vec_to_array(texture.color), None
+
+        self.index[key] = len(self.kinds)
+        self.kinds.append(kind)
+        self.colors.append(color)
+        self.textures.append(None if texture is None else compile_texture(texture))
+        self.fuzz.append(fuzz)
+        self.ref_idx.append(ref_idx)
+        return self.index[key]
+
+    def finalize(self):
+        self.kinds = np.array(self.kinds, dtype=np.int64)
+        self.colors = np.array(self.colors, dtype=np.float64).reshape(-1, 3)
+        self.fuzz = np.array(self.fuzz, dtype=np.float64)
+        self.ref_idx = np.array(self.ref_idx, dtype=np.float64)
+        self.textured = [i for i, tex in enumerate(self.textures) if tex is not None]
+
+    def color(self, mat, u, v, p, du, dv):
+        '''Albedo (or emitted color) of materials mat at the given surface coordinates, filtered over footprints du by dv'''
+        color = self.colors[mat]
+        for i in self.textured:
+            mask = mat == i
+            if mask.any():
+                color[mask] = self.textures[i](u[mask], v[mask], p[mask], du[mask], dv[mask])
+        return color
+
+
+class InstanceGroup:
+    '''Primitives sharing one affine transform (object space to world space), stored as arrays with a BVH over them if there are
+    more than BRUTE_FORCE_SIZE (smaller groups test every ray against every primitive)
+
+    The BVH is traversed breadth first for all rays at once: every step tests the boxes of all (ray, node) pairs still open, the
+    primitives of the leaves hit, and opens the children of the inner nodes hit. Rays only visit the nodes their closest hit so far
+    does not rule out, instead of being tested against every primitive.
+    '''
+
+    def __init__(self, matrix, offset):
+        self.matrix = matrix
+        self.offset = offset
+        self.inverse = np.linalg.inv(matrix)
+        self.identity = np.array_equal(matrix, np.eye(3)) and not offset.any()
+        self.length_scale = abs(np.linalg.det(matrix)) ** (1 / 3)
+
+        self.spheres = []
+        self.moving = []
+        self.rects = []
+
+    def finalize(self):
+        spheres = np.array(self.spheres, dtype=np.float64).reshape(-1, 5)
+        self.sph_c = spheres[:, 0:3]
+        self.sph_r = spheres[:, 3]
+        self.sph_id = spheres[:, 4].astype(np.int64)
+        self.sph_c2 = np.einsum('ij,ij->i', self.sph_c, self.sph_c) - self.sph_r * self.sph_r
+
+        moving = np.array(self.moving, dtype=np.float64).reshape(-1, 10)
+        self.mov_c0 = moving[:, 0:3]
+        self.mov_c1 = moving[:, 3:6]
+        self.mov_t0 = moving[:, 6]
+        self.mov_t1 = moving[:, 7]
+        self.mov_r = moving[:, 8]
+        self.mov_id = moving[:, 9].astype(np.int64)
+
+        rects = np.array(self.rects, dtype=np.float64).reshape(-1, 9)
+        self.rect_axes = rects[:, 0:3].astype(np.int64)
+        self.rect_lo = rects[:, 3:5]
+        self.rect_hi = rects[:, 5:7]
+        self.rect_k = rects[:, 7]
+        self.rect_id = rects[:, 8].astype(np.int64)
+
+        self.primitive_count = len(self.sph_r) + len(self.mov_r) + len(self.rect_k)
+        self.has_bvh = self.primitive_count > BRUTE_FORCE_SIZE
+        if self.has_bvh:
+            self.build_bvh()
+
+    def to_local(self, o, d):
+        if self.identity:
+            return o, d
+        return (o - self.offset) @ self.inverse.T, d @ self.inverse.T
+
+    def bounds(self):
+        '''Object space boxes (lo, hi) of the spheres, moving spheres (over times 0 to 1, like MovingSphere) and rectangles'''
+        r = self.sph_r[:, None]
+        sph_lo, sph_hi = self.sph_c - r, self.sph_c + r
+
+        r = self.mov_r[:, None]
+        span = (self.mov_c1 - self.mov_c0) / (self.mov_t1 - self.mov_t0)[:, None]
+        start = self.mov_c0 - self.mov_t0[:, None] * span
+        end = start + span
+        mov_lo, mov_hi = np.minimum(start, end) - r, np.maximum(start, end) + r
+
+        # Rectangles are padded a little along their normal, like their bounding_box
+        rows = np.arange(len(self.rect_k))
+        rect_lo = np.zeros((len(rows), 3))
+        rect_hi = np.zeros((len(rows), 3))
+        axes = self.rect_axes
+        rect_lo[rows, axes[:, 0]] = self.rect_k - 0.0001
+        rect_hi[rows, axes[:, 0]] = self.rect_k + 0.0001
+        rect_lo[rows, axes[:, 1]] = self.rect_lo[:, 0]
+        rect_hi[rows, axes[:, 1]] = self.rect_hi[:, 0]
+        rect_lo[rows, axes[:, 2]] = self.rect_lo[:, 1]
+        rect_hi[rows, axes[:, 2]] = self.rect_hi[:, 1]
+
+        return np.concatenate((sph_lo, mov_lo, rect_lo)), np.concatenate((sph_hi, mov_hi, rect_hi))
+
+    def build_bvh(self):
+        '''Build the BVH over all primitives of the group (median splits along the widest axis of their centers) as flat arrays
+
+        Nodes are stored depth first, so the left child of an inner node follows it and node_right holds its right child. Leaves
+        hold node_count items from node_first on in the item arrays (kind, index in the arrays of that kind and primitive id).
+        '''
+        kinds = np.concatenate((np.full(len(self.sph_r), SPHERE), np.full(len(self.mov_r), MOVING_SPHERE), np.full(len(self.rect_k), RECT)))
+        local = np.concatenate((np.arange(len(self.sph_r)), np.arange(len(self.mov_r)), np.arange(len(self.rect_k))))
+        ids = np.concatenate((self.sph_id, self.mov_id, self.rect_id))
+        lo, hi = self.bounds()
+        centers = (lo + hi) / 2
+        order = np.arange(len(kinds))
+        node_lo, node_hi, node_first, node_count, node_right = [], [], [], [], []
+
+        def build(start, end):
+            node = len(node_first)
+            items = order[start:end]
+            node_lo.append(lo[items].min(axis=0))
+            node_hi.append(hi[items].max(axis=0))
+            node_first.append(start)
+            node_count.append(end - start)
+            node_right.append(-1)
+            if end - start > LEAF_SIZE:
+                c = centers[items]
+                axis = np.argmax(c.max(axis=0) - c.min(axis=0))
+                mid = (end - start) // 2
+                order[start:end] = items[np.argpartition(c[:, axis], mid)]
+                node_count[node] = 0
+                build(start, start + mid)
+                node_right[node] = build(start + mid, end)
+            return node
+
+        if len(order):
+            build(0, len(order))
+        self.node_lo = np.array(node_lo, dtype=np.float64).reshape(-1, 3)
+        self.node_hi = np.array(node_hi, dtype=np.float64).reshape(-1, 3)
+        self.node_first = np.array(node_first, dtype=np.int64)
+        self.node_count = np.array(node_count, dtype=np.int64)
+        self.node_right = np.array(node_right, dtype=np.int64)
+        self.item_kind = kinds[order]
+        self.item_local = local[order]
+        self.item_id = ids[order]
+
+    def intersect(self, o, d, time, t_min, t_best, prim, any_hit=False):
+        '''Update the closest hit distances t_best and primitive ids prim in place (with any_hit, rays that have a hit in prim
+        already are skipped, and rays stop at the first hit found, which need not be the closest)'''
+        if self.primitive_count == 0:
+            return
+        o, d = self.to_local(o, d)
+        if not self.has_bvh:
+            if not any_hit:
+                self.intersect_all(o, d, time, t_min, t_best, prim)
+                return
+            ray = np.flatnonzero(prim < 0)
+            ray_t, ray_prim = t_best[ray], prim[ray]
+            self.intersect_all(o[ray], d[ray], time[ray], t_min[ray], ray_t, ray_prim)
+            t_best[ray], prim[ray] = ray_t, ray_prim
+            return
+
+        ray = np.flatnonzero(prim < 0) if any_hit else np.arange(len(o))
+        node = np.zeros(len(ray), dtype=np.int64)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            inv_d = 1 / d
+            while len(ray):
+                hit = self.test_boxes(o, inv_d, t_min, t_best, ray, node)
+                ray, node = ray[hit], node[hit]
+
+                leaf = self.node_count[node] > 0
+                self.intersect_leaves(o, d, time, t_min, t_best, prim, ray[leaf], node[leaf])
+                ray, node = ray[~leaf], node[~leaf]
+                if any_hit:
+                    open_ = prim[ray] < 0
+                    ray, node = ray[open_], node[open_]
+                ray = np.concatenate((ray, ray))
+                node = np.concatenate((node + 1, self.node_right[node]))
+
+    def test_boxes(self, o, inv_d, t_min, t_best, ray, node):
+        '''Slab test of the boxes of (ray, node) pairs against the rays' open intervals (NaNs from rays in the plane of a slab with a
+        zero direction component are ignored)'''
+        near = (self.node_lo[node] - o[ray]) * inv_d[ray]
+        far = (self.node_hi[node] - o[ray]) * inv_d[ray]
+        t_near = np.fmax.reduce(np.fmin(near, far), axis=1)
+        t_far = np.fmin.reduce(np.fmax(near, far), axis=1)
+        return (t_near <= t_far) & (t_far >= t_min[ray]) & (t_near <= t_best[ray])
+
+    def intersect_leaves(self, o, d, time, t_min, t_best, prim, ray, node):
+        '''Test the rays of (ray, leaf node) pairs against every primitive of their leaf'''
+        counts = self.node_count[node]
+        ray = np.repeat(ray, counts)
+        ends = np.cumsum(counts)
+        item = np.repeat(self.node_first[node] - ends + counts, counts) + np.arange(len(ray))
+        kind = self.item_kind[item]
+        local = self.item_local[item]
+        t = np.full(len(ray), np.inf)
+
+        sel = np.flatnonzero(kind == SPHERE)
+        if len(sel):
+            r, s = ray[sel], local[sel]
+            oc = o[r] - self.sph_c[s]
+            dr = d[r]
+            t[sel] = self.solve_sphere(dot(dr, dr), dot(oc, dr), dot(oc, oc) - self.sph_r[s] ** 2, t_min[r], t_best[r])
+
+        sel = np.flatnonzero(kind == MOVING_SPHERE)
+        if len(sel):
+            r, s = ray[sel], local[sel]
+            frac = (time[r] - self.mov_t0[s]) / (self.mov_t1[s] - self.mov_t0[s])
+            oc = o[r] - (self.mov_c0[s] + frac[:, None] * (self.mov_c1[s] - self.mov_c0[s]))
+            dr = d[r]
+            t[sel] = self.solve_sphere(dot(dr, dr), dot(oc, dr), dot(oc, oc) - self.mov_r[s] ** 2, t_min[r], t_best[r])
+
+        sel = np.flatnonzero(kind == RECT)
+        if len(sel):
+            r, s = ray[sel], local[sel]
+            axes = self.rect_axes[s]
+            rows = np.arange(len(sel))
+            or_, dr = o[r], d[r]
+            t_rect = (self.rect_k[s] - or_[rows, axes[:, 0]]) / dr[rows, axes[:, 0]]
+            pa = or_[rows, axes[:, 1]] + t_rect * dr[rows, axes[:, 1]]
+            pb = or_[rows, axes[:, 2]] + t_rect * dr[rows, axes[:, 2]]
+            lo = self.rect_lo[s]
+            hi = self.rect_hi[s]
+            valid = (t_rect >= t_min[r]) & (t_rect <= t_best[r]) & (pa >= lo[:, 0]) & (pa <= hi[:, 0]) & (pb >= lo[:, 1]) & (pb <= hi[:, 1])
+            t[sel] = np.where(valid, t_rect, np.inf)
+
+        # Closest hit per ray (a ray can hit several primitives of its leaves in one step)
+        hit = t < t_best[ray]
+        ray, t, ids = ray[hit], t[hit], self.item_id[item[hit]]
+        np.minimum.at(t_best, ray, t)
+        won = t == t_best[ray]
+        prim[ray[won]] = ids[won]
+
+    def intersect_all(self, o, d, time, t_min, t_best, prim):
+        '''Test every ray against every primitive (in object space), in chunks of at most PAIR_BUDGET pairs'''
+        chunk = max(1, PAIR_BUDGET // max(len(o), 1))
+        a = dot(d, d)[:, None]
+        t_lo = t_min[:, None]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for start in range(0, len(self.sph_r), chunk):
+                sl = slice(start, start + chunk)
+                c = self.sph_c[sl]
+                # |o - c|^2 - r^2 and (o - c).d expanded into matrix products
+                half_b = dot(o, d)[:, None] - d @ c.T
+                cc = dot(o, o)[:, None] - 2 * (o @ c.T) + self.sph_c2[sl]
+                t = self.solve_sphere(a, half_b, cc, t_lo, t_best[:, None])
+                self.keep_closest(t, self.sph_id[sl], t_best, prim)
+
+            for start in range(0, len(self.mov_r), chunk):
+                sl = slice(start, start + chunk)
+                frac = (time[:, None] - self.mov_t0[sl]) / (self.mov_t1[sl] - self.mov_t0[sl])
+                oc = o[:, None, :] - (self.mov_c0[sl] + frac[:, :, None] * (self.mov_c1[sl] - self.mov_c0[sl]))
+                half_b = np.einsum('isk,ik->is', oc, d)
+                cc = np.einsum('isk,isk->is', oc, oc) - self.mov_r[sl] ** 2
+                t = self.solve_sphere(a, half_b, cc, t_lo, t_best[:, None])
+                self.keep_closest(t, self.mov_id[sl], t_best, prim)
+
+            for start in range(0, len(self.rect_k), chunk):
+                sl = slice(start, start + chunk)
+                axes = self.rect_axes[sl]
+                t = (self.rect_k[sl] - o[:, axes[:, 0]]) / d[:, axes[:, 0]]
+                pa = o[:, axes[:, 1]] + t * d[:, axes[:, 1]]
+                pb = o[:, axes[:, 2]] + t * d[:, axes[:, 2]]
+                lo = self.rect_lo[sl]
+                hi = self.rect_hi[sl]
+                valid = (t >= t_lo) & (t <= t_best[:, None]) & (pa >= lo[:, 0]) & (pa <= hi[:, 0]) & (pb >= lo[:, 1]) & (pb <= hi[:, 1])
+                self.keep_closest(np.where(valid, t, np.inf), self.rect_id[sl], t_best, prim)
+
+    @staticmethod
+    def keep_closest(t, ids, t_best, prim):
+        '''Keep the closest of a (ray, primitive) matrix of hit distances where it is closer than t_best'''
+        if t.shape[1] == 0:
+            return
+        best = np.argmin(t, axis=1)
+        t_hit = t[np.arange(len(t)), best]
+        closer = t_hit < t_best
+        t_best[closer] = t_hit[closer]
+        prim[closer] = ids[best[closer]]
+
+    @staticmethod
+    def solve_sphere(a, half_b, cc, t_lo, t_hi):
+        discriminant = half_b * half_b - a * cc
+        root = np.sqrt(np.maximum(discriminant, 0.0))
+        near = (-half_b - root) / a
+        far = (-half_b + root) / a
+        t = np.where((near > t_lo) & (near < t_hi), near, np.where((far > t_lo) & (far < t_hi), far, np.inf))
+        return np.where(discriminant > 0, t, np.inf)
+
+
+class Geometry:
+    '''Flattened set of primitives (grouped by transform) with closest-hit queries for arrays of rays'''
+
+    def __init__(self, materials):
+        self.materials = materials
+        self.groups = {}
+        self.kinds = []
+        self.group_of = []
+        self.local = []
+        self.mats = []
+        self.flips = []
+        self.media = []
+
+    def group(self, matrix, offset):
+        key = (matrix.tobytes(), offset.tobytes())
+        if key not in self.groups:
+            self.groups[key] = InstanceGroup(matrix, offset)
+        return self.groups[key]
+
+    def add_primitive(self, kind, group, values, mat, flip):
+        prim_id = len(self.kinds)
+        storage = {SPHERE: group.spheres, MOVING_SPHERE: group.moving, RECT: group.rects}[kind]
+        self.kinds.append(kind)
+        self.group_of.append(group)
+        self.local.append(len(storage))
+        self.mats.append(self.materials.add(mat))
+        self.flips.append(flip)
+        storage.append(values + [prim_id])
+
+    def add(self, obj, matrix=None, offset=None, flip=False):
+        '''Flatten a hittable object graph into this geometry'''
+        if matrix is None:
+            matrix, offset = np.eye(3), np.zeros(3)
+
+        if isinstance(obj, (HittableList, BvhLeaf)):
+            for child in obj.objects:
+                self.add(child, matrix, offset, flip)
+        elif isinstance(obj, LinearBvh):
+            for child in obj.primitives:
+                self.add(child, matrix, offset, flip)
+        elif isinstance(obj, SahBvh):
+            self.add(obj.root, matrix, offset, flip)
+        elif isinstance(obj, BvhNode):
+            self.add(obj.left, matrix, offset, flip)
+            if obj.right is not obj.left:
+                self.add(obj.right, matrix, offset, flip)
+        elif isinstance(obj, Box):
+            for side in obj.sides:
+                self.add(side, matrix, offset, flip)
+        elif isinstance(obj, Translate):
+            self.add(obj.obj, matrix, offset + matrix @ vec_to_array(obj.offset), flip)
+        elif isinstance(obj, RotateY):
+            rotation = np.array([[obj.cos_theta, 0, obj.sin_theta], [0, 1, 0], [-obj.sin_theta, 0, obj.cos_theta]])
+            self.add(obj.obj, matrix @ rotation, offset, flip)
+        elif isinstance(obj, Instance):
+            rows = np.array(obj.transform.rows())
+            self.add(obj.obj, matrix @ rows[:3, :3], offset + matrix @ rows[:3, 3], flip)
+        elif isinstance(obj, FlipFace):
+            self.add(obj.p, matrix, offset, not flip)
+        elif isinstance(obj, ConstantMedium):
+            boundary = Geometry(self.materials)
+            boundary.add(obj.boundary, matrix, offset, flip)
+            boundary.finalize()
+            self.media.append((boundary, obj.neg_inv_density, self.materials.add(obj.phase_function)))
+        elif isinstance(obj, Sphere):
+            group = self.group(matrix, offset)
+            self.add_primitive(SPHERE, group, [obj.c.x, obj.c.y, obj.c.z, obj.r], obj.mat, flip)
+        elif isinstance(obj, MovingSphere):
+            group = self.group(matrix, offset)
+            values = [obj.center0.x, obj.center0.y, obj.center0.z, obj.center1.x, obj.center1.y, obj.center1.z, obj.time0, obj.time1, obj.r]
+            self.add_primitive(MOVING_SPHERE, group, values, obj.mat, flip)
+        elif isinstance(obj, (xyRect, xzRect, yzRect)):
+            group = self.group(matrix, offset)
+            self.add_primitive(RECT, group, rect_values(obj), obj.mat, flip)
+        else:
+            raise ValueError(f'Hittable type {type(obj).__name__} is not supported by the wavefront engine')
+
+    def finalize(self):
+        self.group_list = list(self.groups.values())
+        for group in self.group_list:
+            group.finalize()
+
+        group_index = {id(group): i for i, group in enumerate(self.group_list)}
+        self.kinds = np.array(self.kinds, dtype=np.int64)
+        self.group_of = np.array([group_index[id(group)] for group in self.group_of], dtype=np.int64)
+        self.local = np.array(self.local, dtype=np.int64)
+        self.mats = np.array(self.mats, dtype=np.int64)
+        self.flips = np.array(self.flips, dtype=bool)
+
+    def intersect(self, o, d, time, t_min, t_max):
+        '''Find the closest hit distance and primitive id (-1 on a miss) for every ray'''
+        t_best = np.array(np.broadcast_to(t_max, len(o)), dtype=np.float64)
+        t_min = np.array(np.broadcast_to(t_min, len(o)), dtype=np.float64)
+        prim = np.full(len(o), -1, dtype=np.int64)
+        for group in self.group_list:
+            group.intersect(o, d, time, t_min, t_best, prim)
+        return t_best, prim
+
+    def occluded(self, o, d, time, t_min, t_max):
+        '''Whether every ray hits anything between t_min and t_max (stopping at the first hit found, like Hittable.occluded)'''
+        t_best = np.array(np.broadcast_to(t_max, len(o)), dtype=np.float64)
+        t_min = np.array(np.broadcast_to(t_min, len(o)), dtype=np.float64)
+        prim = np.full(len(o), -1, dtype=np.int64)
+        for group in self.group_list:
+            group.intersect(o, d, time, t_min, t_best, prim, any_hit=True)
+        return prim >= 0
+
+    def surface(self, o, d, time, t, prim):
+        '''Compute the hit point, face normal, front face flag, UV coordinates and their rates (change per unit of length, like
+        HitRecord.du and dv) for hit primitives'''
+        n = len(prim)
+        p = o + t[:, None] * d
+        normal = np.zeros((n, 3))
+        u = np.zeros(n)
+        v = np.zeros(n)
+        du = np.zeros(n)
+        dv = np.zeros(n)
+
+        group_ids = self.group_of[prim]
+        for gi in np.unique(group_ids):
+            group = self.group_list[gi]
+            in_group = np.flatnonzero(group_ids == gi)
+            local_o, local_d = group.to_local(o[in_group], d[in_group])
+            local_p = local_o + t[in_group, None] * local_d
+            local_n = np.zeros((len(in_group), 3))
+            kinds = self.kinds[prim[in_group]]
+            idx = self.local[prim[in_group]]
+
+            for kind in (SPHERE, MOVING_SPHERE):
+                sel = kinds == kind
+                if not sel.any():
+                    continue
+                if kind == SPHERE:
+                    center = group.sph_c[idx[sel]]
+                    radius = group.sph_r[idx[sel]]
+                else:
+                    frac = (time[in_group][sel] - group.mov_t0[idx[sel]]) / (group.mov_t1[idx[sel]] - group.mov_t0[idx[sel]])
+                    center = group.mov_c0[idx[sel]] + frac[:, None] * (group.mov_c1[idx[sel]] - group.mov_c0[idx[sel]])
+                    radius = group.mov_r[idx[sel]]
+                outward = (local_p[sel] - center) / radius[:, None]
+                local_n[sel] = outward
+                u[in_group[sel]], v[in_group[sel]] = sphere_uv(outward)
+                du[in_group[sel]] = 1 / (2 * pi * radius * np.maximum(np.hypot(outward[:, 0], outward[:, 2]), 1e-6))
+                dv[in_group[sel]] = 1 / (pi * radius)
+
+            sel = kinds == RECT
+            if sel.any():
+                rect = idx[sel]
+                axes = group.rect_axes[rect]
+                rows = np.arange(len(rect))
+                lo = group.rect_lo[rect]
+                hi = group.rect_hi[rect]
+                sel_p = local_p[sel]
+                u[in_group[sel]] = (sel_p[rows, axes[:, 1]] - lo[:, 0]) / (hi[:, 0] - lo[:, 0])
+                v[in_group[sel]] = (sel_p[rows, axes[:, 2]] - lo[:, 1]) / (hi[:, 1] - lo[:, 1])
+                du[in_group[sel]] = 1 / (hi[:, 0] - lo[:, 0])
+                dv[in_group[sel]] = 1 / (hi[:, 1] - lo[:, 1])
+                rect_n = np.zeros((len(rect), 3))
+                rect_n[rows, axes[:, 0]] = 1.0
+                local_n[sel] = rect_n
+
+            normal[in_group] = local_n if group.identity else unit(local_n @ group.inverse)
+            du[in_group] /= group.length_scale
+            dv[in_group] /= group.length_scale
+
+        front_face = dot(d, normal) < 0
+        normal = np.where(front_face[:, None], normal, -normal)
+        front_face ^= self.flips[prim]
+        return p, normal, front_face, u, v, du, dv
+
+
+def rect_values(rect):
+    '''Array row (normal axis, two in-plane axes, bounds, plane offset) for an axis-aligned rectangle'''
+    if isinstance(rect, xyRect):
+        return [2, 0, 1, rect.x0, rect.y0, rect.x1, rect.y1, rect.k]
+    if isinstance(rect, xzRect):
+        return [1, 0, 2, rect.x0, rect.z0, rect.x1, rect.z1, rect.k]
+    return [0, 1, 2, rect.y0, rect.z0, rect.y1, rect.z1, rect.k]
+
+
+class LightTable:
+    '''Lights (rectangles and spheres) stored as arrays for vectorized light sampling and PDF evaluation, chosen by power with the
+    alias table of a LightList, with their emission looked up in a material table'''
+
+    def __init__(self, lights, materials):
+        if not isinstance(lights, LightList):
+            lights = LightList(list(lights.objects))
+        self.materials = materials
+        rects = []
+        spheres = []
+        kinds = []
+        mats = []
+        flips = []
+        for light, obj in zip(lights.objects, lights.shapes):
+            flip = False
+            while isinstance(light, FlipFace):
+                light, flip = light.p, not flip
+            mats.append(materials.add(obj.mat))
+            flips.append(flip)
+            if isinstance(obj, (xyRect, xzRect, yzRect)):
+                rects.append(rect_values(obj))
+                kinds.append(0)
+            elif isinstance(obj, Sphere):
+                spheres.append([obj.c.x, obj.c.y, obj.c.z, obj.r])
+                kinds.append(1)
+            else:
+                raise ValueError(f'Light type {type(obj).__name__} is not supported by the wavefront engine')
+
+        # Light i of the list is entry order[i] of the arrays, which hold the rectangles first
+        kinds = np.array(kinds, dtype=np.int64)
+        order = np.argsort(kinds, kind='stable').argsort()
+        pdfs = np.array(lights.pdfs)
+        self.select_pdf = np.empty(len(order))
+        self.select_pdf[order] = pdfs
+        self.alias_prob = np.array(lights.table.prob)
+        self.alias_own = order
+        self.alias_other = order[np.array(lights.table.alias, dtype=np.int64)]
+        self.mats = np.empty(len(order), dtype=np.int64)
+        self.mats[order] = mats
+        self.flips = np.empty(len(order), dtype=bool)
+        self.flips[order] = flips
+
+        rects = np.array(rects, dtype=np.float64).reshape(-1, 8)
+        self.rect_axes = rects[:, 0:3].astype(np.int64)
+        self.rect_lo = rects[:, 3:5]
+        self.rect_hi = rects[:, 5:7]
+        self.rect_k = rects[:, 7]
+        self.rect_area = np.prod(self.rect_hi - self.rect_lo, axis=1)
+
+        spheres = np.array(spheres, dtype=np.float64).reshape(-1, 4)
+        self.sph_c = spheres[:, 0:3]
+        self.sph_r = spheres[:, 3]
+
+        self.count = len(self.rect_k) + len(self.sph_r)
+
+    def solid_angles(self, i, o):
+        '''Solid angle of rectangle i seen from points o, with the terms for sampling it (like aarect.spherical_rectangle)'''
+        n_axis, a_axis, b_axis = self.rect_axes[i]
+        x0 = self.rect_lo[i, 0] - o[:, a_axis]
+        x1 = self.rect_hi[i, 0] - o[:, a_axis]
+        y0 = self.rect_lo[i, 1] - o[:, b_axis]
+        y1 = self.rect_hi[i, 1] - o[:, b_axis]
+        z0 = -np.abs(self.rect_k[i] - o[:, n_axis])
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            z2 = z0 * z0
+            l0 = np.sqrt(z2 + y0 * y0)
+            l1 = np.sqrt(z2 + x1 * x1)
+            l2 = np.sqrt(z2 + y1 * y1)
+            l3 = np.sqrt(z2 + x0 * x0)
+            g0 = np.arccos(np.clip(y0 * x1 / (l0 * l1), -1.0, 1.0))
+            g1 = np.arccos(np.clip(-x1 * y1 / (l1 * l2), -1.0, 1.0))
+            g2 = np.arccos(np.clip(y1 * x0 / (l2 * l3), -1.0, 1.0))
+            g3 = np.arccos(np.clip(-x0 * y0 / (l3 * l0), -1.0, 1.0))
+            k = 2 * pi - g2 - g3
+            solid_angle = np.where(z0 < 0, np.maximum(g0 + g1 - k, 0.0), 0.0)
+        return np.nan_to_num(solid_angle), k, -y0 / l0, y1 / l2, (x0, x1, y0, y1, z0)
+
+    def sphere_pdf(self, i, o, v):
+        '''Density of sampling directions v (hitting sphere i) from points o (like Sphere.light_pdf)'''
+        oc = self.sph_c[i] - o
+        distance_squared = dot(oc, oc)
+        r2 = self.sph_r[i] ** 2
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x = r2 / distance_squared
+            cone = 1 / (2 * pi * x / (1 + np.sqrt(np.maximum(1 - x, 0.0))))
+            b = dot(oc, v) / np.sqrt(dot(v, v))
+            t = b + np.sqrt(np.maximum(b * b - distance_squared + r2, 0.0))
+            cosine = np.maximum(np.abs(t - b) / self.sph_r[i], 1e-12)
+            inside = t * t / (cosine * 4 * pi * r2)
+        return np.where(distance_squared > r2, cone, inside)
+
+    def pdf_value(self, o, v, t):
+        '''Density of sample choosing the nearest light that rays (o, v) hit, for rays that hit a light at t (0 where that light is not
+        one of the table, like LightList.light_pdf)'''
+        nearest = np.full(len(o), np.inf)
+        total = np.zeros(len(o))
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for i in range(len(self.rect_k)):
+                n_axis, a_axis, b_axis = self.rect_axes[i]
+                t_light = (self.rect_k[i] - o[:, n_axis]) / v[:, n_axis]
+                pa = o[:, a_axis] + t_light * v[:, a_axis]
+                pb = o[:, b_axis] + t_light * v[:, b_axis]
+                hit = (t_light >= 0.001) & (t_light < nearest) & (pa >= self.rect_lo[i, 0]) & (pa <= self.rect_hi[i, 0]) \
+                    & (pb >= self.rect_lo[i, 1]) & (pb <= self.rect_hi[i, 1])
+                nearest = np.where(hit, t_light, nearest)
+                total = np.where(hit, self.select_pdf[i] / self.solid_angles(i, o)[0], total)
+
+            length_squared = dot(v, v)
+            for i in range(len(self.sph_r)):
+                oc = o - self.sph_c[i]
+                half_b = dot(oc, v)
+                cc = dot(oc, oc) - self.sph_r[i] ** 2
+                root = np.sqrt(np.maximum(half_b * half_b - length_squared * cc, 0.0))
+                t_near = (-half_b - root) / length_squared
+                t_far = (-half_b + root) / length_squared
+                t_light = np.where(t_near >= 0.001, t_near, t_far)
+                hit = (half_b * half_b - length_squared * cc > 0) & (t_light >= 0.001) & (t_light < nearest)
+                nearest = np.where(hit, t_light, nearest)
+                total = np.where(hit, self.select_pdf[len(self.rect_k) + i] * self.sphere_pdf(i, o, v), total)
+
+        found = np.abs(nearest - t) <= SHADOW_EPSILON * t
+        return np.where(found, np.nan_to_num(total), 0.0)
+
+    def sample(self, o, rng):
+        '''Directions (unit length) from points o towards lights chosen by power, uniform over the solid angle of each light (like
+        LightList.sample), returning the chosen lights (entries of the arrays), the directions, distances and densities'''
+        n = len(o)
+        x = rng.random(n) * self.count
+        column = np.minimum(x.astype(np.int64), self.count - 1)
+        choice = np.where(x - column < self.alias_prob[column], self.alias_own[column], self.alias_other[column])
+        directions = np.zeros((n, 3))
+        distances = np.ones(n)
+        pdfs = np.zeros(n)
+
+        for i in range(len(self.rect_k)):
+            sel = np.flatnonzero(choice == i)
+            n_axis, a_axis, b_axis = self.rect_axes[i]
+            solid_angle, k, b0, b1, (x0, x1, y0, y1, z0) = self.solid_angles(i, o[sel])
+            u = rng.random(len(sel))
+            v = rng.random(len(sel))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                au = u * solid_angle + k
+                fu = (np.cos(au) * b0 - b1) / np.sin(au)
+                cu = np.clip(np.where(fu > 0, 1.0, -1.0) / np.sqrt(fu * fu + b0 * b0), -1.0, 1.0)
+                xu = np.clip(np.nan_to_num(-(cu * z0) / np.sqrt(1 - cu * cu)), x0, x1)
+                d = np.sqrt(xu * xu + z0 * z0)
+                h0 = y0 / np.sqrt(d * d + y0 * y0)
+                h1 = y1 / np.sqrt(d * d + y1 * y1)
+                hv = h0 + v * (h1 - h0)
+                hv2 = hv * hv
+                yv = np.clip(np.where(hv2 < 1 - 1e-12, hv * d / np.sqrt(1 - hv2), y1), y0, y1)
+            point = np.empty((len(sel), 3))
+            point[:, a_axis] = xu
+            point[:, b_axis] = yv
+            point[:, n_axis] = self.rect_k[i] - o[sel, n_axis]
+            distance = np.sqrt(dot(point, point))
+            ok = (solid_angle > 0) & (distance > 0)
+            directions[sel] = np.nan_to_num(point / distance[:, None])
+            distances[sel] = distance
+            pdfs[sel] = np.where(ok, self.select_pdf[i] / np.where(ok, solid_angle, 1.0), 0.0)
+
+        for i in range(len(self.sph_r)):
+            j = len(self.rect_k) + i
+            sel = np.flatnonzero(choice == j)
+            oc = self.sph_c[i] - o[sel]
+            distance_squared = dot(oc, oc)
+            r = self.sph_r[i]
+            r1 = rng.random(len(sel))
+            r2 = rng.random(len(sel))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                # Cone sampling from outside
+                x = r * r / distance_squared
+                one_minus_cos_max = x / (1 + np.sqrt(np.maximum(1 - x, 0.0)))
+                cos_theta = 1 - r2 * one_minus_cos_max
+                sin_theta = np.sqrt(np.maximum(1 - cos_theta * cos_theta, 0.0))
+                phi = 2 * pi * r1
+                ou, ov, ow = build_onb(oc)
+                cone = (np.cos(phi) * sin_theta)[:, None] * ou + (np.sin(phi) * sin_theta)[:, None] * ov + cos_theta[:, None] * ow
+                cone_distance = np.sqrt(distance_squared) * cos_theta - np.sqrt(np.maximum(r * r - distance_squared * sin_theta ** 2, 0.0))
+
+                # Area sampling from inside
+                z = 1 - 2 * r1
+                ring = np.sqrt(np.maximum(1 - z * z, 0.0))
+                normal = np.stack((ring * np.cos(2 * pi * r2), ring * np.sin(2 * pi * r2), z), axis=1)
+                to_point = oc + r * normal
+                area_distance = np.sqrt(dot(to_point, to_point))
+                area_direction = to_point / area_distance[:, None]
+                cosine = np.maximum(np.abs(dot(normal, area_direction)), 1e-12)
+
+                outside = distance_squared > r * r
+                directions[sel] = np.where(outside[:, None], cone, area_direction)
+                distances[sel] = np.where(outside, cone_distance, area_distance)
+                pdfs[sel] = self.select_pdf[j] * np.where(outside, 1 / (2 * pi * one_minus_cos_max), area_distance ** 2 / (cosine * 4 * pi * r * r))
+
+        return choice, directions, distances, np.nan_to_num(pdfs)
+
+    def emitted(self, choice, o, d, distance):
+        '''Light emitted by lights choice towards points o from the points at distance along directions d (as returned by sample),
+        without tracing the rays (like LightList.emitted); lights are looked up at a point, like the shadow rays of ray_color'''
+        n = len(choice)
+        p = o + distance[:, None] * d
+        u = np.zeros(n)
+        v = np.zeros(n)
+        front_face = np.zeros(n, dtype=bool)
+
+        sel = np.flatnonzero(choice < len(self.rect_k))
+        i = choice[sel]
+        axes = self.rect_axes[i]
+        lo, hi = self.rect_lo[i], self.rect_hi[i]
+        u[sel] = (p[sel, axes[:, 1]] - lo[:, 0]) / (hi[:, 0] - lo[:, 0])
+        v[sel] = (p[sel, axes[:, 2]] - lo[:, 1]) / (hi[:, 1] - lo[:, 1])
+        front_face[sel] = d[sel, axes[:, 0]] < 0
+
+        sel = np.flatnonzero(choice >= len(self.rect_k))
+        i = choice[sel] - len(self.rect_k)
+        outward = (p[sel] - self.sph_c[i]) / self.sph_r[i, None]
+        u[sel], v[sel] = sphere_uv(outward)
+        front_face[sel] = dot(d[sel], outward) < 0
+
+        mat = self.mats[choice]
+        emits = (front_face ^ self.flips[choice]) & (self.materials.kinds[mat] == LIGHT)
+        point = np.zeros(n)
+        return np.where(emits[:, None], self.materials.color(mat, u, v, p, point, point), 0.0)
+
+
+class WavefrontTracer:
+    '''Traces batches of rays through a scene bounce by bounce, keeping all live rays in NumPy arrays'''
+
+    def __init__(self, world, lights, background):
+        self.materials = MaterialTable()
+        self.geometry = Geometry(self.materials)
+        self.geometry.add(world)
+        self.geometry.finalize()
+        self.materials.finalize()
+        self.lights = LightTable(lights, self.materials) if lights is not None and len(lights) > 0 else None
+        self.background = vec_to_array(background)
+
+    def camera_rays(self, camera, i, j, width, height, rng):
+        '''Generate camera rays through pixels (i, j) with random jitter, like Camera.get_ray'''
+        n = len(i)
+        s = (i + rng.random(n)) / (width - 1)
+        t = (j + rng.random(n)) / (height - 1)
+
+        dx, dy = random_in_unit_disk(rng, n)
+        offset = camera.lens_radius * (dx[:, None] * vec_to_array(camera.u) + dy[:, None] * vec_to_array(camera.v))
+        origin = vec_to_array(camera.origin) + offset
+        direction = vec_to_array(camera.lower_left_corner) + s[:, None] * vec_to_array(camera.horizontal) \
+            + t[:, None] * vec_to_array(camera.vertical) - origin
+        time = rng.uniform(camera.time0, camera.time1, n)
+
+        return origin, direction, time
+
+    def intersect(self, o, d, time, rng):
+        '''Closest hit of every ray against surfaces and media, returning (t, primitive id, material id)'''
+        t, prim = self.geometry.intersect(o, d, time, 0.001, np.inf)
+        mat = np.where(prim >= 0, self.geometry.mats[np.maximum(prim, 0)], -1)
+
+        for boundary, neg_inv_density, phase in self.geometry.media:
+            inside, t_scatter = self.scatter_in_medium(boundary, neg_inv_density, o, d, time, t, rng)
+            t[inside] = t_scatter
+            prim[inside] = -1
+            mat[inside] = phase
+
+        return t, prim, mat
+
+    def occluded(self, o, d, time, t_max, rng):
+        '''Whether surfaces block rays before t_max, or media scatter them (at random, like in intersect)'''
+        blocked = self.geometry.occluded(o, d, time, 0.001, t_max)
+        for boundary, neg_inv_density, phase in self.geometry.media:
+            open_ = np.flatnonzero(~blocked)
+            inside, _ = self.scatter_in_medium(boundary, neg_inv_density, o[open_], d[open_], time[open_], t_max[open_], rng)
+            blocked[open_[inside]] = True
+        return blocked
+
+    @staticmethod
+    def scatter_in_medium(boundary, neg_inv_density, o, d, time, t, rng):
+        '''Rays that a medium scatters before distances t (like ConstantMedium.intersect), returning their indices and where they
+        scatter'''
+        t1, prim1 = boundary.intersect(o, d, time, -np.inf, np.inf)
+        inside = np.flatnonzero(prim1 >= 0)
+        t2, prim2 = boundary.intersect(o[inside], d[inside], time[inside], t1[inside] + 0.0001, np.inf)
+        inside, t1, t2 = inside[prim2 >= 0], t1[inside][prim2 >= 0], t2[prim2 >= 0]
+
+        t1 = np.maximum(t1, 0.001)
+        t2 = np.minimum(t2, t[inside])
+        ray_length = np.sqrt(dot(d[inside], d[inside]))
+        hit_distance = neg_inv_density * np.log(rng.random(len(inside)))
+        scattered = (t1 < t2) & (hit_distance <= (t2 - t1) * ray_length)
+        return inside[scattered], t1[scattered] + hit_distance[scattered] / ray_length[scattered]
+
+    def trace(self, o, d, time, pixel, pixel_count, max_depth, rng, stats=None, costs=None, features=None, spread=0.0):
+        '''Trace rays (with pixel indices) and return the summed radiance per pixel, adding the number of rays traced per pixel to costs
+        and the albedo, normal and distance of the first hits per pixel to features (seven columns) if given
+
+        Textures are filtered over the width of a cone around each ray, widening by spread with the distance its path has travelled,
+        like ray_color.
+
+        Diffuse hits sample the lights with a shadow ray and cosine sample the next direction, combining both with the power heuristic
+        like ray_color.
+        '''
+        radiance = np.zeros((pixel_count, 3))
+        throughput = np.ones((len(o), 3))
+        # Density of the diffuse sample that chose each ray (0 for camera and specular rays, whose emitter hits count fully)
+        bsdf_pdf = np.zeros(len(o))
+        travelled = np.zeros(len(o))
+        materials = self.materials
+
+        for bounce in range(max_depth):
+            if len(o) == 0:
+                break
+            if stats is not None:
+                stats.record_rays(bounce, len(o))
+            if costs is not None:
+                costs += np.bincount(pixel, minlength=pixel_count)
+
+            t, prim, mat = self.intersect(o, d, time, rng)
+
+            # Rays escaping the scene pick up the background color
+            miss = mat < 0
+            self.accumulate(radiance, pixel[miss], throughput[miss] * self.background, pixel_count)
+            if features is not None and bounce == 0:
+                np.add.at(features[:, 0:3], pixel[miss], self.background)
+            keep = ~miss
+            o, d, time, pixel, throughput, bsdf_pdf = o[keep], d[keep], time[keep], pixel[keep], throughput[keep], bsdf_pdf[keep]
+            t, prim, mat, travelled = t[keep], prim[keep], mat[keep], travelled[keep]
+            if len(o) == 0:
+                break
+
+            # Surface data is only computed for the closest hit of each ray
+            p = o + t[:, None] * d
+            normal = np.zeros_like(o)
+            normal[:, 0] = 1.0
+            front_face = np.ones(len(o), dtype=bool)
+            u = np.zeros(len(o))
+            v = np.zeros(len(o))
+            du = np.zeros(len(o))
+            dv = np.zeros(len(o))
+            surface = np.flatnonzero(prim >= 0)
+            p[surface], normal[surface], front_face[surface], u[surface], v[surface], du[surface], dv[surface] = \
+                self.geometry.surface(o[surface], d[surface], time[surface], t[surface], prim[surface])
+            distance = t * np.sqrt(dot(d, d))
+            travelled = travelled + distance
+            footprint = spread * travelled
+
+            kind = materials.kinds[mat]
+            color = materials.color(mat, u, v, p, footprint * du, footprint * dv)
+            new_d = np.zeros_like(d)
+            weight = np.zeros_like(throughput)
+
+            emitting = np.flatnonzero((kind == LIGHT) & front_face)
+            mis = np.ones(len(emitting))
+            if self.lights is not None:
+                # Emitters found by diffuse samples only add the part of their light that the light samples did not already count
+                scattered = np.flatnonzero(bsdf_pdf[emitting] > 0)
+                sel = emitting[scattered]
+                mis[scattered] = power_heuristic(bsdf_pdf[sel], self.lights.pdf_value(o[sel], d[sel], t[sel]))
+            self.accumulate(radiance, pixel[emitting], throughput[emitting] * color[emitting] * mis[:, None], pixel_count)
+
+            if features is not None and bounce == 0:
+                # Glass passes all light, and lights have no albedo, so their (clamped) emission stands in for it (black from behind, like ray_color)
+                albedo = np.minimum(color, 1.0)
+                albedo[kind == DIELECTRIC] = 1.0
+                albedo[(kind == LIGHT) & ~front_face] = 0.0
+                np.add.at(features, pixel, np.hstack((albedo, normal, distance[:, None])))
+
+            # Diffuse surfaces and media sample the lights, and remember the density of their next direction for weighting emitters it hits
+            new_pdf = np.zeros(len(o))
+            if self.lights is not None:
+                sel = np.flatnonzero((kind == LAMBERTIAN) | (kind == ISOTROPIC))
+                light, traced = self.sample_lights(p[sel], normal[sel], kind[sel] == ISOTROPIC, time[sel], rng)
+                if stats is not None:
+                    stats.record_shadow_rays(len(traced))
+                if costs is not None:
+                    costs += np.bincount(pixel[sel[traced]], minlength=pixel_count)
+                self.accumulate(radiance, pixel[sel], throughput[sel] * color[sel] * light, pixel_count)
+
+            sel = np.flatnonzero(kind == LAMBERTIAN)
+            new_d[sel], weight[sel], pdf = self.scatter_lambertian(normal[sel], color[sel], rng)
+            if self.lights is not None:
+                new_pdf[sel] = pdf
+
+            sel = np.flatnonzero(kind == METAL)
+            reflected = reflect(unit(d[sel]), normal[sel])
+            new_d[sel] = reflected + materials.fuzz[mat[sel], None] * random_in_unit_sphere(rng, len(sel))
+            weight[sel] = color[sel]
+
+            sel = np.flatnonzero(kind == DIELECTRIC)
+            new_d[sel] = self.scatter_dielectric(d[sel], normal[sel], front_face[sel], materials.ref_idx[mat[sel]], rng)
+            weight[sel] = 1.0
+
+            sel = np.flatnonzero(kind == ISOTROPIC)
+            new_d[sel] = random_in_unit_sphere(rng, len(sel))
+            weight[sel] = color[sel]
+            if self.lights is not None:
+                new_pdf[sel] = 1 / (4 * pi)
+
+            # Compact away rays absorbed by lights, with zero contribution, or ended by Russian roulette (survivors are boosted)
+            throughput = throughput * weight
+            survival = throughput.max(axis=1)
+            keep = (kind != LIGHT) & (survival > 0)
+            if bounce >= RUSSIAN_ROULETTE_DEPTH:
+                survival = np.minimum(survival, 1.0)
+                keep &= rng.random(len(survival)) < survival
+                throughput[keep] /= survival[keep, None]
+            o, d, time, pixel, throughput, bsdf_pdf = p[keep], new_d[keep], time[keep], pixel[keep], throughput[keep], new_pdf[keep]
+            travelled = travelled[keep]
+
+        return radiance
+
+    def sample_lights(self, p, normal, isotropic, time, rng):
+        '''Light reaching diffuse hits (or isotropic medium points) from a sampled point on the lights (divided by the albedo),
+        weighted against material sampling with the power heuristic (like ray_color), and the indices of the points that traced a
+        shadow ray (those facing a sampled point that emits); the shadow rays are blocked by anything before the sampled point'''
+        result = np.zeros((len(p), 3))
+        choice, direction, distance, light_pdf = self.lights.sample(p, rng)
+        lit = np.flatnonzero(light_pdf > 0)
+        emitted = self.lights.emitted(choice[lit], p[lit], direction[lit], distance[lit])
+        emits = emitted.max(axis=1) > 0
+        lit, emitted = lit[emits], emitted[emits]
+
+        visible = ~self.occluded(p[lit], direction[lit], time[lit], distance[lit] * (1 - SHADOW_EPSILON), rng)
+        hit, emitted = lit[visible], emitted[visible]
+
+        # The scattering density is also the density of sampling the direction from the material
+        scattering = np.where(isotropic[hit], 1 / (4 * pi), np.maximum(dot(direction[hit], normal[hit]), 0.0) / pi)
+        pdf = light_pdf[hit]
+        result[hit] = emitted * (scattering * power_heuristic(pdf, scattering) / pdf)[:, None]
+        return result, lit
+
+    def scatter_lambertian(self, normal, albedo, rng):
+        '''Cosine sample diffuse bounces, returning the directions, their weights and their densities'''
+        n = len(normal)
+        ou, ov, ow = build_onb(normal)
+        r1 = rng.random(n)
+        r2 = rng.random(n)
+        z = np.sqrt(1 - r2)
+        phi = 2 * pi * r1
+        local = (np.cos(phi) * np.sqrt(r2), np.sin(phi) * np.sqrt(r2), z)
+        direction = local[0][:, None] * ou + local[1][:, None] * ov + local[2][:, None] * ow
+        return direction, albedo, z / pi
+
+    def scatter_dielectric(self, d, normal, front_face, ref_idx, rng):
+        '''Reflect or refract rays through glass, choosing by the Schlick approximation'''
+        length = np.sqrt(dot(d, d))
+        ni_over_nt = np.where(front_face, 1.0 / ref_idx, ref_idx)
+        cosine = np.where(front_face, 1.0, ref_idx) * -dot(d, normal) / length
+
+        uv = d / length[:, None]
+        dt = dot(uv, normal)
+        discriminant = 1.0 - ni_over_nt * ni_over_nt * (1 - dt * dt)
+        refracted = ni_over_nt[:, None] * (uv - normal * dt[:, None]) - normal * np.sqrt(np.maximum(discriminant, 0.0))[:, None]
+
+        r0 = ((1 - ref_idx) / (1 + ref_idx)) ** 2
+        reflect_prob = np.where(discriminant > 0, r0 + (1 - r0) * (1 - cosine) ** 5, 1.0)
+        reflects = rng.random(len(d)) < reflect_prob
+        return np.where(reflects[:, None], reflect(d, normal), refracted)
+
+    @staticmethod
+    def accumulate(radiance, pixel, color, pixel_count):
+        color = np.nan_to_num(color)
+        for c in range(3):
+            radiance[:, c] += np.bincount(pixel, weights=color[:, c], minlength=pixel_count)
+
+    def render_pixels(self, camera, i, j, width, height, samples_per_pixel, max_depth, rng, stats=None, costs=None, features=None):
+        '''Summed radiance and summed squared luminance of samples_per_pixel camera rays through each pixel (i, j), adding the rays traced
+        and the first-hit features per pixel to costs and features if given'''
+        pixel_count = len(i)
+        radiance = np.zeros((pixel_count, 3))
+        squares = np.zeros(pixel_count)
+        samples_per_pass = max(1, TILE_RAYS // max(pixel_count, 1))
+        # Angle covered by a pixel, which widens the texture footprint of the camera rays
+        spread = camera.viewport_height / (height - 1)
+
+        for done in range(0, samples_per_pixel, samples_per_pass):
+            samples = min(samples_per_pass, samples_per_pixel - done)
+            pixel = np.tile(np.arange(pixel_count), samples)
+            o, d, time = self.camera_rays(camera, i[pixel], j[pixel], width, height, rng)
+            # Radiance is gathered per sample first, so the spread of the samples can be measured
+            sample_costs = np.zeros(len(pixel)) if costs is not None else None
+            sample_features = np.zeros((len(pixel), 7)) if features is not None else None
+            sample_radiance = self.trace(o, d, time, np.arange(len(pixel)), len(pixel), max_depth, rng, stats, sample_costs, sample_features, spread).reshape(samples, pixel_count, 3)
+            if costs is not None:
+                costs += sample_costs.reshape(samples, pixel_count).sum(axis=0)
+            if features is not None:
+                features += sample_features.reshape(samples, pixel_count, 7).sum(axis=0)
+            radiance += sample_radiance.sum(axis=0)
+            squares += ((sample_radiance @ np.array(LUMINANCE)) ** 2).sum(axis=0)
+
+        return radiance, squares
+
+
+def reflect(v, n):
+    '''Reflect the rows of v about the normals n'''
+    return v - 2 * dot(v, n)[:, None] * n
+
+
+class WavefrontRenderer:
+    '''Renders image tiles with the wavefront tracer (the scene is compiled to arrays once per renderer)'''
+
+    def __init__(self, scene, max_depth, background, seed=None):
+        self.scene = scene
+        self.max_depth = max_depth
+        self.tracer = WavefrontTracer(scene.world, scene.lights, background)
+        self.seed = seed
+        self.rng = np.random.default_rng(seed)
+        self.stats = None
+        self.heatmap = False
+        self.features = False
+
+    def set_view(self, camera, width, height):
+        '''Render the same compiled world from another camera or at another image size'''
+        self.scene = Scene(camera, self.scene.world, self.scene.lights, width, height)
+
+    def render_tile(self, x0, y0, x1, y1, samples_per_pixel, first_sample=0):
+        '''Summed colors, squared luminances and (with heatmap or features set, else None) rays traced and first-hit features of some
+        samples, numbered from first_sample, for each pixel in a tile (row-major, y0 is the top row)'''
+        rows = np.arange(y0, y1)
+        j = np.repeat(self.scene.height - 1 - rows, x1 - x0)
+        i = np.tile(np.arange(x0, x1), len(rows))
+        costs = np.zeros(len(i)) if self.heatmap else None
+        features = np.zeros((len(i), 7)) if self.features else None
+        # With a seed, every pass over a tile gets its own random numbers, so the image does not depend on which process renders it
+        rng = self.rng if self.seed is None else np.random.default_rng((self.seed, x0, y0, first_sample))
+        radiance, squares = self.tracer.render_pixels(self.scene.camera, i, j, self.scene.width, self.scene.height, samples_per_pixel, self.max_depth, rng, self.stats, costs, features)
+        return radiance.tolist(), squares.tolist(), costs.tolist() if costs is not None else None, features.tolist() if features is not None else None